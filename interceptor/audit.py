@@ -0,0 +1,170 @@
+"""
+intercept status --all - a read-only audit of every tool that interceptor knows about.
+
+The tools are those having a configuration, and those having a foo-intercepted beside foo
+somewhere in PATH. PATH is walked once for all of them, the wrappers' headers are read by a
+thread pool, and each configuration file is parsed once, no matter how many tools are linked
+to it.
+"""
+import json
+import os
+import re
+import typing as tp
+from concurrent.futures import ThreadPoolExecutor
+
+from interceptor import __version__
+from interceptor.config import Configuration, read_json_from_file
+from interceptor.index import ExecutableIndex, INTERCEPTED
+
+WORKERS = 16
+
+INTERCEPTED_STATUS = 'intercepted'
+PARTIAL_STATUS = 'partially intercepted'
+UNINTERCEPTED_STATUS = 'not intercepted'
+NOT_FOUND_STATUS = 'not found'
+
+
+def is_backup(name: str, names: tp.Set[str]) -> bool:
+    """
+    Whether name is a backup written by intercept backup, ie. foo.N where foo has a
+    configuration and foo.1 to foo.N-1 are there as well, since it numbers them from 1 up.
+    Tools such as python3.11 or gcc-12.2 are not taken for backups that way.
+
+    :param names: names of all the files in the interceptor directory
+    """
+    base, _, suffix = name.rpartition('.')
+    if base not in names or not suffix.isdigit() or suffix.startswith('0'):
+        return False
+    return all('%s.%d' % (base, i) in names for i in range(1, int(suffix)))
+
+
+def version_key(version: str) -> list:
+    """
+    :return: a key ordering versions such as 2.1, 2.2a3, 2.2 and 2.2.1 in that order
+    """
+    key = [(2, int(part)) if part.isdigit() else (0, part)
+           for part in re.findall(r'\d+|[^\d.]+', version)]
+    # a version that ends is newer than it's pre-releases, but older than it's patch releases
+    key.append((1,))
+    return key
+
+
+def is_older(version: str) -> bool:
+    """Whether version is older than the installed version of interceptor"""
+    return not version or version_key(version) < version_key(__version__)
+
+
+def list_configurations() -> tp.Dict[str, tp.Optional[str]]:
+    """
+    Return names of the tools that have a configuration, mapped to the name of the tool whose
+    configuration it's a symlink to, or None if it's not a symlink.
+
+    Backups (foo.1, foo.2 and so on) and hidden files are skipped.
+    """
+    configurations = {}
+    entries = list(os.scandir(Configuration.interceptor_path()))
+    names = {entry.name for entry in entries}
+    for entry in entries:
+        name = entry.name
+        if name.startswith('.') or is_backup(name, names):
+            continue
+        if entry.is_symlink():
+            configurations[name] = os.path.basename(os.readlink(entry.path))
+        elif entry.is_file():
+            configurations[name] = None
+    return configurations
+
+
+def validate_configuration(path: str) -> tp.Optional[str]:
+    """Return why the configuration at path is invalid, or None if it's valid"""
+    try:
+        Configuration.from_json(read_json_from_file(path), os.path.basename(path))
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        return str(e)
+    return None
+
+
+def audit(workers: int = WORKERS) -> dict:
+    """
+    Inspect every configuration and every wrapper, changing nothing.
+
+    :return: a JSON-able report
+    """
+    configurations = list_configurations()
+    index = ExecutableIndex(configurations, with_intercepted=True, workers=workers)
+
+    paths = {name: os.path.realpath(os.path.join(Configuration.interceptor_path(), name))
+             for name in configurations}
+    unique_paths = sorted(set(paths.values()))
+    with ThreadPoolExecutor(workers) as executor:
+        errors = dict(zip(unique_paths, executor.map(validate_configuration, unique_paths)))
+
+    tools = []
+    for name in sorted(index.names | set(configurations)):
+        executables = index.paths(name, abort_on_failure=False)
+        wrappers = [executable for executable in executables if executable.is_wrapper]
+        if not executables:
+            status = NOT_FOUND_STATUS
+        elif len(wrappers) == len(executables):
+            status = INTERCEPTED_STATUS
+        elif wrappers:
+            status = PARTIAL_STATUS
+        else:
+            status = UNINTERCEPTED_STATUS
+
+        problems = []
+        if status == PARTIAL_STATUS:
+            problems.append('partially intercepted, call intercept %s --force' % (name,))
+        if name not in configurations:
+            if wrappers:
+                problems.append('configuration is missing')
+        elif errors[paths[name]] is not None:
+            problems.append('configuration is invalid: %s' % (errors[paths[name]],))
+        for executable in executables:
+            if executable.is_wrapper and not executable.has_original:
+                problems.append('%s is missing' % (executable.path + INTERCEPTED,))
+            elif not executable.is_wrapper and executable.has_original:
+                problems.append('%s is not a wrapper, but %s exists' % (
+                    executable.path, executable.path + INTERCEPTED))
+            if executable.is_wrapper and is_older(executable.version):
+                problems.append('%s was generated by interceptor %s' % (
+                    executable.path, executable.version or 'older than 2.0'))
+
+        tools.append({'name': name,
+                      'status': status,
+                      'config': name in configurations,
+                      'linked_to': configurations.get(name),
+                      'executables': [{'path': executable.path,
+                                       'wrapper': executable.is_wrapper,
+                                       'original': executable.has_original,
+                                       'version': executable.version}
+                                      for executable in executables],
+                      'problems': problems})
+
+    return {'version': __version__,
+            'tools': tools,
+            'orphans': sorted(index.orphans),
+            'problems': sum(len(tool['problems']) for tool in tools) + len(index.orphans)}
+
+
+def print_audit(as_json: bool = False) -> None:
+    report = audit()
+    if as_json:
+        print(json.dumps(report, indent=4))
+        return
+
+    counts = {}
+    for tool in report['tools']:
+        counts[tool['status']] = counts.get(tool['status'], 0) + 1
+        line = '%-24s %s' % (tool['name'], tool['status'])
+        if tool['linked_to'] is not None:
+            line += ', config linked to %s' % (tool['linked_to'],)
+        print(line)
+        for problem in tool['problems']:
+            print('    %s' % (problem,))
+    for orphan in report['orphans']:
+        print('orphaned %s' % (orphan,))
+    print('%s tools: %s, %s problems found' % (
+        len(report['tools']),
+        ', '.join('%s %s' % (count, status) for status, count in sorted(counts.items())),
+        report['problems']))
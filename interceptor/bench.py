@@ -0,0 +1,368 @@
+"""
+Measuring the overhead of interception.
+
+intercept bench foo spawns foo's wrapper (made to exec a trivial target, /bin/true by default)
+and the target itself the same number of times, and reports the difference between them,
+together with a breakdown of where the wrapper spends it's time.
+
+python -m interceptor.bench runs a synthetic suite of argument counts and rule counts,
+that needs neither root nor any intercepted tool, so that it can be ran in CI.
+
+intercept bench-parallelism simulates a build on this machine, while other work keeps some of
+it's CPUs busy, with a few fixed job counts and with the one a parallelism policy picks, and
+reports the build's throughput and how much CPU time was left for the other work.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import typing as tp
+from concurrent.futures import ThreadPoolExecutor
+
+from interceptor.config import Configuration
+from interceptor.intercepting import render_wrapper, INTERCEPTED
+from interceptor.whereis import filter_whereis
+
+PHASES = ('start', 'imports', 'load_config_for', 'modify', 'execv')
+
+
+def percentile(values: tp.Sequence[float], fraction: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(values: tp.Sequence[float]) -> tp.Dict[str, float]:
+    return {'mean': sum(values) / len(values) if values else 0.0,
+            'p50': percentile(values, 0.5),
+            'p99': percentile(values, 0.99)}
+
+
+def spawn_many(args: tp.List[str], runs: int, jobs: int,
+               env: tp.Optional[tp.Dict[str, str]] = None,
+               profile_dir: tp.Optional[str] = None) -> tp.List[tp.Tuple[float, float]]:
+    """
+    Run args runs times, at most jobs at once.
+
+    :param profile_dir: if given, each wrapper will record it's phases into a separate file
+        named after the number of the run in this directory
+    :return: a list of (time of spawning, time of exit) of each run
+    """
+    def spawn(i: int) -> tp.Tuple[float, float]:
+        run_env = dict(os.environ if env is None else env)
+        if profile_dir is not None:
+            run_env['INTERCEPTOR_PROFILE'] = os.path.join(profile_dir, str(i))
+        started_at = time.time()
+        subprocess.run(args, env=run_env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        return started_at, time.time()
+
+    with ThreadPoolExecutor(jobs) as executor:
+        return list(executor.map(spawn, range(runs)))
+
+
+def read_phases(profile_dir: str,
+                spawns: tp.List[tp.Tuple[float, float]]) -> tp.Dict[str, tp.List[float]]:
+    phases = {phase: [] for phase in PHASES}
+    for i, (spawned_at, finished_at) in enumerate(spawns):
+        try:
+            with open(os.path.join(profile_dir, str(i)), 'r') as f_in:
+                started_at, imported_at, loaded_at, modified_at = map(float, f_in.read().split())
+        except (OSError, ValueError):
+            continue
+        phases['start'].append(started_at - spawned_at)
+        phases['imports'].append(imported_at - started_at)
+        phases['load_config_for'].append(loaded_at - imported_at)
+        phases['modify'].append(modified_at - loaded_at)
+        phases['execv'].append(finished_at - modified_at)
+    return phases
+
+
+def measure_overhead(tool_name: str, wrapper_args: tp.List[str], target_args: tp.List[str],
+                     runs: int, jobs: int, env: tp.Optional[tp.Dict[str, str]] = None) -> dict:
+    """
+    Spawn the wrapper and it's target runs times each and compare the times they took.
+    """
+    with tempfile.TemporaryDirectory() as profile_dir:
+        wrapped = spawn_many(wrapper_args, runs, jobs, env, profile_dir)
+        phases = read_phases(profile_dir, wrapped)
+    direct = spawn_many(target_args, runs, jobs, env)
+    wrapped_times = [finished_at - started_at for started_at, finished_at in wrapped]
+    direct_times = [finished_at - started_at for started_at, finished_at in direct]
+    wrapped_summary = summarize(wrapped_times)
+    direct_summary = summarize(direct_times)
+    return {'tool': tool_name,
+            'runs': runs,
+            'jobs': jobs,
+            'wrapped': wrapped_summary,
+            'direct': direct_summary,
+            'overhead': {key: wrapped_summary[key] - direct_summary[key]
+                         for key in wrapped_summary},
+            'phases': {phase: summarize(values) for phase, values in phases.items()}}
+
+
+def print_report(report: dict) -> None:
+    def ms(summary: tp.Dict[str, float]) -> str:
+        return 'mean %8.3f ms  p50 %8.3f ms  p99 %8.3f ms' % (
+            summary['mean'] * 1000, summary['p50'] * 1000, summary['p99'] * 1000)
+
+    print('%s: %s runs, %s at once' % (report['tool'], report['runs'], report['jobs']))
+    print('  wrapped   %s' % (ms(report['wrapped']),))
+    print('  direct    %s' % (ms(report['direct']),))
+    print('  overhead  %s' % (ms(report['overhead']),))
+    for phase in PHASES:
+        print('    %-16s %s' % (phase, ms(report['phases'][phase])))
+
+
+def bench_tool(tool_name: str, runs: int, jobs: int, target: str, real: bool,
+               arguments: tp.List[str], as_json: bool) -> None:
+    if not os.path.isfile(os.path.join(Configuration.interceptor_path(), tool_name)):
+        print('Configuration for %s does not exist or is not a file' % (tool_name,))
+        sys.exit(1)
+
+    if real:
+        wrapper_path = next(iter(filter_whereis(tool_name)))
+        report = measure_overhead(tool_name, [wrapper_path, *arguments],
+                                  [wrapper_path + INTERCEPTED, *arguments], runs, jobs)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            wrapper_path = os.path.join(tmp_dir, tool_name)
+            with open(wrapper_path, 'w') as f_out:
+                f_out.write(render_wrapper(tool_name, target))
+            os.chmod(wrapper_path, 0o755)
+            report = measure_overhead(tool_name, [wrapper_path, *arguments],
+                                      [target, *arguments], runs, jobs)
+    if as_json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_report(report)
+
+
+def synthetic_configuration(rule_count: int) -> Configuration:
+    """Return a configuration with rule_count rules, spread evenly over all rule kinds"""
+    per_kind = rule_count // 4
+    return Configuration(args_to_disable=['-DDISABLED%s' % (i,) for i in range(per_kind)],
+                         args_to_append=['-DAPPENDED%s' % (i,) for i in range(per_kind)],
+                         args_to_prepend=['-DPREPENDED%s' % (i,) for i in range(per_kind)],
+                         args_to_replace=[['-DREPLACED%s' % (i,), '-DREPLACEMENT%s' % (i,)]
+                                          for i in range(rule_count - 3 * per_kind)],
+                         app_name='bench')
+
+
+def synthetic_arguments(argument_count: int) -> tp.List[str]:
+    """Return a command line of argument_count arguments, some of which are hit by the rules"""
+    args = ['cc', '-c', 'main.c', '-o', 'main.o']
+    kinds = ('-DDISABLED%s', '-DREPLACED%s', '-Iinclude%s', 'object%s.o')
+    for i in range(argument_count - len(args) + 1):
+        args.append(kinds[i % len(kinds)] % (i // len(kinds),))
+    return args
+
+
+def time_rewrite(cfg: Configuration, args: tp.List[str], repeats: int = 5) -> float:
+    best = None
+    for _ in range(repeats):
+        started_at = time.perf_counter()
+        cfg.rewrite(args)
+        elapsed = time.perf_counter() - started_at
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_suite(argument_counts: tp.List[int], rule_counts: tp.List[int], runs: int, jobs: int,
+              target: str) -> tp.List[dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        interceptor_path = os.path.join(tmp_dir, 'etc', 'interceptor.d')
+        os.makedirs(interceptor_path)
+        env = dict(os.environ, VIRTUAL_ENV=tmp_dir)
+        env.pop('INTERCEPTOR_SOCKET', None)
+        for rule_count in rule_counts:
+            cfg = synthetic_configuration(rule_count)
+            with open(os.path.join(interceptor_path, cfg.app_name), 'w') as f_out:
+                json.dump(cfg.to_json(), f_out)
+            wrapper_path = os.path.join(tmp_dir, cfg.app_name)
+            with open(wrapper_path, 'w') as f_out:
+                f_out.write(render_wrapper(cfg.app_name, target))
+            os.chmod(wrapper_path, 0o755)
+
+            for argument_count in argument_counts:
+                args = synthetic_arguments(argument_count)
+                report = measure_overhead(cfg.app_name, [wrapper_path, *args[1:]],
+                                          [target, *args[1:]], runs, jobs, env)
+                report['arguments'] = argument_count
+                report['rules'] = rule_count
+                report['rewrite'] = time_rewrite(cfg, args)
+                results.append(report)
+    return results
+
+
+def print_suite(results: tp.List[dict]) -> None:
+    print('%10s %6s %14s %14s %14s %14s' % ('arguments', 'rules', 'rewrite',
+                                            'overhead p50', 'overhead p99', 'modify p50'))
+    for result in results:
+        print('%10s %6s %11.3f ms %11.3f ms %11.3f ms %11.3f ms' % (
+            result['arguments'], result['rules'], result['rewrite'] * 1000,
+            result['overhead']['p50'] * 1000, result['overhead']['p99'] * 1000,
+            result['phases']['modify']['p50'] * 1000))
+
+
+# a compilation that takes a fixed amount of CPU time and touches a given amount of memory
+BURN = """import time
+end = time.process_time() + %r
+block = bytearray(%d)
+for i in range(0, len(block), 4096):
+    block[i] = 1
+while time.process_time() < end:
+    pass
+"""
+
+
+def cpu_time_of(pid: int) -> float:
+    """:return: CPU time taken so far by the process pid, in seconds"""
+    with open('/proc/%d/stat' % (pid,), 'r') as f_in:
+        fields = f_in.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def run_build(jobs: int, tasks: int, task_time: float, task_memory: int) -> None:
+    script = BURN % (task_time, task_memory)
+    with ThreadPoolExecutor(jobs) as executor:
+        list(executor.map(lambda _: subprocess.run([sys.executable, '-c', script], check=True),
+                          range(tasks)))
+
+
+def simulate_parallelism(policy: dict, fixed_jobs: tp.List[int], tasks: int, task_time: float,
+                         task_memory: int, background: int) -> tp.List[dict]:
+    """
+    Run a build of tasks compilations, with each job count in fixed_jobs and with the one
+    picked by policy, while background busy processes stand for the other work.
+
+    The load average lags a minute behind, so the load the policy is given is the one measured
+    before the background is started plus the background processes, ie. what it will settle
+    at.
+    """
+    from interceptor.parallelism import POLICY_DEFAULTS, job_count, measure_resources
+    resources = measure_resources()
+    resources['load'] += background
+    policy_jobs, _ = job_count(dict(POLICY_DEFAULTS, **policy), resources)
+    scenarios = [('-j%d' % (jobs,), jobs) for jobs in fixed_jobs] + [('policy', policy_jobs)]
+
+    others = [subprocess.Popen([sys.executable, '-c', 'while True: pass'])
+              for _ in range(background)]
+    results = []
+    try:
+        for name, jobs in scenarios:
+            others_before = sum(cpu_time_of(process.pid) for process in others)
+            started_at = time.monotonic()
+            run_build(jobs, tasks, task_time, task_memory)
+            wall = time.monotonic() - started_at
+            others_after = sum(cpu_time_of(process.pid) for process in others)
+            results.append({'scenario': name,
+                            'jobs': jobs,
+                            'wall': wall,
+                            'throughput': tasks / wall,
+                            'background_cpus': (others_after - others_before) / wall})
+    finally:
+        for process in others:
+            process.kill()
+            process.wait()
+    return results
+
+
+def print_simulation(results: tp.List[dict]) -> None:
+    print('%10s %6s %10s %12s %16s' % ('scenario', 'jobs', 'wall', 'tasks/s',
+                                       'background CPUs'))
+    for result in results:
+        print('%10s %6s %8.2f s %12.2f %16.2f' % (
+            result['scenario'], result['jobs'], result['wall'], result['throughput'],
+            result['background_cpus']))
+
+
+def bench_main(argv: tp.List[str]) -> None:
+    """Entry point of intercept bench"""
+    parser = argparse.ArgumentParser(prog='intercept bench',
+                                     description='Measure the overhead of intercepting a tool',
+                                     usage='intercept bench [options] tool [-- arguments]')
+    parser.add_argument('tool', help='name of the intercepted tool, whose config will be used')
+    parser.add_argument('--runs', type=int, default=200, help='how many times to spawn each')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='how many processes to spawn at once')
+    parser.add_argument('--target', default=shutil.which('true') or '/bin/true',
+                        help='the executable the wrapper will exec')
+    parser.add_argument('--real', action='store_true',
+                        help='spawn the installed wrapper and it\'s -intercepted binary instead')
+    parser.add_argument('--json', action='store_true', help='output the report as JSON')
+    arguments = []
+    if '--' in argv:
+        argv, arguments = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+    bench_tool(args.tool, args.runs, args.jobs, args.target, args.real, arguments, args.json)
+
+
+def suite_main(argv: tp.List[str]) -> None:
+    """Entry point of python -m interceptor.bench"""
+    parser = argparse.ArgumentParser(prog='python -m interceptor.bench',
+                                     description='Run the synthetic interception benchmarks')
+    parser.add_argument('--arguments', type=int, nargs='+', default=[10, 1000, 50000])
+    parser.add_argument('--rules', type=int, nargs='+', default=[0, 20, 200])
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--target', default=shutil.which('true') or '/bin/true')
+    parser.add_argument('--json', action='store_true', help='output the results as JSON')
+    parser.add_argument('--max-overhead', type=float, default=None, metavar='MS',
+                        help='fail if the p50 overhead of any case exceeds MS milliseconds')
+    args = parser.parse_args(argv)
+    results = run_suite(args.arguments, args.rules, args.runs, args.jobs, args.target)
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_suite(results)
+    if args.max_overhead is not None:
+        worst = max(result['overhead']['p50'] for result in results) * 1000
+        if worst > args.max_overhead:
+            print('p50 overhead of %.3f ms exceeds %.3f ms' % (worst, args.max_overhead))
+            sys.exit(1)
+
+
+def parallelism_main(argv: tp.List[str]) -> None:
+    """Entry point of intercept bench-parallelism"""
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(
+        prog='intercept bench-parallelism',
+        description='Compare the throughput of a simulated build with fixed job counts and '
+                    'with the one picked by a parallelism policy')
+    parser.add_argument('--tool', help='take the policy from this tool\'s configuration, '
+                                       'instead of using the default one')
+    parser.add_argument('--fixed', type=int, nargs='+', default=[1, cpus * 2],
+                        help='fixed job counts to compare with')
+    parser.add_argument('--tasks', type=int, default=cpus * 8,
+                        help='how many compilations the build has')
+    parser.add_argument('--task-time', type=float, default=0.5,
+                        help='CPU time each compilation takes, in seconds')
+    parser.add_argument('--task-memory', type=int, default=64,
+                        help='memory each compilation touches, in MiB')
+    parser.add_argument('--background', type=int, default=cpus // 2,
+                        help='how many CPUs the other work on the machine keeps busy')
+    parser.add_argument('--json', action='store_true', help='output the results as JSON')
+    args = parser.parse_args(argv)
+    if min(args.fixed + [args.tasks]) < 1 or args.background < 0:
+        parser.error('job counts and --tasks have to be positive')
+    policy = {}
+    if args.tool:
+        from interceptor.config import load_config_for
+        policy = load_config_for(args.tool, None).parallelism
+    results = simulate_parallelism(policy, args.fixed, args.tasks, args.task_time,
+                                   args.task_memory * 1024 * 1024, args.background)
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_simulation(results)
+
+
+if __name__ == '__main__':
+    suite_main(sys.argv[1:])
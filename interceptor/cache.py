@@ -0,0 +1,483 @@
+#
+# The result cache: compiler invocations that compile a single source file are looked up in
+# an on-disk store by a hash of everything they depend on, and their outputs are restored
+# from it instead of running the compiler again.
+#
+# The key is made of the rewritten command line, the working directory, the relevant
+# environment variables, the identity of the compiler's binary, the whole configuration
+# of the tool and the preprocessed source, like in ccache's preprocessor mode, so that
+# changes to any header are noticed as well.
+#
+# Entries are written to a temporary file and renamed into place, so that parallel wrappers
+# never see one half written. Their modification time is bumped on every hit, and when the
+# store grows larger than the tool's cache_max_size, the least recently used ones are removed.
+#
+# This is imported by the wrappers of tools that have "cache" enabled, so only cheap parts of
+# the standard library may be imported at module level here.
+#
+import hashlib
+import marshal
+import os
+import sys
+import time
+
+from interceptor.compiler_options import VALUE_OPTIONS
+from interceptor.config import Configuration
+from interceptor.supervise import Child, exit_like
+
+CACHE_VERSION = 1
+
+STATISTICS = ('hits', 'misses', 'uncacheable', 'stores', 'evictions', 'size', 'probe_hits',
+              'probe_misses')
+
+# environment variables that change what a compiler does
+RELEVANT_ENVIRONMENT = ('LANG', 'LC_ALL', 'LC_CTYPE', 'LC_MESSAGES', 'CPATH', 'C_INCLUDE_PATH',
+                        'CPLUS_INCLUDE_PATH', 'OBJC_INCLUDE_PATH', 'GCC_EXEC_PREFIX',
+                        'COMPILER_PATH', 'SOURCE_DATE_EPOCH', 'DEPENDENCIES_OUTPUT',
+                        'SUNPRO_DEPENDENCIES')
+
+SOURCE_EXTENSIONS = frozenset(('.c', '.cc', '.cp', '.cxx', '.cpp', '.CPP', '.c++', '.C', '.m',
+                               '.mm', '.M', '.i', '.ii', '.s', '.S', '.sx'))
+
+# options that make the compiler read or write files that the cache does not know about
+UNCACHEABLE_PREFIXES = ('-E', '-S', '-M', '-save-temps', '-fprofile', '--coverage',
+                        '-ftest-coverage', '-fdump', '-fsyntax-only', '-gsplit-dwarf',
+                        '-fstack-usage', '-fcallgraph-info', '-fplugin', '-specs', '-B',
+                        '-Wa,', '-Wp,', '-Xpreprocessor', '-fdiagnostics-format=sarif', '@')
+
+DEPENDENCY_OPTIONS = frozenset(('-MD', '-MMD', '-MP'))
+DEPENDENCY_VALUE_OPTIONS = frozenset(('-MF', '-MT', '-MQ'))
+
+
+class Invocation:
+    """
+    A compiler invocation that compiles a single source file into an object file.
+
+    :ivar outputs: paths of the files it writes, the object file first
+    :ivar hashed_args: the arguments to hash, ie. all of them except for the output file, unless
+        it's the target named in the dependency file
+    :ivar preprocessor_args: the arguments to preprocess the source file with
+    :ivar source: path of the source file
+    :ivar dependency_args: the options that make it write a dependency file, with their values
+    """
+
+    def __init__(self, outputs: list, hashed_args: list, preprocessor_args: list, source: str,
+                 dependency_args: list):
+        self.outputs = outputs
+        self.hashed_args = hashed_args
+        self.preprocessor_args = preprocessor_args
+        self.source = source
+        self.dependency_args = dependency_args
+
+
+def parse_invocation(args: list):
+    """
+    :return: an Invocation, or None if args is not a cacheable compiler invocation
+    """
+    compile_only = False
+    source = None
+    output = None
+    dependency_file = None
+    writes_dependencies = False
+    names_target = False
+    hashed_args = [args[0]]
+    preprocessor_args = [args[0]]
+    dependency_args = []
+    arguments = iter(args[1:])
+    for arg in arguments:
+        if arg == '-c':
+            compile_only = True
+            continue
+        if arg == '-o' or (arg.startswith('-o') and arg not in VALUE_OPTIONS):
+            if output is not None:
+                return None
+            output = next(arguments, None) if arg == '-o' else arg[2:]
+            if not output:
+                return None
+            continue
+        if arg in DEPENDENCY_OPTIONS:
+            writes_dependencies = writes_dependencies or arg != '-MP'
+            hashed_args.append(arg)
+            dependency_args.append(arg)
+            continue
+        if arg in DEPENDENCY_VALUE_OPTIONS or arg[:3] in DEPENDENCY_VALUE_OPTIONS:
+            value = next(arguments, None) if arg in DEPENDENCY_VALUE_OPTIONS else arg[3:]
+            if value is None:
+                return None
+            if arg[:3] == '-MF':
+                dependency_file = value
+            else:
+                names_target = True
+            hashed_args.extend((arg, value) if arg in DEPENDENCY_VALUE_OPTIONS else (arg,))
+            dependency_args.extend((arg, value) if arg in DEPENDENCY_VALUE_OPTIONS else (arg,))
+            continue
+        if arg.startswith(UNCACHEABLE_PREFIXES) or arg == '-':
+            return None
+        hashed_args.append(arg)
+        preprocessor_args.append(arg)
+        if arg in VALUE_OPTIONS:
+            value = next(arguments, None)
+            if value is None:
+                return None
+            hashed_args.append(value)
+            preprocessor_args.append(value)
+        elif not arg.startswith('-'):
+            if source is not None or os.path.splitext(arg)[1] not in SOURCE_EXTENSIONS:
+                return None
+            source = arg
+
+    if not compile_only or source is None:
+        return None
+    if output is None:
+        output = os.path.splitext(os.path.basename(source))[0] + '.o'
+    outputs = [output]
+    if writes_dependencies:
+        if dependency_file is None:
+            dependency_file = os.path.splitext(output)[0] + '.d'
+        outputs.append(dependency_file)
+        if not names_target:
+            # the dependency file names the object file as it's target
+            hashed_args.extend(('-o', output))
+    preprocessor_args.append('-E')
+    return Invocation(outputs, hashed_args, preprocessor_args, source, dependency_args)
+
+
+def hash_preprocessed(hasher, location: str, args: list) -> bool:
+    """
+    Preprocess the source file and feed the result to hasher.
+
+    :return: whether preprocessing has succeeded
+    """
+    read_fd, write_fd = os.pipe()
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            child = Child(location, args, stdout=write_fd, stderr=devnull.fileno())
+        os.close(write_fd)
+        write_fd = None
+        while True:
+            data = os.read(read_fd, 1024 * 1024)
+            if not data:
+                break
+            hasher.update(data)
+    finally:
+        os.close(read_fd)
+        if write_fd is not None:
+            os.close(write_fd)
+    status, _, _ = child.wait()
+    return os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def compute_key(cfg: Configuration, location: str, invocation: Invocation):
+    """
+    :return: the key of the invocation in the store, or None if the source file could not
+        be preprocessed
+    """
+    hasher = hashlib.sha256()
+
+    def add(data: bytes) -> None:
+        hasher.update(b'%d:' % (len(data),))
+        hasher.update(data)
+
+    add(b'interceptor-cache-%d' % (CACHE_VERSION,))
+    add(repr(cfg.to_json()).encode('utf-8'))
+    binary = os.stat(location)
+    add(b'%d %d %d %d' % (binary.st_dev, binary.st_ino, binary.st_size, binary.st_mtime_ns))
+    add(os.fsencode(os.getcwd()))
+    add(b'%d' % (len(invocation.hashed_args),))
+    for arg in invocation.hashed_args:
+        add(os.fsencode(arg))
+    for name in RELEVANT_ENVIRONMENT:
+        value = os.environ.get(name)
+        add(b'-' if value is None else b'=' + os.fsencode(value))
+    if not hash_preprocessed(hasher, location, invocation.preprocessor_args):
+        return None
+    return hasher.hexdigest()
+
+
+def entry_path(key: str) -> str:
+    return os.path.join(Configuration.cache_path(), key[:2], key[2:])
+
+
+def update_statistics(set_size: int = None, **deltas) -> dict:
+    """
+    Add deltas to the statistics of the store, under a lock.
+
+    :param set_size: the size of the store, if it's known exactly
+    :return: the updated statistics
+    """
+    import fcntl
+    path = os.path.join(Configuration.cache_path(), 'stats')
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o666)
+    except FileNotFoundError:
+        os.makedirs(Configuration.cache_path(), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        statistics = parse_statistics(os.read(fd, 4096))
+        for name, delta in deltas.items():
+            statistics[name] += delta
+        if set_size is not None:
+            statistics['size'] = set_size
+        data = (' '.join(str(statistics[name]) for name in STATISTICS) + '\n').encode('ascii')
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, data)
+        os.ftruncate(fd, len(data))
+    finally:
+        os.close(fd)
+    return statistics
+
+
+def count(**deltas) -> None:
+    """Add deltas to the statistics of the store, if they can be written at all"""
+    try:
+        update_statistics(**deltas)
+    except OSError:
+        pass
+
+
+def parse_statistics(data: bytes) -> dict:
+    values = data.split()
+    if len(values) > len(STATISTICS) or not all(value.isdigit() for value in values):
+        values = []
+    # statistics added later are missing from older files
+    values += [0] * (len(STATISTICS) - len(values))
+    return dict(zip(STATISTICS, map(int, values)))
+
+
+def read_statistics() -> dict:
+    try:
+        with open(os.path.join(Configuration.cache_path(), 'stats'), 'rb') as f_in:
+            return parse_statistics(f_in.read())
+    except FileNotFoundError:
+        return parse_statistics(b'')
+
+
+def write_atomically(path: str, data: bytes) -> None:
+    tmp_path = '%s.interceptor-%s' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f_out:
+            f_out.write(data)
+        os.rename(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_all(fd: int, data: bytes) -> None:
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def restore(key: str, invocation: Invocation) -> bool:
+    """
+    Restore the outputs of invocation from the store, along with what it printed.
+
+    :return: whether it was found in the store
+    """
+    path = entry_path(key)
+    try:
+        with open(path, 'rb') as f_in:
+            version, stdout, stderr, outputs = marshal.load(f_in)
+        if version != CACHE_VERSION or len(outputs) != len(invocation.outputs):
+            return False
+        for output_path, data in zip(invocation.outputs, outputs):
+            write_atomically(output_path, data)
+        os.utime(path)
+    except (OSError, EOFError, ValueError, TypeError):
+        return False
+    write_all(1, stdout)
+    write_all(2, stderr)
+    return True
+
+
+def store(cfg: Configuration, key: str, invocation: Invocation, stdout: bytes,
+          stderr: bytes) -> None:
+    """Put the outputs of a successful invocation into the store, and evict if it's too big"""
+    outputs = []
+    for output_path in invocation.outputs:
+        with open(output_path, 'rb') as f_in:
+            outputs.append(f_in.read())
+    data = marshal.dumps((CACHE_VERSION, stdout, stderr, outputs))
+    path = entry_path(key)
+    try:
+        write_atomically(path, data)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomically(path, data)
+    statistics = update_statistics(stores=1, size=len(data))
+    if statistics['size'] > cfg.cache_max_size:
+        evict(cfg.cache_max_size)
+
+
+def evict(max_size: int) -> None:
+    """
+    Remove the least recently used entries, until the store takes up 90% of max_size.
+
+    Only one wrapper evicts at a time, the others carry on.
+    """
+    import fcntl
+    lock_fd = os.open(os.path.join(Configuration.cache_path(), 'evict.lock'),
+                      os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o666)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+        entries = []
+        for shard in os.scandir(Configuration.cache_path()):
+            if not shard.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        entries.sort()
+        size = sum(entry_size for _, entry_size, _ in entries)
+        evicted = 0
+        for _, entry_size, path in entries:
+            if size <= max_size * 0.9:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            evicted += 1
+        update_statistics(set_size=size, evictions=evicted)
+    finally:
+        os.close(lock_fd)
+
+
+def read_captured(fd: int) -> bytes:
+    os.lseek(fd, 0, os.SEEK_SET)
+    chunks = []
+    while True:
+        data = os.read(fd, 1024 * 1024)
+        if not data:
+            return b''.join(chunks)
+        chunks.append(data)
+
+
+def capture_file() -> int:
+    """Return the descriptor of a new anonymous file, to capture the output of the tool in"""
+    path = os.path.join(Configuration.cache_path(), 'capture-%s' % (os.getpid(),))
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600)
+    except FileNotFoundError:
+        os.makedirs(Configuration.cache_path(), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600)
+    try:
+        os.unlink(path)
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
+
+
+def capture_outputs() -> tuple:
+    """
+    :return: a tuple of descriptors of anonymous files, to capture stdout and stderr in
+    :raises OSError: the files could not be created
+    """
+    stdout_fd = capture_file()
+    try:
+        return stdout_fd, capture_file()
+    except OSError:
+        os.close(stdout_fd)
+        raise
+
+
+def run_cached(cfg: Configuration, location: str, args: list) -> None:
+    """
+    Restore the outputs of args from the store, or run the tool and store them.
+
+    Returns only if args cannot be cached, or the cache cannot be used, otherwise exits the
+    same way the tool did.
+    """
+    invocation = parse_invocation(args)
+    key = None
+    if invocation is not None:
+        try:
+            key = compute_key(cfg, location, invocation)
+        except OSError:
+            pass
+    if key is None:
+        count(uncacheable=1)
+        return
+
+    trace_path = os.environ.get('INTERCEPTOR_TRACE')
+    started_at = time.time()
+    if restore(key, invocation):
+        count(hits=1)
+        if trace_path:
+            from interceptor.trace import record_trace
+            try:
+                record_trace(trace_path, cfg.app_name, started_at, time.time(), 0, 0, args)
+            except OSError:
+                pass
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+    try:
+        stdout_fd, stderr_fd = capture_outputs()
+    except OSError:
+        # the tool is ran uncached
+        return
+    count(misses=1)
+
+    child = Child(location, args, stdout=stdout_fd, stderr=stderr_fd)
+    status, wall_time, rusage = child.wait()
+    stdout, stderr = read_captured(stdout_fd), read_captured(stderr_fd)
+    write_all(1, stdout)
+    write_all(2, stderr)
+    if cfg.measure:
+        from interceptor.metrics import record_metrics
+        try:
+            record_metrics(cfg.app_name, child.started_at, wall_time, rusage, status, args)
+        except OSError as e:
+            print('interceptor(%s): cannot record metrics: %s' % (cfg.app_name, e))
+    if trace_path:
+        from interceptor.trace import record_trace
+        try:
+            record_trace(trace_path, cfg.app_name, child.started_at,
+                         child.started_at + wall_time, child.pid, status, args)
+        except OSError:
+            pass
+    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+        try:
+            store(cfg, key, invocation, stdout, stderr)
+        except OSError as e:
+            sys.stderr.write('interceptor(%s): cannot store the result: %s\n' % (
+                cfg.app_name, e))
+    exit_like(status)
+
+
+def print_cache_stats() -> None:
+    statistics = read_statistics()
+    lookups = statistics['hits'] + statistics['misses']
+    print('Cache: %s' % (Configuration.cache_path(),))
+    print('Hits: %s (%.1f%%)' % (statistics['hits'],
+                                 100 * statistics['hits'] / lookups if lookups else 0))
+    print('Misses: %s' % (statistics['misses'],))
+    print('Uncacheable calls: %s' % (statistics['uncacheable'],))
+    print('Results stored: %s, evicted: %s' % (statistics['stores'], statistics['evictions']))
+    print('Size: %.1f MiB' % (statistics['size'] / 1024 / 1024,))
+    probes = statistics['probe_hits'] + statistics['probe_misses']
+    print('Probes answered from the cache: %s of %s (%.1f%%)' % (
+        statistics['probe_hits'], probes, 100 * statistics['probe_hits'] / probes if probes else 0))
+
+
+def clear_cache() -> None:
+    import shutil
+    if os.path.isdir(Configuration.cache_path()):
+        for entry in os.scandir(Configuration.cache_path()):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+        update_statistics(set_size=0)
+    print('Cache cleared')
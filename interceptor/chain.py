@@ -0,0 +1,177 @@
+#
+# Interception chains: when a whole toolchain is intercepted, a run of one wrapper can lead to
+# runs of others, eg. c++ calling g++, or gcc calling an intercepted as and ld. Every wrapper
+# marks the environment of the tool it runs with INTERCEPTOR_CHAIN, which holds the depth of
+# the chain and, for the last MAX_ENTRIES wrappers in it, the tool's name and a digest of the
+# arguments the wrapper passed on:
+#
+# INTERCEPTOR_CHAIN=2|c++:1c291ca3/g++:09a3b7f2
+#
+# A wrapper whose configuration is the same file (eg. linked with intercept link) as the one
+# of a wrapper up the chain, and that is given the very arguments that wrapper passed on, has
+# nothing left to do: it's rules have been applied, it's resource controls are inherited and
+# it's run is measured, cached or holds a slot as a part of that wrapper's run. It execs the
+# tool straight away, without loading the configuration.
+#
+# Wrappers ran nested count their runs by depth in /var/run/interceptor/chains/foo, that
+# intercept status foo displays. Each run appends it's depth as a digit, preceded by p if it
+# passed straight through, with a single write to a file opened with O_APPEND, so that wrappers
+# ran in parallel neither interleave nor wait for each other. Once the file grows past
+# MAX_STATISTICS_SIZE, the wrapper that notices replaces it with a line of the counts that it
+# holds, which the runs go on appending to. Runs appended to the old file while it's being
+# replaced are not counted.
+#
+# This is imported by every wrapper, so only cheap parts of the standard library may be
+# imported at module level here.
+#
+import os
+import zlib
+
+from interceptor.config import Configuration
+
+CHAIN_ENVIRONMENT = 'INTERCEPTOR_CHAIN'
+MAX_ENTRIES = 8
+# runs at this depth or deeper are counted together
+MAX_DEPTH = 6
+# size after which the statistics of a tool are compacted into a line of counts
+MAX_STATISTICS_SIZE = 64 * 1024
+
+
+def args_digest(args: list) -> str:
+    """:return: a digest of args[1:]"""
+    return '%08x' % (zlib.crc32('\0'.join(args[1:]).encode('utf-8', 'surrogateescape')),)
+
+
+def parse_chain(value: str) -> tuple:
+    """
+    :return: a tuple of (depth, list of (tool name, digest of it's arguments)), or (0, []) if
+        value is not a valid chain
+    """
+    depth, _, entries = value.partition('|')
+    try:
+        depth = int(depth)
+    except ValueError:
+        return 0, []
+    chain = []
+    for entry in entries.split('/'):
+        name, sep, digest = entry.rpartition(':')
+        if sep:
+            chain.append((name, digest))
+    return depth, chain
+
+
+def config_path(tool_name: str) -> str:
+    return os.path.realpath(os.path.join(Configuration.interceptor_path(), tool_name))
+
+
+def already_applied(tool_name: str, chain: list, args: list) -> bool:
+    """Whether a wrapper up the chain has applied tool_name's configuration to args"""
+    digest = args_digest(args)
+    path = None
+    for name, entry_digest in chain:
+        if entry_digest != digest:
+            continue
+        if name == tool_name:
+            return True
+        if path is None:
+            path = config_path(tool_name)
+        if config_path(name) == path:
+            return True
+    return False
+
+
+def pass_through(tool_name: str, location: str, args: list) -> None:
+    """
+    Exec the tool with args as they are, if a wrapper up the chain has done all that this one
+    would do, otherwise return.
+    """
+    depth, chain = parse_chain(os.environ.get(CHAIN_ENVIRONMENT, ''))
+    if not depth or not already_applied(tool_name, chain, args):
+        return
+    os.environ[CHAIN_ENVIRONMENT] = '%d|%s' % (depth + 1, '/'.join(
+        '%s:%s' % entry for entry in chain))
+    record_run(tool_name, depth + 1, passed_through=True)
+    os.execv(location, args)
+
+
+def mark_chain(tool_name: str, args: list) -> None:
+    """
+    Add this wrapper to the chain in the environment the tool will inherit.
+
+    :param args: the arguments the tool will be ran with
+    """
+    depth, chain = parse_chain(os.environ.get(CHAIN_ENVIRONMENT, ''))
+    chain = chain[-(MAX_ENTRIES - 1):] + [(tool_name, args_digest(args))]
+    os.environ[CHAIN_ENVIRONMENT] = '%d|%s' % (depth + 1, '/'.join(
+        '%s:%s' % entry for entry in chain))
+    if depth:
+        record_run(tool_name, depth + 1, passed_through=False)
+
+
+def statistics_path(tool_name: str) -> str:
+    return os.path.join(Configuration.run_path(), 'chains', tool_name)
+
+
+def parse_statistics(data: bytes) -> list:
+    """
+    :return: a list of the number of runs that passed straight through, followed by the
+        numbers of runs at each depth from 2 to MAX_DEPTH
+    """
+    counts = [0] * MAX_DEPTH
+    if b'\n' in data:
+        line, data = data.split(b'\n', 1)
+        values = line.split()
+        if len(values) == MAX_DEPTH and all(value.isdigit() for value in values):
+            counts = [int(value) for value in values]
+    runs = [data.count(b'p')] + [data.count(b'%d' % (depth,))
+                                 for depth in range(2, MAX_DEPTH + 1)]
+    return [count + run for count, run in zip(counts, runs)]
+
+
+def compact_statistics(path: str) -> None:
+    """Replace the statistics at path with a line of the counts they hold"""
+    with open(path, 'rb') as f_in:
+        statistics = parse_statistics(f_in.read())
+    tmp_path = '%s.%s' % (path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o666)
+    try:
+        os.write(fd, b' '.join(b'%d' % (count,) for count in statistics) + b'\n')
+    finally:
+        os.close(fd)
+    os.rename(tmp_path, path)
+
+
+def record_run(tool_name: str, depth: int, passed_through: bool) -> None:
+    """Count a nested run at depth"""
+    path = statistics_path(tool_name)
+    data = b'%s%d' % (b'p' if passed_through else b'', min(depth, MAX_DEPTH))
+    try:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o666)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o666)
+        try:
+            os.write(fd, data)
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if size >= MAX_STATISTICS_SIZE:
+            compact_statistics(path)
+    except OSError:
+        pass
+
+
+def print_chain_statistics(tool_name: str) -> None:
+    try:
+        with open(statistics_path(tool_name), 'rb') as f_in:
+            statistics = parse_statistics(f_in.read())
+    except FileNotFoundError:
+        return
+    nested = sum(statistics[1:])
+    if not nested:
+        return
+    depths = ', '.join('%s at depth %s%s' % (count, depth, '+' if depth == MAX_DEPTH else '')
+                       for depth, count in enumerate(statistics[1:], 2) if count)
+    print('Ran by other wrappers %s times (%s), %s of them passed straight through' % (
+        nested, depths, statistics[0]))
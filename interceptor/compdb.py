@@ -0,0 +1,251 @@
+"""
+intercept rewrite-compdb - apply a tool's rules to a compilation database, such as
+compile_commands.json, so that the tools reading it see the arguments that really run.
+
+The database is never loaded as a whole. It's read in chunks, split into the text of it's
+entries by a regular expression that skips over strings, and the entries are sent in batches
+to a process pool, that parses them, rewrites their "arguments" or "command" and encodes them
+again. The batches are written out in order as they come back, with at most a few of them per
+worker held in memory at once.
+"""
+import argparse
+import json
+import os
+import re
+import shlex
+import sys
+import time
+import typing as tp
+from concurrent.futures import ProcessPoolExecutor
+
+from interceptor.config import Configuration, load_config_for
+
+CHUNK_SIZE = 1024 * 1024
+BATCH_SIZE = 2000
+# batches given to each worker at once, so that neither the workers nor the writer wait
+BATCHES_PER_WORKER = 2
+
+# a string, or a brace that's not in one. A string cut off by the end of the buffer is matched
+# up to it, so that the braces in it are not taken for the ones of the entry
+TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*(?:"|\\?\Z)|[{}]', re.DOTALL)
+
+_configuration = None  # type: tp.Optional[Configuration]
+_all_entries = False
+
+
+def split_entries(f_in: tp.TextIO) -> tp.Iterator[str]:
+    """
+    Yield the text of each object in the JSON array read from f_in.
+
+    :raises ValueError: the input is not an array of objects
+    """
+    buffer = ''
+    position = 0
+    started = False
+    eof = False
+    while True:
+        if not eof and len(buffer) - position < CHUNK_SIZE:
+            chunk = f_in.read(CHUNK_SIZE)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ValueError('unexpected end of input')
+            continue
+        if not started:
+            if buffer[position] != '[':
+                raise ValueError('a compilation database has to be a JSON array')
+            started = True
+            position += 1
+            continue
+        if buffer[position] == ']':
+            return
+        if buffer[position] != '{':
+            raise ValueError('unexpected %r at an entry' % (buffer[position],))
+
+        depth = 0
+        end = None
+        for match in TOKEN.finditer(buffer, position):
+            token = match.group()
+            if token == '{':
+                depth += 1
+            elif token == '}':
+                depth -= 1
+                if not depth:
+                    end = match.end()
+                    break
+        if end is None:
+            if eof:
+                raise ValueError('unexpected end of input')
+            # the entry goes on in the next chunk
+            chunk = f_in.read(CHUNK_SIZE)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield buffer[position:end]
+        position = end
+
+
+def split_command(command: str) -> tp.List[str]:
+    """Split command the way a POSIX shell would"""
+    if '"' in command or "'" in command or '\\' in command:
+        return shlex.split(command)
+    # the same as shlex.split does, many times faster
+    return command.split()
+
+
+def matches(cfg: Configuration, args: tp.List[str]) -> bool:
+    """Whether args runs the tool that cfg belongs to"""
+    return bool(args) and os.path.basename(args[0]) == cfg.app_name
+
+
+def rewrite_entry(cfg: Configuration, entry: dict, all_entries: bool = False) -> bool:
+    """
+    Apply cfg's rules to the arguments of entry, in place.
+
+    :param all_entries: whether to rewrite the entry even if it runs some other tool
+    :return: whether the arguments were changed
+    """
+    if 'arguments' in entry:
+        args = entry['arguments']
+    elif 'command' in entry:
+        args = split_command(entry['command'])
+    else:
+        return False
+    if not all_entries and not matches(cfg, args):
+        return False
+
+    if cfg.drop_missing_directories and 'directory' in entry:
+        # relative directories are relative to the entry's directory
+        try:
+            os.chdir(entry['directory'])
+        except OSError:
+            pass
+    new_args = cfg.rewrite(args)
+    if new_args == args:
+        return False
+    if 'arguments' in entry:
+        entry['arguments'] = new_args
+    else:
+        entry['command'] = shlex.join(new_args)
+    return True
+
+
+def initialize_worker(dct: dict, app_name: str, all_entries: bool) -> None:
+    global _configuration, _all_entries
+    _configuration = Configuration.from_json(dct, app_name=app_name)
+    _all_entries = all_entries
+
+
+def rewrite_batch(entries: tp.List[str]) -> tp.Tuple[str, int]:
+    """
+    Rewrite a batch of entries in a worker.
+
+    :return: a tuple of (the entries as JSON, separated by commas, number of entries changed)
+    """
+    changed = 0
+    result = []
+    for text in entries:
+        entry = json.loads(text)
+        if rewrite_entry(_configuration, entry, _all_entries):
+            changed += 1
+            text = json.dumps(entry)
+        result.append(text)
+    return ',\n'.join(result), changed
+
+
+def batches(entries: tp.Iterator[str], size: int) -> tp.Iterator[tp.List[str]]:
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def rewrite_compdb(cfg: Configuration, input_path: str, output_path: str,
+                   jobs: tp.Optional[int] = None, all_entries: bool = False) -> tp.Tuple[int, int]:
+    """
+    Apply cfg's rules to every entry of the compilation database at input_path, writing the
+    result to output_path. output_path is replaced only once it's written completely, so it
+    may be the same as input_path.
+
+    :param jobs: number of processes to rewrite with, the number of CPUs by default
+    :param all_entries: whether to rewrite entries that run some other tool as well
+    :return: a tuple of (number of entries, number of entries changed)
+    :raises ValueError: the input is not a valid compilation database
+    """
+    jobs = jobs or os.cpu_count() or 1
+    total = changed = 0
+    tmp_path = '%s.interceptor-%s' % (output_path, os.getpid())
+    try:
+        with open(input_path, 'r', encoding='utf-8') as f_in, \
+                open(tmp_path, 'w', encoding='utf-8') as f_out, \
+                ProcessPoolExecutor(jobs, initializer=initialize_worker,
+                                    initargs=(cfg.to_json(), cfg.app_name,
+                                              all_entries)) as executor:
+            f_out.write('[\n')
+            pending = []
+            first = True
+
+            def write_oldest() -> None:
+                nonlocal first, changed
+                text, batch_changed = pending.pop(0).result()
+                if not first:
+                    f_out.write(',\n')
+                f_out.write(text)
+                first = False
+                changed += batch_changed
+
+            for batch in batches(split_entries(f_in), BATCH_SIZE):
+                total += len(batch)
+                pending.append(executor.submit(rewrite_batch, batch))
+                if len(pending) >= jobs * BATCHES_PER_WORKER:
+                    write_oldest()
+            while pending:
+                write_oldest()
+            f_out.write('\n]\n')
+        os.rename(tmp_path, output_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return total, changed
+
+
+def rewrite_compdb_main(argv: tp.List[str]) -> None:
+    """Entry point of intercept rewrite-compdb"""
+    parser = argparse.ArgumentParser(
+        prog='intercept rewrite-compdb',
+        description='Apply a tool\'s rules to the entries of a compilation database',
+        usage='intercept rewrite-compdb [options] tool input output')
+    parser.add_argument('tool', help='name of the tool, whose rules will be applied')
+    parser.add_argument('input', help='path to the compilation database, eg. '
+                                      'compile_commands.json')
+    parser.add_argument('output', help='path to write the rewritten database to, may be the '
+                                       'same as input')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='how many processes to rewrite with')
+    parser.add_argument('--all', action='store_true',
+                        help='rewrite the entries that run other tools as well')
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error('--jobs has to be positive')
+
+    cfg = load_config_for(args.tool, None)
+    started_at = time.monotonic()
+    try:
+        total, changed = cfg.rewrite_compdb(args.input, args.output, args.jobs, args.all)
+    except (OSError, ValueError) as e:
+        print('Cannot rewrite %s: %s' % (args.input, e))
+        sys.exit(1)
+    print('Rewrote %s of %s entries in %.2f s' % (changed, total,
+                                                  time.monotonic() - started_at))
@@ -0,0 +1,187 @@
+#
+# What interceptor knows about the command lines of GCC and Clang: which options take a value,
+# which only affect the preprocessor, and telling the input files and the duplicate search
+# paths apart on that basis.
+#
+# This is imported by the wrappers of tools that have "path_deduplication", "cache" or
+# "offload" enabled, so only cheap parts of the standard library may be imported at module
+# level here.
+#
+import os
+
+# options whose value may be the next argument
+VALUE_OPTIONS = frozenset(('-o', '-I', '-D', '-U', '-include', '-imacros', '-isystem',
+                           '-idirafter', '-iprefix', '-iwithprefix', '-iwithprefixbefore',
+                           '-iquote', '-isysroot', '-imultilib', '--sysroot', '-MF', '-MT',
+                           '-MQ', '-x', '-Xlinker', '-Xassembler', '-Xpreprocessor', '-Xclang',
+                           '-mllvm', '-aux-info', '--param', '-L', '-F', '-T', '-u', '-z',
+                           '-arch', '-target', '-G'))
+
+# options that add a directory to a search path, in which the first occurrence of a directory
+# is the one that counts. Longer ones go first, so that they are matched in joined form
+# before the shorter ones they start with.
+SEARCH_PATH_OPTIONS = ('-idirafter', '-isystem', '-iquote', '-I', '-L', '-F')
+
+MACRO_OPTIONS = ('-D', '-U')
+
+# options that only affect the preprocessor, so that compiling preprocessed source can do
+# without them. Those taking a value take it either joined or as the next argument.
+PREPROCESSOR_VALUE_OPTIONS = ('-include', '-imacros', '-idirafter', '-iprefix',
+                              '-iwithprefixbefore', '-iwithprefix', '-isystem', '-iquote',
+                              '-imultilib', '-D', '-U', '-I')
+PREPROCESSOR_FLAGS = frozenset(('-nostdinc', '-nostdinc++', '-undef', '-H', '-C', '-CC'))
+
+# the language of the preprocessed source, by the extension of the source file
+PREPROCESSED_LANGUAGES = {'.c': 'cpp-output', '.i': 'cpp-output', '.cc': 'c++-cpp-output',
+                          '.cp': 'c++-cpp-output', '.cxx': 'c++-cpp-output',
+                          '.cpp': 'c++-cpp-output', '.CPP': 'c++-cpp-output',
+                          '.c++': 'c++-cpp-output', '.C': 'c++-cpp-output',
+                          '.ii': 'c++-cpp-output', '.m': 'objective-c-cpp-output',
+                          '.mm': 'objective-c++-cpp-output', '.M': 'objective-c++-cpp-output'}
+
+
+def operands(args: list) -> list:
+    """
+    :param args: the arguments, without the process name
+    :return: the arguments that are neither options nor their values, ie. the input files
+    """
+    result = []
+    arguments = iter(args)
+    for arg in arguments:
+        if arg in VALUE_OPTIONS:
+            next(arguments, None)
+        elif not arg.startswith('-') or arg == '-':
+            result.append(arg)
+    return result
+
+
+def without_preprocessor_options(args: list) -> list:
+    """
+    :param args: the arguments, without the process name
+    :return: the arguments without the options that only affect the preprocessor
+    """
+    result = []
+    arguments = iter(args)
+    for arg in arguments:
+        if arg in PREPROCESSOR_FLAGS or arg.startswith('-Wp,'):
+            continue
+        if arg in PREPROCESSOR_VALUE_OPTIONS:
+            next(arguments, None)
+            continue
+        if arg.startswith(PREPROCESSOR_VALUE_OPTIONS):
+            continue
+        result.append(arg)
+        if arg in VALUE_OPTIONS:
+            value = next(arguments, None)
+            if value is not None:
+                result.append(value)
+    return result
+
+
+class Deduplication:
+    """
+    Counts of the arguments removed by deduplicate().
+    """
+
+    def __init__(self):
+        self.paths = 0
+        self.macros = 0
+        self.missing = 0
+
+    @property
+    def total(self) -> int:
+        return self.paths + self.macros + self.missing
+
+    def __str__(self) -> str:
+        return 'removed %s duplicate search paths, %s duplicate macros and %s missing ' \
+               'directories' % (self.paths, self.macros, self.missing)
+
+
+def macro_state(option: str, value: str) -> tuple:
+    """
+    :return: a tuple of (name of the macro, what it's defined as after option, or None
+        if it's undefined)
+    """
+    if option == '-U':
+        return value, None
+    name, _, definition = value.partition('=')
+    if '(' in name:
+        name = name[:name.index('(')]
+        definition = value[len(name):]
+    return name, definition or '1'
+
+
+def deduplicate(arguments: list, drop_missing: bool = False, counts: Deduplication = None) -> list:
+    """
+    Remove the arguments that have no effect because of the ones before them:
+
+    * search path options (-I, -isystem, -iquote, -idirafter, -L, -F) naming a directory that
+      the same option has already named, in either joined (-Ifoo) or split (-I foo) form,
+      comparing normalized paths
+    * -D and -U options that leave their macro the way it already is, ie. repeated
+      definitions and undefinitions
+
+    The values of other options that take one are never mistaken for options, and every other
+    argument, including repeated ones such as -Xlinker x, is kept as is.
+
+    :param arguments: the arguments, without the process name
+    :param drop_missing: whether to remove search path options naming directories that don't
+        exist as well. Directories relative to the sysroot (starting with =) are always kept.
+    :param counts: a Deduplication to count the removed arguments in, if given
+    :return: a new list of arguments
+    """
+    if counts is None:
+        counts = Deduplication()
+    result = []
+    seen = {option: set() for option in SEARCH_PATH_OPTIONS}
+    macros = {}
+    exists = {}
+    arguments = iter(arguments)
+    for arg in arguments:
+        option = None
+        if arg[:1] == '-':
+            for candidate in SEARCH_PATH_OPTIONS + MACRO_OPTIONS:
+                if arg.startswith(candidate):
+                    option = candidate
+                    break
+        if option is None:
+            result.append(arg)
+            if arg in VALUE_OPTIONS:
+                value = next(arguments, None)
+                if value is not None:
+                    result.append(value)
+            continue
+
+        if arg == option:
+            value = next(arguments, None)
+            if value is None:
+                result.append(arg)
+                break
+            original = (arg, value)
+        else:
+            value = arg[len(option):]
+            original = (arg,)
+
+        if option in MACRO_OPTIONS:
+            name, state = macro_state(option, value)
+            if name in macros and macros[name] == state:
+                counts.macros += 1
+                continue
+            macros[name] = state
+        elif option == '-I' and value == '-':
+            # -I- splits the search path in two
+            seen['-I'].clear()
+        else:
+            path = os.path.normpath(value)
+            if path in seen[option]:
+                counts.paths += 1
+                continue
+            seen[option].add(path)
+            if drop_missing and path[:1] != '=' and not path.startswith('$SYSROOT'):
+                if path not in exists:
+                    exists[path] = os.path.isdir(path)
+                if not exists[path]:
+                    counts.missing += 1
+                    continue
+        result.extend(original)
+    return result
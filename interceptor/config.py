@@ -1,17 +1,22 @@
-import copy
+#
+# This module is imported by every generated wrapper on every single invocation
+# of an intercepted tool, so it may import only cheap parts of the standard
+# library (no typing, no satella, no pkg_resources). Anything heavier has to be
+# imported lazily, in the code path that actually needs it.
+#
+import marshal
 import os
+import stat
 import sys
-import typing as tp
-import warnings
 
-import pkg_resources
-from satella.coding import for_argument
-from satella.json import read_json_from_file, write_json_to_file
+from interceptor import __version__
+from interceptor.rewrite import Rewriter
 
 
 class Configuration:
     _base_path = None
     _interceptor_path = None
+    _var_path = None
 
     @classmethod
     def project_name(cls) -> str:
@@ -36,19 +41,88 @@ class Configuration:
 
         return cls._interceptor_path
 
+    @classmethod
+    def var_path(cls) -> str:
+        if cls._var_path is None:
+            env_virt_env = os.environ.get("VIRTUAL_ENV")
+            if env_virt_env is None:
+                cls._var_path = '/var'
+            else:
+                cls._var_path = os.path.join(env_virt_env, 'var')
+
+        return cls._var_path
+
+    @classmethod
+    def run_path(cls) -> str:
+        return os.path.join(cls.var_path(), 'run', 'interceptor')
+
+    @classmethod
+    def lib_path(cls) -> str:
+        return os.path.join(cls.var_path(), 'lib', 'interceptor')
+
+    @classmethod
+    def log_path(cls) -> str:
+        return os.path.join(cls.var_path(), 'log', 'interceptor.d')
+
+    @classmethod
+    def cache_path(cls) -> str:
+        return os.path.join(cls.var_path(), 'cache', 'interceptor')
+
+    @classmethod
+    def socket_path(cls) -> str:
+        return os.environ.get('INTERCEPTOR_SOCKET') or os.path.join(cls.run_path(), 'daemon.sock')
+
+    @classmethod
+    def frozen_path(cls) -> str:
+        return os.path.join(cls.interceptor_path(), '.frozen')
+
     @property
     def path(self) -> str:
         return os.path.join(self.interceptor_path(), self.app_name)
 
-    def __init__(self, args_to_disable: tp.Optional[tp.List[str]] = None,
-                 args_to_append: tp.Optional[tp.List[str]] = None,
-                 args_to_prepend: tp.Optional[tp.List[str]] = None,
-                 args_to_replace: tp.Optional[tp.List[tp.Tuple[str, str]]] = None,
+    @property
+    def plan_path(self) -> str:
+        return os.path.join(self.frozen_path(), self.app_name)
+
+    def __init__(self, args_to_disable: list = None,
+                 args_to_append: list = None,
+                 args_to_prepend: list = None,
+                 args_to_replace: list = None,
                  display_before_start: bool = False,
                  notify_about_actions: bool = False,
-                 app_name: tp.Optional[str] = None,
+                 app_name: str = None,
                  deduplication: bool = False,
-                 log: bool = False):
+                 log: bool = False,
+                 frozen: bool = False,
+                 patterns_to_disable: list = None,
+                 patterns_to_replace: list = None,
+                 log_max_size: int = 64 * 1024 * 1024,
+                 log_backups: int = 5,
+                 log_compress: bool = False,
+                 log_sample_rate: float = 1.0,
+                 log_environment: list = None,
+                 measure: bool = False,
+                 response_files: bool = False,
+                 cache: bool = False,
+                 cache_max_size: int = 5 * 1024 * 1024 * 1024,
+                 probe_cache: bool = False,
+                 probe_arguments: list = None,
+                 offload: bool = False,
+                 offload_workers: list = None,
+                 offload_timeout: float = 120.0,
+                 project_overrides: bool = False,
+                 max_concurrent: int = 0,
+                 min_available_memory: int = 0,
+                 cpu_affinity: str = '',
+                 nice: int = 0,
+                 ionice: str = '',
+                 rlimits: dict = None,
+                 env_set: dict = None,
+                 env_unset: list = None,
+                 launcher: list = None,
+                 parallelism: dict = None,
+                 path_deduplication: bool = False,
+                 drop_missing_directories: bool = False):
         self.args_to_disable = args_to_disable or []
         self.args_to_append = args_to_append or []
         self.args_to_prepend = args_to_prepend or []
@@ -58,67 +132,181 @@ class Configuration:
         self.app_name = app_name
         self.deduplication = deduplication
         self.log = log
+        self.frozen = frozen
+        self.patterns_to_disable = patterns_to_disable or []
+        self.patterns_to_replace = patterns_to_replace or []
+        self.log_max_size = log_max_size
+        self.log_backups = log_backups
+        self.log_compress = log_compress
+        self.log_sample_rate = log_sample_rate
+        self.log_environment = log_environment or []
+        self.measure = measure
+        self.response_files = response_files
+        self.cache = cache
+        self.cache_max_size = cache_max_size
+        self.probe_cache = probe_cache
+        self.probe_arguments = probe_arguments or []
+        self.offload = offload
+        self.offload_workers = offload_workers or []
+        self.offload_timeout = offload_timeout
+        self.project_overrides = project_overrides
+        self.max_concurrent = max_concurrent
+        self.min_available_memory = min_available_memory
+        self.cpu_affinity = cpu_affinity
+        self.nice = nice
+        self.ionice = ionice
+        self.rlimits = rlimits or {}
+        self.env_set = env_set or {}
+        self.env_unset = env_unset or []
+        self.launcher = launcher or []
+        self.parallelism = parallelism or {}
+        self.path_deduplication = path_deduplication
+        self.drop_missing_directories = drop_missing_directories
+        self._rewriter = None
 
     def to_json(self):
         return {'args_to_disable': self.args_to_disable,
                 'args_to_append': self.args_to_append,
                 'args_to_prepend': self.args_to_prepend,
                 'args_to_replace': self.args_to_replace,
+                'patterns_to_disable': self.patterns_to_disable,
+                'patterns_to_replace': self.patterns_to_replace,
                 'display_before_start': self.display_before_start,
                 'notify_about_actions': self.notify_about_actions,
                 'deduplication': self.deduplication,
-                'log': self.log}
+                'log': self.log,
+                'log_max_size': self.log_max_size,
+                'log_backups': self.log_backups,
+                'log_compress': self.log_compress,
+                'log_sample_rate': self.log_sample_rate,
+                'log_environment': self.log_environment,
+                'measure': self.measure,
+                'response_files': self.response_files,
+                'cache': self.cache,
+                'cache_max_size': self.cache_max_size,
+                'probe_cache': self.probe_cache,
+                'probe_arguments': self.probe_arguments,
+                'offload': self.offload,
+                'offload_workers': self.offload_workers,
+                'offload_timeout': self.offload_timeout,
+                'project_overrides': self.project_overrides,
+                'max_concurrent': self.max_concurrent,
+                'min_available_memory': self.min_available_memory,
+                'cpu_affinity': self.cpu_affinity,
+                'nice': self.nice,
+                'ionice': self.ionice,
+                'rlimits': self.rlimits,
+                'env_set': self.env_set,
+                'env_unset': self.env_unset,
+                'launcher': self.launcher,
+                'parallelism': self.parallelism,
+                'path_deduplication': self.path_deduplication,
+                'drop_missing_directories': self.drop_missing_directories,
+                'frozen': self.frozen}
 
-    @for_argument(None, copy.copy)
-    def modify(self, args, *extra_args):
+    @property
+    def has_resource_controls(self) -> bool:
+        """Whether the wrapper has to change anything about itself before running the tool"""
+        return bool(self.cpu_affinity or self.nice or self.ionice or self.rlimits
+                    or self.env_set or self.env_unset)
+
+    @property
+    def rewriter(self) -> Rewriter:
+        if self._rewriter is None:
+            self._rewriter = Rewriter(self.args_to_disable, self.args_to_append,
+                                      self.args_to_prepend, self.args_to_replace,
+                                      self.patterns_to_disable, self.patterns_to_replace,
+                                      self.deduplication)
+        return self._rewriter
+
+    def rewrite(self, args, notes: list = None, temporary_files: list = None) -> list:
+        """
+        Apply the argument rules to args, without any side effects.
+
+        :param notes: a list to append descriptions of actions taken to, if given
+        :param temporary_files: if given and response files are enabled, the rules will be
+            applied to the contents of response files too, and paths of the rewritten response
+            files will be appended to this list
+        """
         process, *arguments = args
-        for arg_to_take_away in self.args_to_disable:
-            while arg_to_take_away in arguments:
-                if self.notify_about_actions:
-                    print('interceptor(%s): taking away %s' % (self.app_name, arg_to_take_away))
-                del arguments[arguments.index(arg_to_take_away)]
-
-        for arg_to_replace, arg_to_replace_with in self.args_to_replace:
-            while arg_to_replace in arguments:
-                if self.notify_about_actions:
-                    print('interceptor(%s): replacing %s with %s' % (self.app_name, arg_to_replace,
-                                                                     arg_to_replace_with))
-                arguments[arguments.index(arg_to_replace)] = arg_to_replace_with
-
-        for arg_to_append in self.args_to_append:
-            if arg_to_append not in arguments:
-                if self.notify_about_actions:
-                    print('interceptor(%s): appending %s' % (self.app_name, arg_to_append))
-                arguments.append(arg_to_append)
-
-        for arg_to_prepend in reversed(self.args_to_prepend):
-            if arg_to_prepend not in arguments:
-                if self.notify_about_actions:
-                    print('interceptor(%s): prepending %s' % (self.app_name, arg_to_prepend))
-                arguments = [arg_to_prepend] + arguments
-
-        if self.deduplication:
-            new_arguments = []
-            added_args = {}
-            for arg in arguments:
-                if arg not in added_args:
-                    new_arguments.append(arg)
-                    added_args.add(arg)
-            arguments = new_arguments
+        expand = None
+        if self.response_files and temporary_files is not None:
+            from interceptor.response_files import ResponseFileRewriter
+            expand = ResponseFileRewriter(self.rewriter, notes, temporary_files)
+        arguments = self.rewriter.rewrite(arguments, notes, expand)
+        if self.path_deduplication:
+            from interceptor.compiler_options import Deduplication, deduplicate
+            counts = Deduplication()
+            arguments = deduplicate(arguments, self.drop_missing_directories, counts)
+            if notes is not None and counts.total:
+                notes.append(str(counts))
+        return [process, *arguments]
 
+    def rewrite_compdb(self, input_path: str, output_path: str, jobs: int = None,
+                       all_entries: bool = False) -> tuple:
+        """
+        Apply the argument rules to the entries of a compilation database, such as
+        compile_commands.json, in parallel and without loading it whole.
+
+        :param jobs: number of processes to rewrite with, the number of CPUs by default
+        :param all_entries: whether to rewrite the entries that run other tools as well
+        :return: a tuple of (number of entries, number of entries changed)
+        :raises OSError: the database could not be read or written
+        :raises ValueError: the input is not a valid compilation database
+        """
+        from interceptor.compdb import rewrite_compdb
+        return rewrite_compdb(self, input_path, output_path, jobs, all_entries)
+
+    def modify(self, args, *extra_args, temporary_files: list = None):
+        notes = [] if self.notify_about_actions else None
+        new_args = self.rewrite(args, notes, temporary_files)
+        self.report(args, new_args, notes)
+        return new_args
+
+    def report(self, args, new_args, notes: list = None) -> None:
+        """
+        Carry out the side effects of rewriting args into new_args: notifications,
+        displaying and logging.
+        """
+        for note in notes or ():
+            print('interceptor(%s): %s' % (self.app_name, note))
+
+        arguments = new_args[1:]
         if self.display_before_start:
             print('%s %s' % (sys.argv[0], ' '.join(arguments)))
 
         if self.log:
-            if not os.path.exists('/var/log/interceptor.d'):
-                os.mkdir('/var/log/interceptor.d')
-            with open(os.path.join('/var/log/interceptor.d', sys.argv[0], 'a')) as f_out:
-                f_out.write(' '.join(arguments))
-
-        return [process, *arguments]
+            from interceptor.invocation_log import log_invocation
+            log_invocation(self, args, new_args)
 
     def save(self):
-        write_json_to_file(self.path, self.to_json(), sort_keys=True, indent=4)
+        import json
+        with open(self.path, 'w') as f_out:
+            json.dump(self.to_json(), f_out, sort_keys=True, indent=4)
+        self.freeze()
+
+    def freeze(self) -> None:
+        """
+        Write out the rule plan for this tool if it's frozen, or remove a stale one if it's not.
+
+        The plan is a marshalled copy of this configuration tagged with the modification time
+        of the configuration file it was made from, so that the wrapper can use it without
+        parsing any JSON as long as the configuration is not changed behind our back.
+        """
+        if not self.frozen:
+            try:
+                os.unlink(self.plan_path)
+            except FileNotFoundError:
+                pass
+            return
+
+        os.makedirs(self.frozen_path(), exist_ok=True)
+        plan = marshal.dumps((os.stat(self.path).st_mtime_ns, self.to_json(),
+                              self.rewriter.to_plan()))
+        tmp_path = '%s.%s' % (self.plan_path, os.getpid())
+        with open(tmp_path, 'wb') as f_out:
+            f_out.write(plan)
+        os.rename(tmp_path, self.plan_path)
 
     @classmethod
     def from_json(cls, dct, app_name: str):
@@ -126,12 +314,14 @@ class Configuration:
         if prepend is None:
             prepend = dct.get('args_to_append_before')
             if prepend is not None:
+                import warnings
                 warnings.warn('args_to_append_before is deprecated, use args_to_prepend',
                               DeprecationWarning)
         take_away = dct.get('args_to_disable')
         if take_away is None:
             take_away = dct.get('args_to_take_away')
             if take_away is not None:
+                import warnings
                 warnings.warn('args_to_take_away is deprecated, use args_to_prepend',
                               DeprecationWarning)
 
@@ -143,7 +333,38 @@ class Configuration:
                              dct.get('notify_about_actions', False),
                              app_name=app_name,
                              deduplication=dct.get('deduplication', False),
-                             log=dct.get('log', False))
+                             log=dct.get('log', False),
+                             frozen=dct.get('frozen', False),
+                             patterns_to_disable=dct.get('patterns_to_disable'),
+                             patterns_to_replace=dct.get('patterns_to_replace'),
+                             log_max_size=dct.get('log_max_size', 64 * 1024 * 1024),
+                             log_backups=dct.get('log_backups', 5),
+                             log_compress=dct.get('log_compress', False),
+                             log_sample_rate=dct.get('log_sample_rate', 1.0),
+                             log_environment=dct.get('log_environment', []),
+                             measure=dct.get('measure', False),
+                             response_files=dct.get('response_files', False),
+                             cache=dct.get('cache', False),
+                             cache_max_size=dct.get('cache_max_size', 5 * 1024 * 1024 * 1024),
+                             probe_cache=dct.get('probe_cache', False),
+                             probe_arguments=dct.get('probe_arguments', []),
+                             offload=dct.get('offload', False),
+                             offload_workers=dct.get('offload_workers', []),
+                             offload_timeout=dct.get('offload_timeout', 120.0),
+                             project_overrides=dct.get('project_overrides', False),
+                             max_concurrent=dct.get('max_concurrent', 0),
+                             min_available_memory=dct.get('min_available_memory', 0),
+                             cpu_affinity=dct.get('cpu_affinity', ''),
+                             nice=dct.get('nice', 0),
+                             ionice=dct.get('ionice', ''),
+                             rlimits=dct.get('rlimits', {}),
+                             env_set=dct.get('env_set', {}),
+                             env_unset=dct.get('env_unset', []),
+                             launcher=dct.get('launcher', []),
+                             parallelism=dct.get('parallelism', {}),
+                             path_deduplication=dct.get('path_deduplication', False),
+                             drop_missing_directories=dct.get('drop_missing_directories',
+                                                              False))
 
 
 def assert_correct_version(version: str) -> None:
@@ -151,8 +372,7 @@ def assert_correct_version(version: str) -> None:
         # print('You have used an older version of interceptor to intercept this command.\n'
         #       'It is advised to undo the interception and reintercept the call to upgrade.')
         return
-    my_version = pkg_resources.require(Configuration.project_name())[0].version
-    if int(version.split('.')[0]) > int(my_version.split('.')[0]):
+    if int(version.split('.')[0]) > int(__version__.split('.')[0]):
         sys.stderr.write('You have intercepted this call using a higher version of Interceptor. \n'
                          'This might not work as advertised. Try undo\'ing the interception \n'
                          'and intercepting this again.\n'
@@ -160,14 +380,51 @@ def assert_correct_version(version: str) -> None:
         sys.exit(1)
 
 
-def load_config_for(name: str, version: tp.Optional[str] = '') -> Configuration:
+def read_json_from_file(path: str):
+    import json
+    with open(path, 'r') as f_in:
+        return json.load(f_in)
+
+
+def load_config_for(name: str, version: str = '', project: bool = False) -> Configuration:
+    """
+    :param project: whether to apply the per-project overrides found from the working
+        directory, if the configuration enables them
+    """
     if version is not None:
         assert_correct_version(version)
 
     file_name = os.path.join(Configuration.interceptor_path(), name)
-    if not os.path.isfile(file_name):
+    try:
+        file_stat = os.stat(file_name)
+    except OSError:
+        file_stat = None
+    if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
         print('Configuration for %s does not exist or is not a file' % (name,))
         sys.exit(1)
 
-    cfg = Configuration.from_json(read_json_from_file(file_name), app_name=name)
+    cfg = load_frozen_config_for(name, file_stat.st_mtime_ns)
+    if cfg is None:
+        cfg = Configuration.from_json(read_json_from_file(file_name), app_name=name)
+    if project and cfg.project_overrides:
+        from interceptor.projects import apply_project_overrides
+        cfg = apply_project_overrides(cfg, name, file_stat.st_mtime_ns)
+    return cfg
+
+
+def load_frozen_config_for(name: str, mtime_ns: int):
+    """
+    Return the configuration for name from it's plan, or None if there's no up-to-date plan.
+
+    :param mtime_ns: modification time of the configuration file
+    """
+    try:
+        with open(os.path.join(Configuration.frozen_path(), name), 'rb') as f_in:
+            plan_mtime_ns, dct, rewriter_plan = marshal.load(f_in)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if plan_mtime_ns != mtime_ns:
+        return None
+    cfg = Configuration.from_json(dct, app_name=name)
+    cfg._rewriter = Rewriter.from_plan(rewriter_plan)
     return cfg
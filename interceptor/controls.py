@@ -0,0 +1,166 @@
+#
+# Resource controls: CPU affinity, nice level, I/O priority, resource limits and environment
+# changes that the wrapper applies to itself before it runs the tool, and the launcher (such
+# as ccache) that it runs the tool through. They are inherited over exec, so unlike running
+# the tool through nice, taskset or numactl they cost no extra process.
+#
+# A control that cannot be applied is reported on stderr and skipped, the tool is run anyway.
+#
+# This is imported by the wrappers of tools that have resource controls, so only cheap parts
+# of the standard library may be imported at module level here.
+#
+import os
+import sys
+
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+# numbers of the ioprio_set syscall, which the os module does not provide
+IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'riscv64': 30,
+                       'armv7l': 314, 'ppc64le': 273, 'ppc64': 273, 's390x': 282}
+
+
+def parse_cpu_list(text: str) -> set:
+    """
+    Parse a CPU list in the kernel's format, eg. 0-3,8,10-11.
+
+    :raises ValueError: text is not a CPU list
+    """
+    cpus = set()
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def parse_cpu_affinity(spec: str) -> set:
+    """
+    Return the CPUs that spec stands for.
+
+    spec is either a CPU list, such as 0-7,16-23, or node: followed by a list of NUMA nodes,
+    such as node:0 or node:0-1, which stands for the CPUs of these nodes.
+
+    :raises ValueError: spec is invalid, or names a node that does not exist
+    """
+    if not spec.startswith('node:'):
+        return parse_cpu_list(spec)
+    cpus = set()
+    for node in parse_cpu_list(spec[5:]):
+        path = '/sys/devices/system/node/node%d/cpulist' % (node,)
+        try:
+            with open(path, 'r') as f_in:
+                cpus.update(parse_cpu_list(f_in.read()))
+        except OSError:
+            raise ValueError('NUMA node %d does not exist' % (node,))
+    return cpus
+
+
+def parse_ionice(spec: str) -> int:
+    """
+    Turn spec, a class optionally followed by a colon and a level, such as idle or
+    best-effort:7, into an I/O priority.
+
+    :raises ValueError: spec is invalid
+    """
+    class_name, _, level = spec.partition(':')
+    if class_name not in IOPRIO_CLASSES:
+        raise ValueError('unknown I/O scheduling class %s, expected one of %s' % (
+            class_name, ', '.join(IOPRIO_CLASSES)))
+    level = int(level or (0 if class_name == 'idle' else 4))
+    if not 0 <= level <= 7:
+        raise ValueError('I/O priority level has to be between 0 and 7')
+    return IOPRIO_CLASSES[class_name] << IOPRIO_CLASS_SHIFT | level
+
+
+def set_ionice(spec: str) -> None:
+    """
+    :raises ValueError: spec is invalid
+    :raises OSError: the I/O priority cannot be set
+    """
+    priority = parse_ionice(spec)
+    machine = os.uname().machine
+    if machine not in IOPRIO_SET_SYSCALLS:
+        raise OSError('setting the I/O priority is not supported on %s' % (machine,))
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(IOPRIO_SET_SYSCALLS[machine], IOPRIO_WHO_PROCESS, 0, priority) == -1:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def set_rlimit(name: str, value) -> None:
+    """
+    :param name: name of the limit without the RLIMIT_ prefix, eg. AS or NOFILE
+    :param value: the soft limit, or a list of the soft and the hard limit, where -1 stands
+        for no limit
+    :raises ValueError: the limit is invalid, or cannot be set
+    :raises OSError: the limit cannot be set
+    """
+    import resource
+    try:
+        resource_id = getattr(resource, 'RLIMIT_' + name.upper())
+    except AttributeError:
+        raise ValueError('unknown limit %s' % (name,))
+    if isinstance(value, list):
+        soft, hard = value
+    else:
+        soft, hard = value, resource.getrlimit(resource_id)[1]
+    resource.setrlimit(resource_id, (soft, hard))
+
+
+def apply_resource_controls(cfg) -> None:
+    """Apply cfg's resource controls and environment changes to this process"""
+    for name in cfg.env_unset:
+        os.environ.pop(name, None)
+    for name, value in cfg.env_set.items():
+        os.environ[name] = value
+
+    controls = (('cpu_affinity', lambda: os.sched_setaffinity(
+                    0, parse_cpu_affinity(cfg.cpu_affinity)), cfg.cpu_affinity),
+                ('nice', lambda: os.nice(cfg.nice), cfg.nice),
+                ('ionice', lambda: set_ionice(cfg.ionice), cfg.ionice))
+    for name, apply, value in controls:
+        if not value:
+            continue
+        try:
+            apply()
+        except (OSError, ValueError) as e:
+            sys.stderr.write('interceptor(%s): cannot set %s to %s: %s\n' % (
+                cfg.app_name, name, value, e))
+    for name, value in cfg.rlimits.items():
+        try:
+            set_rlimit(name, value)
+        except (OSError, ValueError, TypeError) as e:
+            sys.stderr.write('interceptor(%s): cannot set the %s limit to %s: %s\n' % (
+                cfg.app_name, name, value, e))
+
+
+def which(name: str):
+    """
+    :return: path of the executable name in PATH, or None if there is none
+    """
+    if '/' in name:
+        return name if os.access(name, os.X_OK) else None
+    for directory in os.environ.get('PATH', '').split(':'):
+        path = os.path.join(directory or '.', name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def apply_launcher(cfg, location: str, args: list) -> tuple:
+    """
+    Have the tool run through cfg's launcher, such as ccache.
+
+    :return: a tuple of (path of the executable to run, it's arguments)
+    """
+    launcher = which(cfg.launcher[0])
+    if launcher is None:
+        sys.stderr.write('interceptor(%s): launcher %s not found, running the tool '
+                         'directly\n' % (cfg.app_name, cfg.launcher[0]))
+        return location, args
+    return launcher, [*cfg.launcher, location, *args[1:]]
@@ -0,0 +1,266 @@
+import collections
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import typing as tp
+
+from interceptor.config import Configuration, read_json_from_file
+from interceptor.inotify import Inotify
+from interceptor.protocol import send_message, receive_message
+
+LATENCY_SAMPLES = 10000
+
+
+class ConfigurationCache:
+    """
+    Parsed configurations of all tools, kept until anything in the interceptor directory
+    changes.
+
+    If inotify is not available, each configuration is revalidated by it's modification time
+    on every access instead.
+
+    :ivar generation: bumped every time the watcher drops the configurations, so that one read
+        before a change is not stored after it
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configurations = {}  # type: tp.Dict[str, tp.Tuple[int, Configuration]]
+        self.generation = 0
+        try:
+            self.inotify = Inotify()
+            self.inotify.add_watch(Configuration.interceptor_path())
+        except OSError as e:
+            print('inotify is not available (%s), will check modification times instead' % (e,))
+            self.inotify = None
+        else:
+            threading.Thread(target=self.watch, daemon=True).start()
+
+    def watch(self) -> None:
+        while True:
+            self.inotify.read()
+            with self.lock:
+                self.generation += 1
+                self.configurations.clear()
+
+    def get(self, name: str) -> Configuration:
+        """
+        :raises OSError: the configuration does not exist
+        :raises ValueError: the configuration is invalid
+        """
+        if '/' in name or name.startswith('.'):
+            raise ValueError('invalid tool name %s' % (name,))
+        path = os.path.join(Configuration.interceptor_path(), name)
+        with self.lock:
+            mtime_ns, cfg = self.configurations.get(name, (None, None))
+            generation = self.generation
+        if self.inotify is None or cfg is None:
+            current_mtime_ns = os.stat(path).st_mtime_ns
+            if cfg is None or mtime_ns != current_mtime_ns:
+                cfg = Configuration.from_json(read_json_from_file(path), app_name=name)
+                cfg.rewriter  # compile the rules in advance
+                with self.lock:
+                    # if it has changed since, this one may be stale, and is only used once
+                    if self.generation == generation:
+                        self.configurations[name] = current_mtime_ns, cfg
+        return cfg
+
+
+class Statistics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.active_clients = 0
+        self.max_active_clients = 0
+        self.total_latency = 0.0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def client_connected(self) -> None:
+        with self.lock:
+            self.active_clients += 1
+            self.max_active_clients = max(self.max_active_clients, self.active_clients)
+
+    def client_disconnected(self) -> None:
+        with self.lock:
+            self.active_clients -= 1
+
+    def request_served(self, latency: float, error: bool) -> None:
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.total_latency += latency
+            self.latencies.append(latency)
+
+    def to_json(self) -> dict:
+        with self.lock:
+            latencies = sorted(self.latencies)
+            return {'uptime': time.time() - self.started_at,
+                    'requests': self.requests,
+                    'errors': self.errors,
+                    'active_clients': self.active_clients,
+                    'max_active_clients': self.max_active_clients,
+                    'mean_latency': self.total_latency / self.requests if self.requests else 0.0,
+                    'p50_latency': percentile(latencies, 0.5),
+                    'p99_latency': percentile(latencies, 0.99),
+                    'max_latency': latencies[-1] if latencies else 0.0}
+
+
+def percentile(sorted_values: tp.Sequence[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    server: 'DaemonServer'
+
+    def handle(self) -> None:
+        self.server.statistics.client_connected()
+        try:
+            while True:
+                try:
+                    request = receive_message(self.request)
+                except (EOFError, OSError, ValueError):
+                    return
+                started_at = time.monotonic()
+                response = self.serve(request)
+                self.server.statistics.request_served(time.monotonic() - started_at,
+                                                      response[0] == 'error')
+                send_message(self.request, response)
+        finally:
+            self.server.statistics.client_disconnected()
+
+    def serve(self, request) -> tuple:
+        try:
+            op_name, *args = check_request(request)
+            if op_name == 'rewrite':
+                tool_name, argv = args
+                cfg = self.server.configurations.get(tool_name)
+                if cfg.response_files and any(arg[:1] == '@' for arg in argv[1:]):
+                    # response files are relative to the wrapper's directory, and have to
+                    # be removed after the tool exits, so the wrapper rewrites them itself
+                    return 'local', 'response files have to be rewritten by the wrapper'
+                if cfg.project_overrides:
+                    # the overrides are found from the wrapper's working directory
+                    return 'local', 'project overrides have to be applied by the wrapper'
+                if cfg.path_deduplication and cfg.drop_missing_directories:
+                    # relative directories are relative to the wrapper's working directory
+                    return 'local', 'missing directories have to be dropped by the wrapper'
+                notes = [] if cfg.notify_about_actions else None
+                new_args = cfg.rewrite(argv, notes)
+                return 'ok', cfg.to_json(), new_args, notes
+            elif op_name == 'stats':
+                return 'ok', self.server.statistics.to_json()
+            return 'error', 'unknown request %s' % (op_name,)
+        except (OSError, ValueError, TypeError) as e:
+            return 'error', str(e)
+
+
+def check_request(request) -> tuple:
+    """
+    :return: request, if it's one of the requests that the daemon serves
+    :raises ValueError: it's not
+    """
+    if not isinstance(request, tuple) or not request or not isinstance(request[0], str):
+        raise ValueError('a request has to be a tuple starting with the name of an operation')
+    if request[0] == 'rewrite':
+        if len(request) != 3 or not isinstance(request[1], str) \
+                or not isinstance(request[2], list) or not request[2] \
+                or not all(isinstance(arg, str) for arg in request[2]):
+            raise ValueError('rewrite takes a tool name and a list of arguments')
+    elif len(request) != 1:
+        raise ValueError('%s takes no arguments' % (request[0],))
+    return request
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, socket_path: str):
+        self.configurations = ConfigurationCache()
+        self.statistics = Statistics()
+        super().__init__(socket_path, RequestHandler)
+
+
+def run_daemon() -> None:
+    socket_path = Configuration.socket_path()
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    if os.path.exists(socket_path):
+        if query_daemon(('stats',)) is not None:
+            print('The daemon is already running at %s' % (socket_path,))
+            sys.exit(1)
+        os.unlink(socket_path)
+
+    server = DaemonServer(socket_path)
+    os.chmod(socket_path, 0o660)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print('Listening on %s' % (socket_path,))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def query_daemon(request: tuple):
+    """Send a request to the daemon and return it's response, or None if it's not running"""
+    try:
+        return send_request(request)
+    except (OSError, EOFError, ValueError):
+        return None
+
+
+def send_request(request: tuple):
+    """
+    :return: the daemon's response to request
+    :raises OSError: the daemon could not be connected to
+    :raises EOFError: the daemon closed the connection without answering
+    :raises ValueError: the response was malformed
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(5)
+        sock.connect(Configuration.socket_path())
+        send_message(sock, request)
+        return receive_message(sock)
+
+
+def describe_daemon() -> str:
+    """
+    :return: whether this user's wrappers can use the daemon, for intercept status, or None if
+        it does not seem to be running
+    """
+    socket_path = Configuration.socket_path()
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        send_request(('stats',))
+    except PermissionError:
+        return 'not reachable by this user, so the wrappers read their configurations ' \
+               'themselves (ask to be added to the group of %s)' % (socket_path,)
+    except (OSError, EOFError, ValueError) as e:
+        return 'not answering (%s), so the wrappers read their configurations themselves' % (e,)
+    return 'rewriting the arguments, at %s' % (socket_path,)
+
+
+def print_daemon_stats() -> None:
+    response = query_daemon(('stats',))
+    if response is None:
+        print('The daemon is not running')
+        sys.exit(1)
+    stats = response[1]
+    print('Uptime: %.0f s' % (stats['uptime'],))
+    print('Requests served: %s (%s errors)' % (stats['requests'], stats['errors']))
+    print('Clients connected: %s (at most %s at once)' % (stats['active_clients'],
+                                                          stats['max_active_clients']))
+    print('Latency: mean %.3f ms, p50 %.3f ms, p99 %.3f ms, max %.3f ms' % (
+        stats['mean_latency'] * 1000, stats['p50_latency'] * 1000,
+        stats['p99_latency'] * 1000, stats['max_latency'] * 1000))
@@ -0,0 +1,109 @@
+#
+# The multi-call dispatcher: with intercept --multicall, intercepted tools are symlinks to a
+# single dispatcher script instead of separate wrappers, and the dispatcher finds out which
+# tool it was ran as from the path it was ran by, looking it up in a registry of intercepted
+# paths. Since all of the logic lives in this module, it's bytecode is cached, and upgrading
+# interceptor upgrades every such wrapper at once.
+#
+# The registry is a marshalled dict of the path of each wrapper to a tuple of (the tool's name,
+# path to the original executable).
+#
+# This is imported by the dispatcher, so only cheap parts of the standard library may be
+# imported at module level here.
+#
+import marshal
+import os
+import sys
+
+from interceptor.config import Configuration
+
+# the same as interceptor.index.INTERCEPTED, which imports re
+INTERCEPTED = '-intercepted'
+
+MAX_SYMLINKS = 40
+
+
+def dispatcher_path() -> str:
+    return os.path.join(Configuration.lib_path(), 'dispatcher')
+
+
+def registry_path() -> str:
+    return os.path.join(Configuration.lib_path(), 'registry')
+
+
+def read_registry() -> dict:
+    try:
+        with open(registry_path(), 'rb') as f_in:
+            return marshal.load(f_in)
+    except FileNotFoundError:
+        return {}
+
+
+def registry_key(path: str) -> str:
+    """Return path with the symlinks in it's directory resolved, which the registry is keyed by"""
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(os.path.realpath(directory), name)
+
+
+def resolve(path: str, registry: dict):
+    """
+    Find out which tool the dispatcher was ran as, from the path it was ran by.
+
+    Symlinks are followed one at a time, so that a tool ran by another name that is a symlink
+    to it (such as cc to gcc) is found as well.
+
+    :return: a tuple of (the tool's name, path to the original executable), or None if path
+        is not a registered wrapper
+    """
+    dispatcher = dispatcher_path()
+    for _ in range(MAX_SYMLINKS):
+        path = registry_key(path)
+        if path in registry:
+            return registry[path]
+        if not os.path.islink(path):
+            return None
+        target = os.path.normpath(os.path.join(os.path.dirname(path), os.readlink(path)))
+        if target == dispatcher:
+            # not registered, but it was made by intercept --multicall
+            if os.path.exists(path + INTERCEPTED):
+                return os.path.basename(path), path + INTERCEPTED
+            return None
+        path = target
+    return None
+
+
+def main() -> None:
+    path = sys.argv[0]
+    found = resolve(path, read_registry())
+    if found is None:
+        sys.stderr.write('interceptor: %s is not an intercepted tool\n' % (path,))
+        sys.exit(127)
+    from interceptor.runtime import run
+    tool_name, location = found
+    run(tool_name, location)
+
+
+def update_registry(path: str, entry=None) -> None:
+    """
+    Register path as a wrapper, or unregister it if entry is None.
+
+    :param entry: a tuple of (the tool's name, path to the original executable)
+    """
+    import fcntl
+    os.makedirs(Configuration.lib_path(), exist_ok=True)
+    lock_fd = os.open(registry_path() + '.lock', os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        registry = read_registry()
+        path = registry_key(path)
+        if entry is None:
+            if registry.pop(path, None) is None:
+                return
+        else:
+            registry[path] = tuple(entry)
+        tmp_path = '%s.%s' % (registry_path(), os.getpid())
+        with open(tmp_path, 'wb') as f_out:
+            marshal.dump(registry, f_out)
+        os.rename(tmp_path, registry_path())
+    finally:
+        os.close(lock_fd)
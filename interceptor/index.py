@@ -0,0 +1,178 @@
+import os
+import re
+import stat
+import sys
+import typing as tp
+
+INTERCEPTED = '-intercepted'
+# Wrappers generated by older versions of interceptor load their configuration by themselves
+INTERCEPTOR_WRAPPER_STRINGS = ('from interceptor.runtime import run',
+                               'from interceptor.config import load_config_for',
+                               'from interceptor.dispatch import main')
+
+# Tools making up a toolchain, and those of them that come in versioned flavours (eg. gcc-12)
+TOOLCHAINS = {
+    'gcc': (('gcc', 'g++', 'cc', 'c++', 'cpp', 'gcc-ar', 'gcc-nm', 'gcc-ranlib', 'ld', 'ld.bfd',
+             'ld.gold', 'ar', 'as', 'nm', 'ranlib', 'strip', 'objcopy', 'objdump'),
+            ('gcc', 'g++', 'cpp', 'gcc-ar', 'gcc-nm', 'gcc-ranlib')),
+    'clang': (('clang', 'clang++', 'clang-cpp', 'cc', 'c++', 'ld.lld', 'lld', 'llvm-ar',
+               'llvm-nm', 'llvm-ranlib', 'llvm-strip', 'llvm-objcopy', 'llvm-objdump'),
+              ('clang', 'clang++', 'clang-cpp', 'ld.lld', 'lld', 'llvm-ar', 'llvm-nm',
+               'llvm-ranlib', 'llvm-strip', 'llvm-objcopy', 'llvm-objdump')),
+}
+
+
+WRAPPER_VERSION = re.compile(r"^VERSION = '([^']*)'", re.MULTILINE)
+
+
+def read_wrapper_header(path: str) -> tp.Tuple[bool, tp.Optional[str]]:
+    """
+    Check whether path is a wrapper generated by interceptor, by reading it's header.
+
+    :return: a tuple of (whether it's a wrapper, version of interceptor that has generated it,
+        or None if it's unknown)
+    """
+    try:
+        with open(path, 'rb') as f_in:
+            header = f_in.read(512).decode('utf-8')
+    except (OSError, UnicodeDecodeError):
+        return False, None
+    if not any(wrapper_string in header for wrapper_string in INTERCEPTOR_WRAPPER_STRINGS):
+        return False, None
+    match = WRAPPER_VERSION.search(header)
+    if match is None and 'interceptor.dispatch' in header:
+        # the multi-call dispatcher always runs the installed version
+        from interceptor import __version__
+        return True, __version__
+    return True, match.group(1) if match else None
+
+
+def is_wrapper_file(path: str) -> bool:
+    """Check whether path is a wrapper generated by interceptor, by reading it's header"""
+    return read_wrapper_header(path)[0]
+
+
+class Executable:
+    """
+    An executable found in PATH.
+
+    :ivar is_wrapper: whether it is a wrapper generated by interceptor
+    :ivar has_original: whether name-intercepted exists beside it
+    :ivar version: version of interceptor that has generated the wrapper, if it's known
+    """
+
+    def __init__(self, name: str, path: str, is_wrapper: bool, has_original: bool,
+                 version: tp.Optional[str] = None):
+        self.name = name
+        self.path = path
+        self.is_wrapper = is_wrapper
+        self.has_original = has_original
+        self.version = version
+
+    def __repr__(self) -> str:
+        return 'Executable(%r, %r, %r, %r, %r)' % (self.name, self.path, self.is_wrapper,
+                                                   self.has_original, self.version)
+
+
+class ExecutableIndex:
+    """
+    The executables of given names found in PATH, along with their interception status,
+    collected in a single walk over PATH.
+
+    Directories that are the same directory (eg. /bin and /usr/bin on merged-/usr systems)
+    are walked only once.
+
+    :param names: names of the executables to look for
+    :param versioned_names: names of the executables whose versioned flavours (such as
+        gcc-12 or g++-12.2) should be picked up as well
+    :param with_intercepted: whether to pick up every foo that has a foo-intercepted beside it
+        as well, and to collect paths of the foo-intercepted files that have no foo beside
+        them into orphans
+    :param workers: number of threads to read the headers of executables with
+    """
+
+    def __init__(self, names: tp.Iterable[str] = (), versioned_names: tp.Iterable[str] = (),
+                 with_intercepted: bool = False, workers: int = 1):
+        self.names = set(names)
+        self.executables = {}  # type: tp.Dict[str, tp.List[Executable]]
+        self.orphans = []  # type: tp.List[str]
+        versioned_names = list(versioned_names)
+        versioned = None
+        if versioned_names:
+            versioned = re.compile(r'(?:%s)-\d+(?:\.\d+)*' % (
+                '|'.join(map(re.escape, versioned_names)),))
+
+        found = []
+        intercepted = []
+        seen_directories = set()
+        for directory in os.environ.get('PATH', '').split(':'):
+            if not directory:
+                continue
+            real_directory = os.path.realpath(directory)
+            if real_directory in seen_directories:
+                continue
+            seen_directories.add(real_directory)
+            try:
+                entries = {entry.name: entry for entry in os.scandir(directory)}
+            except OSError:
+                continue
+            for name, entry in entries.items():
+                if name not in self.names and (versioned is None
+                                               or not versioned.fullmatch(name)) \
+                        and not (with_intercepted and name + INTERCEPTED in entries):
+                    if with_intercepted and name.endswith(INTERCEPTED):
+                        intercepted.append(entry.path)
+                    continue
+                try:
+                    if not stat.S_ISREG(entry.stat().st_mode) or \
+                            not os.access(entry.path, os.X_OK):
+                        continue
+                except OSError:
+                    continue
+                found.append((name, entry.path, name + INTERCEPTED in entries))
+
+        if workers > 1 and len(found) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(workers) as executor:
+                headers = list(executor.map(read_wrapper_header,
+                                            [path for _, path, _ in found]))
+        else:
+            headers = [read_wrapper_header(path) for _, path, _ in found]
+
+        for (name, path, has_original), (is_wrapper, version) in zip(found, headers):
+            self.names.add(name)
+            self.executables.setdefault(name, []).append(
+                Executable(name, path, is_wrapper, has_original, version))
+        found_paths = {path for _, path, _ in found}
+        self.orphans = [path for path in intercepted
+                        if path[:-len(INTERCEPTED)] not in found_paths]
+
+    @classmethod
+    def for_toolchain(cls, toolchain: str) -> 'ExecutableIndex':
+        """
+        :raises KeyError: unknown toolchain
+        """
+        names, versioned_names = TOOLCHAINS[toolchain]
+        return cls(names, versioned_names)
+
+    def found_names(self) -> tp.List[str]:
+        return sorted(self.executables)
+
+    def paths(self, name: str, abort_on_failure: bool = True) -> tp.List[Executable]:
+        """
+        Return the executables of given name, like filter_whereis does.
+
+        If none are found and abort_on_failure is set, the program will be terminated.
+        """
+        executables = self.executables.get(name, [])
+        if not executables and abort_on_failure:
+            print('%s not found, aborting' % (name,))
+            sys.exit(1)
+        return executables
+
+    def is_all_intercepted(self, name: str) -> bool:
+        return all(executable.is_wrapper for executable in self.paths(name))
+
+    def is_partially_intercepted(self, name: str) -> bool:
+        interceptions = [executable.is_wrapper for executable in self.paths(name)]
+        return not all(interceptions) and any(interceptions)
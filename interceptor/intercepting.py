@@ -2,31 +2,34 @@
 # Take care, in importing this module sys.argv gets changed!
 #
 import os
+import re
 import shutil
 import sys
+import typing as tp
 
-import pkg_resources
 from satella.coding import silence_excs
 from satella.files import read_in_file, write_to_file
 
+from interceptor import __version__
 from interceptor.config import load_config_for, Configuration
+from interceptor.dispatch import dispatcher_path, read_registry, registry_key, registry_path, \
+    update_registry
+from interceptor.index import ExecutableIndex, is_wrapper_file, INTERCEPTED, TOOLCHAINS, \
+    INTERCEPTOR_WRAPPER_STRINGS  # noqa: F401
 from interceptor.whereis import filter_whereis
 
-INTERCEPTED = '-intercepted'
-INTERCEPTOR_WRAPPER_STRING = 'from interceptor.config import load_config_for'
-
 FORCE = '--force' in sys.argv
 if FORCE:
     sys.argv.remove('--force')
 
+MULTICALL = '--multicall' in sys.argv
+if MULTICALL:
+    sys.argv.remove('--multicall')
+
 
 def is_intercepted(path_name: str, print_messages=False) -> bool:
-    a = False
-    with silence_excs(UnicodeDecodeError), open(path_name, 'rb') as f_in:
-        intercepted_real = f_in.read(512).decode('utf-8')
-        a = INTERCEPTOR_WRAPPER_STRING in intercepted_real
     file_name = os.path.split(path_name)
-    if a:
+    if is_wrapper_file(path_name):
         b = os.path.exists(path_name + INTERCEPTED)
         if not b and print_messages:
             print('%s is intercepted, but %s-intercepted does not exist' % (file_name, file_name))
@@ -41,20 +44,18 @@ def is_intercepted(path_name: str, print_messages=False) -> bool:
         return False
 
 
-def is_all_intercepted(name: str) -> bool:
-    for path in filter_whereis(name):
-        if not is_intercepted(path):
-            return False
-    return True
+def is_all_intercepted(name: str, index: tp.Optional[ExecutableIndex] = None) -> bool:
+    return (index or ExecutableIndex([name])).is_all_intercepted(name)
 
 
-def assert_intercepted(name: str) -> None:
+def assert_intercepted(name: str, index: tp.Optional[ExecutableIndex] = None) -> None:
     if FORCE:
         print('Skipping a check to see if %s is intercepted due to --force' % (name, ))
         return
-    if is_all_intercepted(name):
+    index = index or ExecutableIndex([name])
+    if index.is_all_intercepted(name):
         return
-    if is_partially_intercepted(name):
+    if index.is_partially_intercepted(name):
         print('''%s is partially intercepted. This means that there exist binaries of %s
 'that have not been intercepted. To fix that, call:
 
@@ -65,30 +66,28 @@ intercept %s --force
     abort()
 
 
-def is_partially_intercepted(name: str, print_messages=False) -> bool:
-    interceptions = []
-    for path in filter_whereis(name):
-        if is_intercepted(path, print_messages=print_messages):
-            if print_messages:
-                print('%s is currently intercepted' % (path,))
-            interceptions.append(True)
-        else:
-            interceptions.append(False)
-    return not all(interceptions) and any(interceptions)
+def is_partially_intercepted(name: str, print_messages=False,
+                             index: tp.Optional[ExecutableIndex] = None) -> bool:
+    index = index or ExecutableIndex([name])
+    if print_messages:
+        for executable in index.paths(name):
+            if is_intercepted(executable.path, print_messages=True):
+                print('%s is currently intercepted' % (executable.path,))
+    return index.is_partially_intercepted(name)
 
 
-def is_completely_unintercepted(name: str) -> bool:
-    return not is_all_intercepted(name) and not is_partially_intercepted(name)
+def is_completely_unintercepted(name: str, index: tp.Optional[ExecutableIndex] = None) -> bool:
+    index = index or ExecutableIndex([name])
+    return not index.is_all_intercepted(name) and not index.is_partially_intercepted(name)
 
 
-def can_be_unintercepted(name: str) -> bool:
-    for path in filter_whereis(name):
-        if not is_intercepted(path):
-            print('%s is not intercepted' % (path,))
+def can_be_unintercepted(name: str, index: tp.Optional[ExecutableIndex] = None) -> bool:
+    for executable in (index or ExecutableIndex([name])).paths(name):
+        if not executable.is_wrapper:
+            print('%s is not intercepted' % (executable.path,))
             return False
-        target_path = path + INTERCEPTED
-        if not os.path.exists(target_path):
-            print('%s does not exist' % (path,))
+        if not executable.has_original:
+            print('%s does not exist' % (executable.path + INTERCEPTED,))
             return False
     return True
 
@@ -101,70 +100,208 @@ def abort():
 def unintercept_path(path_name: str) -> None:
     src_name = path_name + INTERCEPTED
     shutil.move(src_name, path_name)
+    if os.path.exists(registry_path()):
+        update_registry(path_name)
     print('Successfully unintercepted %s' % (path_name,))
 
 
-def intercept_path(tool_name: str, file_name: str) -> None:
-    source_file = pkg_resources.resource_filename(__name__, 'templates/cmdline.py')
+def render_wrapper(tool_name: str, location: str) -> str:
+    """Return the source of a wrapper that runs location as tool_name"""
+    source_file = os.path.join(os.path.dirname(__file__), 'templates', 'cmdline.py')
+    source_content = read_in_file(source_file, 'utf-8')
+    return source_content.format(EXECUTABLE=sys.executable,
+                                 TOOLNAME=tool_name,
+                                 LOCATION=location,
+                                 VERSION=__version__)
+
+
+def write_dispatcher() -> str:
+    """
+    Write out the multi-call dispatcher, if it's not there already.
+
+    :return: it's path
+    """
+    path = dispatcher_path()
+    source_file = os.path.join(os.path.dirname(__file__), 'templates', 'dispatcher.py')
+    content = read_in_file(source_file, 'utf-8').format(EXECUTABLE=sys.executable)
+    if os.path.exists(path) and read_in_file(path, 'utf-8') == content:
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_name = '%s.%s' % (path, os.getpid())
+    write_to_file(tmp_name, content, 'utf-8')
+    os.chmod(tmp_name, 0o755)
+    os.rename(tmp_name, path)
+    return path
+
+
+def install_wrapper(tool_name: str, file_name: str, multicall: bool = False,
+                    mode: int = 0o755) -> None:
+    """
+    Replace file_name with a wrapper for tool_name, in a single rename so that it's never
+    missing.
+
+    :param multicall: whether the wrapper is to be a symlink to the multi-call dispatcher
+        instead of a script of it's own
+    """
+    target_intercepted = file_name + INTERCEPTED
+    tmp_name = '%s.interceptor-%s' % (file_name, os.getpid())
+    try:
+        if multicall:
+            update_registry(file_name, (tool_name, target_intercepted))
+            os.symlink(write_dispatcher(), tmp_name)
+        else:
+            write_to_file(tmp_name, render_wrapper(tool_name, target_intercepted), 'utf-8')
+            os.chmod(tmp_name, mode)
+        os.rename(tmp_name, file_name)
+    except OSError:
+        with silence_excs(OSError):
+            os.unlink(tmp_name)
+        raise
+
+
+def intercept_path(tool_name: str, file_name: str, multicall: bool = MULTICALL) -> None:
     target_intercepted = file_name + INTERCEPTED
     previous_chmod = os.stat(file_name).st_mode & 0o777
     shutil.copy(file_name, target_intercepted)
-    os.unlink(file_name)
-    source_content = read_in_file(source_file, 'utf-8')
-    project_name = Configuration.project_name()
-    source_content = source_content.format(EXECUTABLE=sys.executable,
-                                           TOOLNAME=tool_name,
-                                           LOCATION=target_intercepted,
-                                           VERSION=pkg_resources.require(
-                                               project_name)[0].version)
-    write_to_file(file_name, source_content, 'utf-8')
-    os.chmod(file_name, previous_chmod)
+    try:
+        install_wrapper(tool_name, file_name, multicall, previous_chmod)
+    except OSError:
+        os.unlink(target_intercepted)
+        raise
     print('Successfully intercepted %s' % (file_name,))
 
 
-def intercept_tool(tool_name: str):
-    if is_partially_intercepted(tool_name):
-        if not FORCE:
-            print(
-                '%s is partially intercepted. Use --force if you want to continue.' % (tool_name,))
-            abort()
-
-    if is_all_intercepted(tool_name):
-        print('%s is completely intercepted.' % (tool_name,))
-        abort()
+WRAPPER_TOOLNAME = re.compile(r"^TOOLNAME = '([^']*)'", re.MULTILINE)
 
-    for path in filter_whereis(tool_name):
-        if not is_intercepted(path):
-            intercept_path(tool_name, path)
 
+def wrapper_tool_name(path: str, name: str) -> str:
+    """
+    :param path: path of a wrapper
+    :param name: name of the executable, returned if the wrapper does not tell the tool's name
+    :return: name of the tool whose configuration the wrapper uses
+    """
+    if os.path.islink(path):
+        return read_registry().get(registry_key(path), (name, None))[0]
+    match = WRAPPER_TOOLNAME.search(read_in_file(path, 'utf-8'))
+    return match.group(1) if match else name
+
+
+def convert_wrappers(multicall: bool = True) -> None:
+    """
+    Turn every wrapper that is a script of it's own into a symlink to the multi-call
+    dispatcher, or the other way around.
+    """
+    from interceptor.audit import list_configurations
+    index = ExecutableIndex(list_configurations(), with_intercepted=True)
+    converted = 0
+    for name in sorted(index.executables):
+        for executable in index.paths(name):
+            if not executable.is_wrapper or not executable.has_original \
+                    or os.path.islink(executable.path) == multicall:
+                continue
+            tool_name = wrapper_tool_name(executable.path, name)
+            mode = os.stat(executable.path + INTERCEPTED).st_mode & 0o777
+            install_wrapper(tool_name, executable.path, multicall, mode)
+            if not multicall:
+                update_registry(executable.path)
+            print('Converted %s' % (executable.path,))
+            converted += 1
+    print('Converted %s wrappers' % (converted,))
+
+
+def ensure_config_exists(tool_name: str) -> None:
+    if not os.path.exists(os.path.join(Configuration.interceptor_path(), tool_name)):
+        print('Config for %s not found, creating a fresh one' % (tool_name,))
+        Configuration(app_name=tool_name).save()
+        return
     try:
         load_config_for(tool_name, None)
         print('Config for %s already exists' % (tool_name,))
-    except KeyError:
-        print('Config for %s not found, creating a fresh one' % (tool_name,))
-        Configuration(app_name=tool_name).save()
     except ValueError:
         print('Config for %s exists, but is invalid. Usage of %s will be impossible until '
               'this is fixed' % (tool_name, tool_name))
 
 
+def intercept_tools(tool_names: tp.List[str], index: tp.Optional[ExecutableIndex] = None):
+    """
+    Intercept all given tools at once.
+
+    All of the tools are checked first, and if any of them cannot be intercepted, nothing is.
+    If intercepting any of the executables fails, all the executables intercepted so far are
+    restored.
+
+    :param index: an index of the tools, to spare walking PATH again
+    """
+    index = index or ExecutableIndex(tool_names)
+    to_intercept = []
+    for tool_name in tool_names:
+        index.paths(tool_name)  # abort if it's not there
+        if index.is_partially_intercepted(tool_name):
+            if not FORCE:
+                print('%s is partially intercepted. Use --force if you want to continue.'
+                      % (tool_name,))
+                abort()
+
+        if index.is_all_intercepted(tool_name):
+            print('%s is completely intercepted.' % (tool_name,))
+            if len(tool_names) == 1:
+                abort()
+            continue
+
+        to_intercept.extend((tool_name, executable.path)
+                            for executable in index.paths(tool_name)
+                            if not executable.is_wrapper)
+
+    intercepted = []
+    try:
+        for tool_name, path in to_intercept:
+            intercept_path(tool_name, path)
+            intercepted.append(path)
+        for tool_name in tool_names:
+            ensure_config_exists(tool_name)
+    except (OSError, ValueError) as e:
+        print('Failed to intercept: %s, rolling back' % (e,))
+        for path in reversed(intercepted):
+            unintercept_path(path)
+        abort()
+
+
+def intercept_tool(tool_name: str):
+    intercept_tools([tool_name])
+
+
+def intercept_toolchain(toolchain: str):
+    try:
+        index = ExecutableIndex.for_toolchain(toolchain)
+    except KeyError:
+        print('Unknown toolchain %s, known are: %s' % (toolchain, ', '.join(sorted(TOOLCHAINS))))
+        abort()
+    tool_names = index.found_names()
+    if not tool_names:
+        print('No tools of %s were found' % (toolchain,))
+        abort()
+    intercept_tools(tool_names, index)
+
+
 def unintercept_tool(tool_name: str):
-    if not can_be_unintercepted(tool_name):
+    index = ExecutableIndex([tool_name])
+    if not can_be_unintercepted(tool_name, index):
         if not FORCE:
             print('%s cannot be unintercepted. Use --force to proceed' % (tool_name,))
             abort()
 
-    for path in filter_whereis(tool_name):
-        if is_intercepted(path):
-            unintercept_path(path)
+    for executable in index.paths(tool_name):
+        if executable.is_wrapper:
+            unintercept_path(executable.path)
         else:
-            print('Skipping on %s' % (path,))
+            print('Skipping on %s' % (executable.path,))
     print('Unintercepted %s, leaving the configuration in-place' % (tool_name,))
 
 
 def check(tool_name: str, add_config: bool = False):
-    total_interception = is_all_intercepted(tool_name)
-    partial_interception = is_partially_intercepted(tool_name, True)
+    index = ExecutableIndex([tool_name])
+    total_interception = is_all_intercepted(tool_name, index)
+    partial_interception = is_partially_intercepted(tool_name, True, index)
     if not total_interception and not partial_interception:
         print('%s is not intercepted at all' % (tool_name,))
         sys.exit(0)
@@ -176,6 +313,8 @@ intercept %s --force
 
     cfg_exists = False
     try:
+        if not os.path.exists(os.path.join(Configuration.interceptor_path(), tool_name)):
+            raise KeyError(tool_name)
         cfg = load_config_for(tool_name, None)
         cfg_exists = True
         print('Configuration for %s exists and is valid' % (tool_name,))
@@ -191,11 +330,31 @@ intercept %s --force
             target = os.readlink(cfg.path).split('/')[-1]
             print('%s config is a symlink to %s config' % (tool_name, target))
         cfg.save()
+        if cfg.project_overrides:
+            from interceptor.projects import find_layers
+            untrusted = []
+            layers = find_layers(tool_name, os.getcwd(), untrusted)
+            print('Project overrides applied here: %s' % (
+                ', '.join(path for path, _ in layers) or 'none',))
+            if untrusted:
+                print('Project overrides ignored as untrusted: %s' % (', '.join(untrusted),))
+        if cfg.parallelism:
+            from interceptor.parallelism import describe_parallelism
+            print('Parallelism: %s' % (describe_parallelism(cfg),))
+        from interceptor.slots import print_slots
+        print_slots(cfg)
+        from interceptor.daemon import describe_daemon
+        daemon = describe_daemon()
+        if daemon is not None:
+            print('Daemon: %s' % (daemon,))
+        from interceptor.chain import print_chain_statistics
+        print_chain_statistics(tool_name)
 
 
 def link(app_name, target_name, copy=False):
-    assert_intercepted(app_name)
-    assert_intercepted(target_name)
+    index = ExecutableIndex([app_name, target_name])
+    assert_intercepted(app_name, index)
+    assert_intercepted(target_name, index)
     source = os.path.join(Configuration.interceptor_path(), app_name)
     target = os.path.join(Configuration.interceptor_path(), target_name)
     if os.path.islink(source) and not FORCE and not copy:
@@ -207,6 +366,7 @@ def link(app_name, target_name, copy=False):
         shutil.copy(source, target)
     else:
         os.symlink(source, target)
+    refreeze(target_name)
     if not copy:
         print('Linked %s to read from %s\'s config' % (target_name, app_name))
     else:
@@ -247,17 +407,39 @@ def reset(app_name):
     print('Configuration for %s reset' % (app_name, ))
 
 
+def refreeze(app_name):
+    """
+    Regenerate the rule plans of app_name and of every tool whose config is a symlink to it.
+
+    To be called after app_name's configuration file was changed by other means than
+    Configuration.save().
+    """
+    interceptor_path = Configuration.interceptor_path()
+    config_path = os.path.realpath(os.path.join(interceptor_path, app_name))
+    for name in os.listdir(interceptor_path):
+        path = os.path.join(interceptor_path, name)
+        if name != app_name and not (os.path.islink(path)
+                                     and os.path.realpath(path) == config_path):
+            continue
+        with silence_excs(ValueError):
+            load_config_for(name, None).freeze()
+
+
 def configure(op_name, app_name, target_name):
     assert_intercepted(app_name)
     cfg = load_config_for(app_name, None)
     if op_name == 'append':
-        cfg.arg_names_to_append.append(target_name)
+        cfg.args_to_append.append(target_name)
     elif op_name == 'prepend':
-        cfg.arg_names_to_prepend.append(target_name)
+        cfg.args_to_prepend.append(target_name)
     elif op_name == 'disable':
-        cfg.arg_names_to_disable.append(target_name)
+        cfg.args_to_disable.append(target_name)
     elif op_name == 'replace':
-        cfg.arg_names_to_replace.append([target_name, sys.target_namev[4]])
+        cfg.args_to_replace.append([target_name, sys.argv[4]])
+    elif op_name == 'disable-matching':
+        cfg.patterns_to_disable.append(target_name)
+    elif op_name == 'replace-matching':
+        cfg.patterns_to_replace.append([target_name, sys.argv[4]])
     elif op_name == 'display':
         cfg.display_before_start = True
     elif op_name == 'hide':
@@ -270,5 +452,134 @@ def configure(op_name, app_name, target_name):
         cfg.log = True
     elif op_name == 'unlog':
         cfg.log = False
+    elif op_name == 'measure':
+        cfg.measure = True
+    elif op_name == 'unmeasure':
+        cfg.measure = False
+    elif op_name == 'response-files':
+        cfg.response_files = True
+    elif op_name == 'no-response-files':
+        cfg.response_files = False
+    elif op_name in ('max-concurrent', 'min-memory'):
+        try:
+            value = int(target_name or '')
+        except ValueError:
+            print('%s expects a number, got %s' % (op_name, target_name))
+            abort()
+        if value < 0:
+            print('%s expects a number that is not negative' % (op_name,))
+            abort()
+        if op_name == 'max-concurrent':
+            cfg.max_concurrent = value
+        else:
+            cfg.min_available_memory = value * 1024 * 1024
+    elif op_name == 'nice':
+        try:
+            cfg.nice = int(target_name or '')
+        except ValueError:
+            print('nice expects a number, got %s' % (target_name,))
+            abort()
+    elif op_name in ('affinity', 'ionice'):
+        from interceptor.controls import parse_cpu_affinity, parse_ionice
+        try:
+            if target_name:
+                (parse_cpu_affinity if op_name == 'affinity' else parse_ionice)(target_name)
+        except ValueError as e:
+            print('Invalid %s: %s' % (op_name, e))
+            abort()
+        if op_name == 'affinity':
+            cfg.cpu_affinity = target_name or ''
+        else:
+            cfg.ionice = target_name or ''
+    elif op_name == 'rlimit':
+        import resource
+        if not hasattr(resource, 'RLIMIT_' + (target_name or '').upper()):
+            print('Unknown limit %s' % (target_name,))
+            abort()
+        if len(sys.argv) < 5:
+            cfg.rlimits.pop(target_name.upper(), None)
+        else:
+            try:
+                values = [int(value) for value in sys.argv[4:6]]
+                cfg.rlimits[target_name.upper()] = values if len(values) == 2 else values[0]
+            except ValueError:
+                print('rlimit expects numbers, got %s' % (' '.join(sys.argv[4:6]),))
+                abort()
+    elif op_name == 'setenv':
+        name, sep, value = (target_name or '').partition('=')
+        if not name or not sep:
+            print('setenv expects NAME=VALUE, got %s' % (target_name,))
+            abort()
+        cfg.env_set[name] = value
+        if name in cfg.env_unset:
+            cfg.env_unset.remove(name)
+    elif op_name == 'unsetenv':
+        cfg.env_set.pop(target_name, None)
+        if target_name not in cfg.env_unset:
+            cfg.env_unset.append(target_name)
+    elif op_name == 'launcher':
+        cfg.launcher = sys.argv[3:]
+    elif op_name == 'parallelism':
+        from interceptor.parallelism import POLICY_DEFAULTS, validate_policy
+        policy = dict(POLICY_DEFAULTS)
+        policy.update(cfg.parallelism)
+        for setting in sys.argv[3:]:
+            key, sep, value = setting.partition('=')
+            if not sep or key not in POLICY_DEFAULTS:
+                print('parallelism expects KEY=VALUE with KEY one of %s, got %s' % (
+                    ', '.join(POLICY_DEFAULTS), setting))
+                abort()
+            default = POLICY_DEFAULTS[key]
+            try:
+                if isinstance(default, bool):
+                    if value.lower() not in ('true', 'false', 'yes', 'no', '1', '0'):
+                        raise ValueError('%s expects true or false' % (key,))
+                    policy[key] = value.lower() in ('true', 'yes', '1')
+                elif isinstance(default, str):
+                    policy[key] = value
+                else:
+                    policy[key] = type(default)(value)
+                validate_policy(policy)
+            except ValueError as e:
+                print('Invalid parallelism policy: %s' % (e,))
+                abort()
+        cfg.parallelism = policy
+    elif op_name == 'no-parallelism':
+        cfg.parallelism = {}
+    elif op_name == 'enable-deduplication':
+        cfg.deduplication = True
+    elif op_name == 'disable-deduplication':
+        cfg.deduplication = False
+    elif op_name == 'dedup-paths':
+        cfg.path_deduplication = True
+    elif op_name == 'no-dedup-paths':
+        cfg.path_deduplication = False
+    elif op_name == 'drop-missing-dirs':
+        cfg.drop_missing_directories = True
+    elif op_name == 'keep-missing-dirs':
+        cfg.drop_missing_directories = False
+    elif op_name == 'cache-results':
+        cfg.cache = True
+    elif op_name == 'no-cache-results':
+        cfg.cache = False
+    elif op_name == 'cache-probes':
+        cfg.probe_cache = True
+    elif op_name == 'no-cache-probes':
+        cfg.probe_cache = False
+    elif op_name == 'offload':
+        cfg.offload = True
+    elif op_name == 'no-offload':
+        cfg.offload = False
+    elif op_name == 'project-overrides':
+        cfg.project_overrides = True
+    elif op_name == 'no-project-overrides':
+        cfg.project_overrides = False
+    elif op_name == 'offload-workers':
+        cfg.offload_workers = sys.argv[3:]
+    elif op_name == 'freeze':
+        cfg.frozen = True
+    elif op_name == 'unfreeze':
+        cfg.frozen = False
     cfg.save()
+    refreeze(app_name)
     print('Configuration changed')
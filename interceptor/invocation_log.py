@@ -0,0 +1,132 @@
+#
+# The invocation log, written by the wrappers of tools that have "log" enabled.
+#
+# Each invocation is a single JSON line, written with a single write() to a file opened with
+# O_APPEND, so that lines from wrappers ran in parallel never interleave.
+#
+# This is imported by the wrappers, so only cheap parts of the standard library may be
+# imported at module level here.
+#
+import os
+import time
+
+try:
+    from _json import encode_basestring_ascii
+except ImportError:
+    from json.encoder import encode_basestring_ascii
+
+from interceptor.config import Configuration
+
+
+def encode_list(strings) -> str:
+    return '[%s]' % (','.join(map(encode_basestring_ascii, strings)),)
+
+
+def is_sampled(sample_rate: float) -> bool:
+    if sample_rate >= 1:
+        return True
+    return int.from_bytes(os.urandom(4), 'big') < sample_rate * 2 ** 32
+
+
+def log_invocation(cfg: Configuration, args, new_args) -> None:
+    """
+    Write a record about the invocation of cfg's tool with args, rewritten to new_args.
+
+    Rotates the log if it grew larger than cfg.log_max_size. The record is skipped if the log
+    cannot be written, so that logging never breaks the build.
+    """
+    if not is_sampled(cfg.log_sample_rate):
+        return
+
+    environment = ''
+    if cfg.log_environment:
+        environment = ',"env":{%s}' % (','.join(
+            '%s:%s' % (encode_basestring_ascii(name), encode_basestring_ascii(os.environ[name]))
+            for name in cfg.log_environment if name in os.environ),)
+    record = '{"time":%r,"pid":%d,"ppid":%d,"cwd":%s,"argv":%s,"rewritten":%s%s}\n' % (
+        time.time(), os.getpid(), os.getppid(), encode_basestring_ascii(os.getcwd()),
+        encode_list(args), encode_list(new_args), environment)
+
+    path = os.path.join(Configuration.log_path(), cfg.app_name)
+    try:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        except FileNotFoundError:
+            os.makedirs(Configuration.log_path(), exist_ok=True)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            os.write(fd, record.encode('ascii'))
+            if cfg.log_max_size and os.fstat(fd).st_size > cfg.log_max_size:
+                rotate(path, fd, cfg.log_backups, cfg.log_compress)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def rotate(path: str, fd: int, backups: int, compress: bool) -> None:
+    """
+    Rotate the log at path, of which fd is an open descriptor.
+
+    Only one wrapper rotates the log, the others go on appending to whichever file they
+    have opened.
+    """
+    import fcntl
+    lock_fd = os.open(path + '.lock', os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return  # somebody else is rotating it right now
+        try:
+            if os.stat(path).st_ino != os.fstat(fd).st_ino:
+                return  # somebody else has rotated it already
+        except FileNotFoundError:
+            return
+
+        if not backups:
+            os.unlink(path)
+        elif compress:
+            rotated_path = '%s.%s' % (path, os.getpid())
+            os.rename(path, rotated_path)
+        else:
+            shift_backups(path, backups, '')
+            os.rename(path, '%s.1' % (path,))
+    finally:
+        os.close(lock_fd)
+
+    if compress and backups:
+        compress_in_background(path, rotated_path, backups)
+
+
+def shift_backups(path: str, backups: int, suffix: str) -> None:
+    for i in range(backups - 1, 0, -1):
+        try:
+            os.rename('%s.%s%s' % (path, i, suffix), '%s.%s%s' % (path, i + 1, suffix))
+        except FileNotFoundError:
+            pass
+
+
+def compress_in_background(path: str, rotated_path: str, backups: int) -> None:
+    """
+    Gzip rotated_path into path.1.gz in a detached process, so that the tool does not wait
+    for it.
+    """
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        if not os.fork():
+            import fcntl
+            import gzip
+            import shutil
+            with open(rotated_path, 'rb') as f_in, gzip.open(rotated_path + '.gz', 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            with open(path + '.lock', 'wb') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                shift_backups(path, backups, '.gz')
+                os.rename(rotated_path + '.gz', '%s.1.gz' % (path,))
+            os.unlink(rotated_path)
+    finally:
+        os._exit(0)
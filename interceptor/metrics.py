@@ -0,0 +1,66 @@
+#
+# The "measure" mode: the wrapper runs the tool as it's child and records how long it took
+# and how much it used.
+#
+# This is imported by the wrappers, so only cheap parts of the standard library may be
+# imported at module level here.
+#
+import os
+
+from interceptor.config import Configuration
+from interceptor.invocation_log import encode_list
+from interceptor.response_files import remove_files
+from interceptor.supervise import Child, exit_like, exit_code
+
+
+def metrics_file_for(app_name: str) -> str:
+    return os.path.join(Configuration.lib_path(), 'metrics', app_name)
+
+
+def record_metrics(app_name: str, started_at: float, wall_time: float, rusage, status: int,
+                   args: list) -> None:
+    """
+    Append a record to app_name's metrics file, as a single line of JSON:
+
+    [start time, wall time, user CPU time, system CPU time, max RSS in KiB, exit code, argv]
+    """
+    record = '[%r,%r,%r,%r,%d,%d,%s]\n' % (started_at, wall_time, rusage.ru_utime,
+                                          rusage.ru_stime, rusage.ru_maxrss, exit_code(status),
+                                          encode_list(args))
+    path = metrics_file_for(app_name)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    try:
+        os.write(fd, record.encode('ascii'))
+    finally:
+        os.close(fd)
+
+
+def run_measured(cfg: Configuration, location: str, args: list,
+                 temporary_files: list = (), trace_path: str = None) -> None:
+    """
+    Run the tool as a child, record it's resource usage if cfg.measure is set and exit the same
+    way it did.
+
+    :param temporary_files: files to remove once the tool has exited
+    :param trace_path: directory to record the run to, see interceptor.trace
+    """
+    child = Child(location, args)
+    status, wall_time, rusage = child.wait()
+    remove_files(temporary_files)
+    if cfg.measure:
+        try:
+            record_metrics(cfg.app_name, child.started_at, wall_time, rusage, status, args)
+        except OSError as e:
+            print('interceptor(%s): cannot record metrics: %s' % (cfg.app_name, e))
+    if trace_path:
+        from interceptor.trace import record_trace
+        try:
+            record_trace(trace_path, cfg.app_name, child.started_at,
+                         child.started_at + wall_time, child.pid, status, args)
+        except OSError as e:
+            print('interceptor(%s): cannot record the trace: %s' % (cfg.app_name, e))
+    exit_like(status)
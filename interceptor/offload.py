@@ -0,0 +1,364 @@
+#
+# Offloading compilations to workers: with "offload" enabled, a tool's compilations of a single
+# source file into an object file are preprocessed by the wrapper, and compiled by the least
+# loaded of the intercept worker processes listening at offload_workers, on this machine or
+# another one. The wrapper writes the object file and prints what the compiler printed, as if
+# the compiler ran locally.
+#
+# Dependency files (-MD and the like) are written by the preprocessor, which runs locally. If
+# no worker is reachable, all of them are busy, or anything goes wrong before the worker
+# answers, the tool is ran locally as usual.
+#
+# A worker's address is either unix:PATH or tcp:HOST:PORT, and TRANSPORTS maps the part before
+# the colon to the function that connects to it. Workers are sent the same messages as the
+# daemon, framed by interceptor.protocol:
+#
+# ('load',) -> ('ok', running compilations, waiting compilations, slots)
+# ('compile', tool name, args, language, working directory, preprocessed source)
+#     -> ('ok', exit code, stdout, stderr, object file or None, wall time, CPU time)
+#
+# A worker counts a connection that asked for it's load as a waiting compilation until it
+# sends one or disconnects, so that wrappers starting at once spread over the workers.
+#
+# Over TCP the first frame a wrapper sends is the shared secret read from SECRET_FILE in
+# /etc, raw rather than marshalled, and the worker serves nothing before it has checked it.
+# Workers only run compilations whose arguments are all in the allowlist below, ie. options
+# that change the code generated or the warnings, and name no files or programs. The wrappers
+# run the others locally without trying.
+#
+# This is imported by the wrappers of tools that have "offload" enabled, so only cheap parts
+# of the standard library may be imported at module level here.
+#
+import fcntl
+import os
+import sys
+import time
+
+from interceptor.cache import capture_file, parse_invocation, read_captured, write_all, \
+    write_atomically
+from interceptor.compiler_options import PREPROCESSED_LANGUAGES, without_preprocessor_options
+from interceptor.config import Configuration
+from interceptor.supervise import Child
+
+# how long to wait for a worker to tell it's load
+LOAD_TIMEOUT = 0.5
+
+SECRET_FILE = 'interceptor-worker.secret'
+MAX_SECRET_SIZE = 4096
+
+# arguments that a worker runs as they are
+SAFE_ARGUMENTS = frozenset(('-ansi', '-pedantic', '-pedantic-errors', '-w', '-pthread',
+                            '-pipe', '-g', '-p', '-pg'))
+# prefixes of the arguments that a worker runs, if they name no path
+SAFE_PREFIXES = ('-O', '-g', '-std=', '-W', '-m', '-f', '--param=', '--target=')
+# options taking a separate value, that a worker runs if the value names no path
+SAFE_VALUE_OPTIONS = frozenset(('--param', '-target'))
+# options that match SAFE_PREFIXES, but load code, read or write files or split the output
+UNSAFE_PREFIXES = ('-fplugin', '-fpass-plugin', '-fload', '-fdump', '-fprofile', '-fauto-profile',
+                   '-fcreate-profile', '-ftest-coverage', '-fcoverage', '-ftime-trace',
+                   '-fsave-optimization-record', '-foptimization-record', '-fopt-info',
+                   '-fcrash-diagnostics', '-fmodule', '-fprebuilt-module', '-fimplicit-module',
+                   '-fsanitize-blacklist', '-fsanitize-ignorelist', '-fsanitize-system',
+                   '-fsanitize-coverage-allowlist', '-fsanitize-coverage-ignorelist',
+                   '-fxray-attr', '-fxray-always', '-fxray-never', '-fembed',
+                   '-fbasic-block-sections', '-fuse-ld', '-fstack-usage', '-fcallgraph-info',
+                   '-fdebug-prefix-map', '-fsyntax-only', '-gsplit-dwarf', '-mllvm')
+
+STATISTICS = ('offloaded', 'failed', 'busy', 'remote_cpu_time', 'preprocess_cpu_time',
+              'transfer_time')
+
+
+def default_worker_address() -> str:
+    return 'unix:' + os.path.join(Configuration.run_path(), 'worker.sock')
+
+
+def is_safe_value(value: str) -> bool:
+    return not value.startswith('-') and '/' not in value and '\\' not in value
+
+
+def is_safe_argument(arg: str) -> bool:
+    """Whether arg can be sent to a worker, that runs it for anyone who can connect to it"""
+    if arg in SAFE_ARGUMENTS:
+        return True
+    if not arg.startswith(SAFE_PREFIXES) or arg.startswith(UNSAFE_PREFIXES):
+        return False
+    if arg.startswith('-W') and ',' in arg:
+        # -Wa, -Wl and -Wp pass options to other programs
+        return False
+    return '/' not in arg and '\\' not in arg
+
+
+def unsafe_argument(args: list):
+    """
+    :param args: the arguments, without the process name
+    :return: the first of args that cannot be sent to a worker, or None if all of them can
+    """
+    arguments = iter(args)
+    for arg in arguments:
+        if arg in SAFE_VALUE_OPTIONS:
+            value = next(arguments, None)
+            if value is None or not is_safe_value(value):
+                return arg
+        elif not is_safe_argument(arg):
+            return arg
+    return None
+
+
+def secret_path() -> str:
+    return os.path.join(Configuration.base_path(), SECRET_FILE)
+
+
+def read_secret(path: str = None) -> bytes:
+    """
+    :raises OSError: the secret could not be read
+    :raises ValueError: the secret file is empty or too large
+    """
+    with open(path or secret_path(), 'rb') as f_in:
+        secret = f_in.read(MAX_SECRET_SIZE + 1).strip()
+    if not secret or len(secret) > MAX_SECRET_SIZE:
+        raise ValueError('%s has to hold between 1 and %s bytes' % (
+            path or secret_path(), MAX_SECRET_SIZE))
+    return secret
+
+
+def authenticate(sock) -> None:
+    """
+    Send the shared secret over a new connection to a worker.
+
+    :raises OSError: the secret could not be read, or the worker refused it
+    :raises ValueError: the secret is invalid
+    """
+    from interceptor.protocol import receive_message
+    secret = read_secret()
+    sock.sendall(len(secret).to_bytes(4, 'big') + secret)
+    try:
+        response = receive_message(sock)
+    except EOFError:
+        response = None
+    if response != ('ok',):
+        raise OSError('the worker refused the secret in %s' % (secret_path(),))
+
+
+def connect_unix(address: str, timeout: float):
+    import _socket
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def connect_tcp(address: str, timeout: float):
+    import _socket
+    host, _, port = address.rpartition(':')
+    host = host.strip('[]')
+    sock = _socket.socket(_socket.AF_INET6 if ':' in host else _socket.AF_INET,
+                          _socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect((host, int(port)))
+        sock.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, 1)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+TRANSPORTS = {'unix': connect_unix, 'tcp': connect_tcp}
+
+
+def connect(address: str, timeout: float):
+    """
+    :raises OSError: the worker could not be connected to
+    :raises ValueError: the address is invalid
+    """
+    scheme, _, rest = address.partition(':')
+    if scheme not in TRANSPORTS:
+        raise ValueError('unknown transport in %s' % (address,))
+    sock = TRANSPORTS[scheme](rest, timeout)
+    if scheme == 'tcp':
+        try:
+            authenticate(sock)
+        except BaseException:
+            sock.close()
+            raise
+    return sock
+
+
+def choose_worker(addresses: list):
+    """
+    Ask every worker how loaded it is, and pick the one with the most free slots.
+
+    :return: a connection to that worker, or None if none of them has a free slot
+    """
+    from interceptor.protocol import send_message, receive_message
+    best = None
+    best_load = 1.0
+    # start with a different worker in each wrapper, so that equally loaded ones take turns
+    start = os.getpid() % len(addresses)
+    for address in addresses[start:] + addresses[:start]:
+        try:
+            sock = connect(address, LOAD_TIMEOUT)
+        except (OSError, ValueError):
+            continue
+        try:
+            send_message(sock, ('load',))
+            status, running, waiting, slots = receive_message(sock)
+            load = (running + waiting) / slots if status == 'ok' and slots > 0 else 1.0
+        except (OSError, EOFError, ValueError, TypeError, ZeroDivisionError):
+            load = 1.0
+        if load < best_load:
+            if best is not None:
+                best.close()
+            best, best_load = sock, load
+        else:
+            sock.close()
+    return best
+
+
+def preprocess(location: str, args: list) -> tuple:
+    """
+    :return: a tuple of (the preprocessed source, or None if preprocessing has failed or it's
+        output could not be captured, CPU time it took)
+    """
+    try:
+        stdout_fd = capture_file()
+    except OSError:
+        return None, 0.0
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            status, _, rusage = Child(location, args, stdout=stdout_fd,
+                                      stderr=devnull.fileno()).wait()
+        cpu_time = rusage.ru_utime + rusage.ru_stime
+        if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+            return None, cpu_time
+        try:
+            return read_captured(stdout_fd), cpu_time
+        except OSError:
+            return None, cpu_time
+    finally:
+        os.close(stdout_fd)
+
+
+def run_offloaded(cfg: Configuration, location: str, args: list) -> None:
+    """
+    Have a worker compile args, if it's a compilation of a single source file.
+
+    Returns if args cannot be offloaded, or if no worker did compile it, otherwise exits the
+    same way the compiler did.
+    """
+    invocation = parse_invocation(args)
+    if invocation is None or '-x' in args:
+        return
+    language = PREPROCESSED_LANGUAGES.get(os.path.splitext(invocation.source)[1])
+    if language is None:
+        return
+    compile_args = without_preprocessor_options(
+        [arg for arg in invocation.preprocessor_args[1:-1] if arg != invocation.source])
+    if unsafe_argument(compile_args) is not None:
+        return
+    addresses = cfg.offload_workers or [default_worker_address()]
+    sock = choose_worker(addresses)
+    if sock is None:
+        record_offload(busy=1)
+        return
+
+    from interceptor.protocol import send_message, receive_message
+    try:
+        preprocessor_args = invocation.preprocessor_args[:-1] + invocation.dependency_args
+        if invocation.dependency_args:
+            if '-MF' not in invocation.dependency_args:
+                preprocessor_args += ['-MF', invocation.outputs[1]]
+            if not any(arg[:3] in ('-MT', '-MQ') for arg in invocation.dependency_args):
+                preprocessor_args += ['-MT', invocation.outputs[0]]
+        preprocessor_args.append('-E')
+        source, preprocess_cpu_time = preprocess(location, preprocessor_args)
+        if source is None:
+            # the compiler will report what's wrong, if anything, when it's ran locally
+            sock.close()
+            return
+
+        try:
+            sent_at = time.monotonic()
+            sock.settimeout(cfg.offload_timeout)
+            send_message(sock, ('compile', cfg.app_name, [args[0]] + compile_args, language,
+                                os.getcwd(), source))
+            status, *response = receive_message(sock)
+            if status != 'ok':
+                raise ValueError(response[0] if response else 'the worker failed')
+            code, stdout, stderr, obj, remote_time, remote_cpu_time = response
+            transfer_time = time.monotonic() - sent_at - remote_time
+            if obj is None and code == 0:
+                raise ValueError('the worker did not return the object file')
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            sys.stderr.write('interceptor(%s): offloading failed, compiling locally: %s\n' % (
+                cfg.app_name, e))
+            record_offload(failed=1)
+            return
+    finally:
+        sock.close()
+
+    if obj is not None:
+        try:
+            write_atomically(invocation.outputs[0], obj)
+        except OSError as e:
+            sys.stderr.write('interceptor(%s): cannot write %s: %s\n' % (
+                cfg.app_name, invocation.outputs[0], e))
+            sys.exit(1)
+    write_all(1, stdout)
+    write_all(2, stderr)
+    record_offload(offloaded=1, remote_cpu_time=remote_cpu_time,
+                   preprocess_cpu_time=preprocess_cpu_time, transfer_time=transfer_time)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+
+def statistics_path() -> str:
+    return os.path.join(Configuration.run_path(), 'offload-stats')
+
+
+def parse_statistics(data: bytes) -> dict:
+    values = data.split()
+    try:
+        values = [int(value) for value in values[:3]] + [float(value) for value in values[3:]]
+    except ValueError:
+        values = []
+    if len(values) != len(STATISTICS):
+        values = [0, 0, 0, 0.0, 0.0, 0.0]
+    return dict(zip(STATISTICS, values))
+
+
+def record_offload(**deltas) -> None:
+    """Add deltas to the statistics of offloading, under a lock"""
+    try:
+        try:
+            fd = os.open(statistics_path(), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o666)
+        except FileNotFoundError:
+            os.makedirs(Configuration.run_path(), exist_ok=True)
+            fd = os.open(statistics_path(), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            statistics = parse_statistics(os.read(fd, 4096))
+            for name, delta in deltas.items():
+                statistics[name] += delta
+            data = ('%d %d %d %r %r %r\n' % tuple(statistics[name] for name in STATISTICS)
+                    ).encode('ascii')
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, data)
+            os.ftruncate(fd, len(data))
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def read_statistics() -> dict:
+    try:
+        with open(statistics_path(), 'rb') as f_in:
+            return parse_statistics(f_in.read())
+    except FileNotFoundError:
+        return parse_statistics(b'')
@@ -0,0 +1,292 @@
+#
+# Load-adaptive parallelism: with a "parallelism" policy in the configuration of a build
+# driver (make, ninja or cmake --build), the wrapper works out how many jobs the machine can
+# take right now, and rewrites or inserts -j (--parallel for cmake) and -l accordingly, in
+# MAKEFLAGS too if that's where make was given them.
+#
+# The job count is the number of CPUs the wrapper may run on, capped by the CPU quota of it's
+# cgroup, times load_factor, less the load average, and capped by the available memory (of
+# the machine or the cgroup, whichever is less) divided by memory_per_job. The -l given is
+# the CPU count times load_factor, so that make and ninja hold back as other work comes in.
+#
+# A make ran by another make that has a jobserver gets it's jobs from the jobserver, and is
+# left alone.
+#
+# This is imported by the wrappers of tools that have a parallelism policy, so only cheap
+# parts of the standard library may be imported at module level here.
+#
+import os
+
+from interceptor.config import Configuration
+
+DRIVERS = {'make': 'make', 'gmake': 'make', 'ninja': 'ninja', 'samu': 'ninja',
+           'cmake': 'cmake'}
+MODES = ('replace', 'cap', 'missing')
+POLICY_DEFAULTS = {'driver': '',
+                   'mode': 'replace',
+                   'load_factor': 1.0,
+                   'memory_per_job': 0,
+                   'min_jobs': 1,
+                   'max_jobs': 0,
+                   'load_limit': True}
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+MIB = 1024 * 1024
+
+# options that set the number of jobs, and the ones that set the load limit
+JOB_OPTIONS = {'make': ('-j', '--jobs'), 'ninja': ('-j',), 'cmake': ('-j', '--parallel')}
+LOAD_OPTIONS = {'make': ('-l', '--load-average', '--max-load'), 'ninja': ('-l',), 'cmake': ()}
+
+
+def policy_of(cfg: Configuration) -> dict:
+    policy = dict(POLICY_DEFAULTS)
+    policy.update(cfg.parallelism)
+    return policy
+
+
+def validate_policy(policy: dict) -> None:
+    """
+    :raises ValueError: policy is not a valid parallelism policy
+    """
+    for key, value in policy.items():
+        if key not in POLICY_DEFAULTS:
+            raise ValueError('unknown key %s' % (key,))
+        default = POLICY_DEFAULTS[key]
+        if isinstance(default, bool) or isinstance(default, str):
+            valid = type(value) is type(default)
+        else:
+            valid = isinstance(value, (int, float)) and not isinstance(value, bool) \
+                    and value >= 0
+        if not valid:
+            raise ValueError('invalid %s: %r' % (key, value))
+    if policy.get('driver', '') not in ('',) + tuple(set(DRIVERS.values())):
+        raise ValueError('driver has to be one of %s' % (
+            ', '.join(sorted(set(DRIVERS.values()))),))
+    if policy.get('mode', 'replace') not in MODES:
+        raise ValueError('mode has to be one of %s' % (', '.join(MODES),))
+
+
+def cgroup_directories(controller: str) -> list:
+    """
+    :return: the directories of the cgroups this process is in for controller, innermost
+        first, that are visible
+    """
+    try:
+        with open('/proc/self/cgroup', 'r') as f_in:
+            lines = f_in.read().splitlines()
+    except OSError:
+        return []
+    directories = []
+    for line in lines:
+        _, controllers, path = line.split(':', 2)
+        if controllers:
+            if controller not in controllers.split(','):
+                continue
+            base = os.path.join(CGROUP_ROOT, controllers)
+        else:
+            base = CGROUP_ROOT
+        directory = os.path.normpath(base + path)
+        while directory.startswith(base):
+            if os.path.isdir(directory):
+                directories.append(directory)
+            directory = os.path.dirname(directory)
+    return directories
+
+
+def read_numbers(path: str) -> list:
+    """:return: the numbers in the file at path, with max as None, or [] if there's none"""
+    try:
+        with open(path, 'r') as f_in:
+            return [None if word == 'max' else int(word) for word in f_in.read().split()]
+    except (OSError, ValueError):
+        return []
+
+
+def cpu_quota():
+    """:return: the number of CPUs this process' cgroups allow it to use, or None"""
+    limit = None
+    for directory in cgroup_directories('cpu'):
+        values = read_numbers(os.path.join(directory, 'cpu.max'))
+        if not values:
+            values = read_numbers(os.path.join(directory, 'cpu.cfs_quota_us')) \
+                + read_numbers(os.path.join(directory, 'cpu.cfs_period_us'))
+        if len(values) == 2 and values[0] is not None and values[0] > 0 and values[1]:
+            quota = values[0] / values[1]
+            limit = quota if limit is None else min(limit, quota)
+    return limit
+
+
+def available_memory():
+    """
+    :return: how many bytes of memory this process may still use, as far as the machine and
+        it's cgroups tell, or None if it's unknown
+    """
+    from interceptor.slots import available_memory as machine_available_memory
+    available = machine_available_memory()
+    for directory in cgroup_directories('memory'):
+        limit = read_numbers(os.path.join(directory, 'memory.max')) \
+            or read_numbers(os.path.join(directory, 'memory.limit_in_bytes'))
+        usage = read_numbers(os.path.join(directory, 'memory.current')) \
+            or read_numbers(os.path.join(directory, 'memory.usage_in_bytes'))
+        # cgroup v1 reports no limit as a huge number
+        if limit and usage and limit[0] is not None and limit[0] < 1 << 60 \
+                and usage[0] is not None:
+            left = max(limit[0] - usage[0], 0)
+            available = left if available is None else min(available, left)
+    return available
+
+
+def measure_resources() -> dict:
+    """
+    :return: a dict of cpus (CPUs this process may run on), quota (CPUs it's cgroup allows
+        it, or None), load (the 1 minute load average) and memory (bytes available, or None)
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+    try:
+        load = os.getloadavg()[0]
+    except OSError:
+        load = 0.0
+    return {'cpus': cpus, 'quota': cpu_quota(), 'load': load, 'memory': available_memory()}
+
+
+def job_count(policy: dict, resources: dict) -> tuple:
+    """
+    :param resources: as returned by measure_resources()
+    :return: a tuple of (number of jobs, load limit)
+    """
+    capacity = resources['cpus']
+    if resources['quota'] is not None:
+        capacity = min(capacity, max(int(resources['quota'] + 0.999), 1))
+    max_load = capacity * policy['load_factor']
+    jobs = int(max_load - resources['load'] + 0.5)
+    if policy['memory_per_job'] and resources['memory'] is not None:
+        jobs = min(jobs, resources['memory'] // (policy['memory_per_job'] * MIB))
+    jobs = max(jobs, policy['min_jobs'], 1)
+    if policy['max_jobs']:
+        jobs = min(jobs, policy['max_jobs'])
+    return int(jobs), max_load
+
+
+def is_number(value: str) -> bool:
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def split_parallelism(args: list, driver: str, strip_load: bool) -> tuple:
+    """
+    Take the options that set the number of jobs, and the load limit if strip_load, out of
+    args[1:].
+
+    :return: a tuple of (the remaining args, number of jobs given, 0 for as many as possible,
+        or None if none was given)
+    """
+    job_options = JOB_OPTIONS[driver]
+    load_options = LOAD_OPTIONS[driver] if strip_load else ()
+    result = [args[0]]
+    jobs = None
+    i = 1
+    while i < len(args):
+        arg = args[i]
+        if arg == '--':
+            result.extend(args[i:])
+            break
+        if arg.startswith('--'):
+            name, sep, value = arg.partition('=')
+        elif arg[:2] in job_options + load_options and len(arg) > 2 and is_number(arg[2:]):
+            name, sep, value = arg[:2], '=', arg[2:]
+        else:
+            name, sep, value = arg, '', ''
+        if name not in job_options and name not in load_options:
+            result.append(arg)
+            i += 1
+            continue
+        if not sep and i + 1 < len(args) and is_number(args[i + 1]):
+            value = args[i + 1]
+            i += 1
+        if name in job_options:
+            jobs = int(value) if value.isdigit() else 0
+        i += 1
+    return result, jobs
+
+
+def apply_parallelism(cfg: Configuration, args: list) -> list:
+    """
+    :return: args with the number of jobs and the load limit set by cfg's policy, if args runs
+        a build driver
+    """
+    policy = policy_of(cfg)
+    driver = policy['driver'] or DRIVERS.get(cfg.app_name) \
+        or DRIVERS.get(os.path.basename(args[0]))
+    if driver is None:
+        return args
+    options_end = args.index('--') if '--' in args else len(args)
+    if driver == 'cmake' and '--build' not in args[1:options_end]:
+        return args
+    makeflags = os.environ.get('MAKEFLAGS', '') if driver == 'make' else ''
+    if '--jobserver-auth' in makeflags or '--jobserver-fds' in makeflags:
+        return args
+
+    strip_load = policy['load_limit']
+    new_args, jobs = split_parallelism(args, driver, strip_load)
+    environment = None
+    if jobs is None and makeflags:
+        words, jobs = split_parallelism(['make'] + makeflags.split(), driver, strip_load)
+        if jobs is not None:
+            environment = 'MAKEFLAGS'
+    if jobs is None and driver == 'cmake' and 'CMAKE_BUILD_PARALLEL_LEVEL' in os.environ:
+        level = os.environ['CMAKE_BUILD_PARALLEL_LEVEL']
+        jobs = int(level) if level.isdigit() else 0
+        environment = 'CMAKE_BUILD_PARALLEL_LEVEL'
+    if policy['mode'] == 'missing' and jobs is not None \
+            or policy['mode'] == 'cap' and jobs is None:
+        return args
+
+    resources = measure_resources()
+    count, max_load = job_count(policy, resources)
+    if policy['mode'] == 'cap' and jobs:
+        count = min(count, jobs)
+    if driver == 'cmake':
+        options = ['--parallel', str(count)]
+    else:
+        options = ['-j%d' % (count,)]
+        if strip_load:
+            options.append('-l%g' % (round(max_load, 2),))
+    if cfg.notify_about_actions:
+        print('interceptor(%s): running %s jobs (%s CPUs, load %.2f)' % (
+            cfg.app_name, count, resources['cpus'], resources['load']))
+
+    if environment == 'MAKEFLAGS':
+        # whatever follows -- are variable definitions
+        words = words[1:]
+        options_end = words.index('--') if '--' in words else len(words)
+        os.environ['MAKEFLAGS'] = ' '.join(words[:options_end] + options + words[options_end:])
+        return new_args
+    if environment == 'CMAKE_BUILD_PARALLEL_LEVEL':
+        os.environ['CMAKE_BUILD_PARALLEL_LEVEL'] = str(count)
+        return new_args
+    if driver == 'cmake':
+        options_end = new_args.index('--') if '--' in new_args else len(new_args)
+        return new_args[:options_end] + options + new_args[options_end:]
+    return new_args[:1] + options + new_args[1:]
+
+
+def describe_parallelism(cfg: Configuration) -> str:
+    """:return: what cfg's policy would set here and now, for intercept status"""
+    policy = policy_of(cfg)
+    resources = measure_resources()
+    count, max_load = job_count(policy, resources)
+    parts = ['%s CPUs' % (resources['cpus'],)]
+    if resources['quota'] is not None:
+        parts.append('CPU quota of %.2f' % (resources['quota'],))
+    parts.append('load %.2f' % (resources['load'],))
+    if resources['memory'] is not None:
+        parts.append('%.1f GiB available' % (resources['memory'] / (1024 * MIB),))
+    return '%s jobs%s now (%s), mode %s' % (
+        count, ', load limit %.2f' % (max_load,) if policy['load_limit'] else '',
+        ', '.join(parts), policy['mode'])
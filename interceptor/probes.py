@@ -0,0 +1,193 @@
+#
+# Memoized probes: configure scripts and build systems ask compilers the same questions, such as
+# gcc -dumpversion or cc -E -dM - </dev/null, thousands of times. With "probe_cache" enabled,
+# the answers to these are kept in /var/cache/interceptor/probes and repeated questions are
+# answered from there, without starting the tool.
+#
+# An invocation is a probe if every one of it's arguments is in the allowlist, which is
+# probe_arguments of the configuration, or DEFAULT_PROBE_ARGUMENTS if that's empty. The key of
+# a probe is a hash of the rewritten command line, the whole configuration of the tool, the
+# identity of it's binary, the environment variables that affect compilers and, if it reads
+# stdin (ie. has - among it's arguments), what it was given on stdin. Since that takes in the
+# binary and the configuration, upgrading the tool or editing it's rules invalidates the answers.
+# If the answers cannot be stored, eg. because the cache belongs to another user, the probes
+# are answered by the tool every time, without a word, since the output is the answer.
+#
+# This is imported by the wrappers of tools that have "probe_cache" enabled, so only cheap parts
+# of the standard library may be imported at module level here.
+#
+import hashlib
+import marshal
+import os
+import sys
+
+from interceptor.cache import RELEVANT_ENVIRONMENT, capture_outputs, count, read_captured, \
+    write_all, write_atomically
+from interceptor.config import Configuration
+from interceptor.supervise import Child, exit_like
+
+PROBES_VERSION = 1
+
+# arguments that only ask the tool about itself, or that only change what it answers.
+# Entries ending with * match every argument starting with the rest of them.
+# -print-file-name= and -print-prog-name= are left out, since their answers depend on the
+# files installed besides the tool, eg. a library that's found in another directory once it's
+# installed.
+DEFAULT_PROBE_ARGUMENTS = (
+    '--version', '-v', '-###', '-dumpversion', '-dumpfullversion', '-dumpmachine', '-dumpspecs',
+    '-print-search-dirs', '-print-libgcc-file-name', '-print-multiarch',
+    '-print-multi-directory', '-print-multi-lib', '-print-multi-os-directory', '-print-sysroot',
+    '-print-sysroot-headers-suffix', '-print-resource-dir', '-print-target-triple',
+    '-print-effective-triple', '-E', '-dM', '-P', '-', '-std=*', '-m*', '-O*', '-D*', '-U*',
+    '--target=*', '-w')
+
+# the languages that -x may name in a probe
+PROBE_LANGUAGES = frozenset(('c', 'c++', 'objective-c', 'objective-c++', 'assembler-with-cpp'))
+
+# the environment variables that affect probes, besides those that affect compilations
+PROBE_ENVIRONMENT = RELEVANT_ENVIRONMENT + ('PATH',)
+
+
+def is_probe(arguments: list, allowlist) -> bool:
+    """
+    :param arguments: the arguments, without the process name
+    :param allowlist: the allowed arguments, entries ending with * being prefixes. -x is allowed
+        along with any of PROBE_LANGUAGES.
+    """
+    if not arguments:
+        return False
+    exact = set()
+    prefixes = []
+    for entry in allowlist:
+        if entry.endswith('*'):
+            prefixes.append(entry[:-1])
+        else:
+            exact.add(entry)
+    prefixes = tuple(prefixes)
+    arguments = iter(arguments)
+    for arg in arguments:
+        if arg == '-x':
+            if next(arguments, None) not in PROBE_LANGUAGES:
+                return False
+        elif arg not in exact and not arg.startswith(prefixes):
+            return False
+    return True
+
+
+def read_stdin() -> bytes:
+    chunks = []
+    while True:
+        data = os.read(0, 1024 * 1024)
+        if not data:
+            return b''.join(chunks)
+        chunks.append(data)
+
+
+def probe_key(cfg: Configuration, location: str, args: list, stdin: bytes) -> str:
+    hasher = hashlib.sha256()
+
+    def add(data: bytes) -> None:
+        hasher.update(b'%d:' % (len(data),))
+        hasher.update(data)
+
+    add(b'interceptor-probe-%d' % (PROBES_VERSION,))
+    add(repr(cfg.to_json()).encode('utf-8'))
+    binary = os.stat(location)
+    add(b'%d %d %d %d' % (binary.st_dev, binary.st_ino, binary.st_size, binary.st_mtime_ns))
+    add(b'%d' % (len(args),))
+    for arg in args:
+        add(os.fsencode(arg))
+    for name in PROBE_ENVIRONMENT:
+        value = os.environ.get(name)
+        add(b'-' if value is None else b'=' + os.fsencode(value))
+    add(b'-' if stdin is None else stdin)
+    return hasher.hexdigest()
+
+
+def answer_probe(cfg: Configuration, location: str, args: list) -> None:
+    """
+    Answer args from the cache if it's a probe that has been answered before, or run the tool
+    and remember it's answer if it's a probe that has not.
+
+    Returns only if args is not a probe, otherwise exits the same way the tool did. If the
+    cache cannot be written, the tool is ran as if probe_cache was off.
+    """
+    if not is_probe(args[1:], cfg.probe_arguments or DEFAULT_PROBE_ARGUMENTS):
+        return
+    stdin = None
+    if '-' in args:
+        stdin = read_stdin()
+        if b'include' in stdin or b'import' in stdin:
+            # the headers are not a part of the key, so preprocessing them is not a probe
+            feed_and_run(location, args, stdin)
+    try:
+        key = probe_key(cfg, location, args, stdin)
+    except OSError:
+        feed_and_run(location, args, stdin)
+    path = os.path.join(Configuration.cache_path(), 'probes', key)
+
+    try:
+        with open(path, 'rb') as f_in:
+            version, stdout, stderr, code = marshal.load(f_in)
+        if version == PROBES_VERSION:
+            write_all(1, stdout)
+            write_all(2, stderr)
+            count(probe_hits=1)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    try:
+        stdout_fd, stderr_fd = capture_outputs()
+    except OSError:
+        feed_and_run(location, args, stdin)
+    count(probe_misses=1)
+    status = run_child(location, args, stdin, stdout=stdout_fd, stderr=stderr_fd)
+    stdout, stderr = read_captured(stdout_fd), read_captured(stderr_fd)
+    write_all(1, stdout)
+    write_all(2, stderr)
+    if os.WIFEXITED(status):
+        data = marshal.dumps((PROBES_VERSION, stdout, stderr, os.WEXITSTATUS(status)))
+        try:
+            try:
+                write_atomically(path, data)
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_atomically(path, data)
+        except OSError:
+            # nothing may be added to the answer, since it's what the build system reads
+            pass
+    exit_like(status)
+
+
+def run_child(location: str, args: list, stdin: bytes = None, **kwargs) -> int:
+    """
+    Run the tool, giving it stdin if it's not None.
+
+    :return: it's wait status
+    """
+    if stdin is None:
+        status, _, _ = Child(location, args, **kwargs).wait()
+        return status
+    # a pipe rather than a file, so that it works when the cache cannot be written
+    read_fd, write_fd = os.pipe()
+    try:
+        child = Child(location, args, stdin=read_fd, **kwargs)
+    finally:
+        os.close(read_fd)
+    try:
+        write_all(write_fd, stdin)
+    except BrokenPipeError:
+        # the tool did not read all of it
+        pass
+    finally:
+        os.close(write_fd)
+    status, _, _ = child.wait()
+    return status
+
+
+def feed_and_run(location: str, args: list, stdin: bytes = None) -> None:
+    """Run the tool, giving it stdin if it's not None, and exit the same way it did"""
+    exit_like(run_child(location, args, stdin))
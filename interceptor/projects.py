@@ -0,0 +1,212 @@
+#
+# Per-project overrides: with "project_overrides" enabled in foo's configuration, the wrapper
+# looks for .interceptor/foo files in it's working directory and every directory above it,
+# and applies them on top of the configuration, the outermost first, followed by
+# $INTERCEPTOR_OVERRIDES/foo if that variable names a directory laid out like .interceptor.
+#
+# A layer is a JSON object holding some keys of the configuration. Lists of rules
+# (RULE_LISTS) are added to those of the layers below, the dicts in RULE_DICTS are updated
+# key by key, and any other key replaces the value of the layers below. The keys in
+# REFUSED_KEYS make the tool run other programs or change it's environment, so a layer setting
+# them is refused as a whole.
+#
+# Since the directories above a project are not necessarily the user's, such as /tmp or /home,
+# a layer is only taken if it, it's .interceptor directory and the directory holding that are
+# all owned by the user or by root, and none of them is writable by the group or others.
+#
+# Finding the layers takes a stat per directory above the working directory. The merged
+# configuration is then looked up in /var/cache/interceptor/projects/<uid> by the layers that
+# make it, and used as long as none of them, nor the configuration itself, has been modified
+# since, so that no JSON is read or rules compiled as long as nothing changes. Every working
+# directory of a project shares the same entry. The entries of each user are kept in a
+# directory only they can access, and an entry not owned by the user is never loaded.
+#
+# This is imported by the wrappers of tools that have "project_overrides" enabled, so only
+# cheap parts of the standard library may be imported at module level here.
+#
+import marshal
+import os
+import sys
+import zlib
+
+from interceptor.config import Configuration
+from interceptor.rewrite import Rewriter
+
+PROJECT_DIRECTORY = '.interceptor'
+OVERRIDES_ENVIRONMENT = 'INTERCEPTOR_OVERRIDES'
+
+INDEX_VERSION = 1
+
+# keys whose values are lists of rules, that a layer adds to
+RULE_LISTS = frozenset(('args_to_disable', 'args_to_append', 'args_to_prepend',
+                        'args_to_replace', 'patterns_to_disable', 'patterns_to_replace',
+                        'env_unset'))
+# keys whose values are dicts, that a layer updates
+RULE_DICTS = frozenset(('parallelism',))
+# keys that only the configuration itself may set
+IGNORED_KEYS = frozenset(('frozen', 'project_overrides'))
+# keys that a layer may not set at all
+REFUSED_KEYS = frozenset(('launcher', 'env_set', 'rlimits', 'offload', 'offload_workers',
+                          'offload_timeout'))
+
+
+def mtime_of(path: str):
+    """Return the modification time of the regular file at path, or None if there's none"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns if st.st_mode & 0o170000 == 0o100000 else None
+
+
+def is_trusted(path: str, uid: int) -> bool:
+    """
+    :return: whether path is owned by uid or root, and not writable by the group or others
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return st.st_uid in (uid, 0) and not st.st_mode & 0o022
+
+
+def is_trusted_layer(path: str) -> bool:
+    """:return: whether the layer at path, and the two directories above it, are trusted"""
+    uid = os.getuid()
+    directory = os.path.dirname(path)
+    return is_trusted(path, uid) and is_trusted(directory, uid) \
+        and is_trusted(os.path.dirname(directory), uid)
+
+
+def find_layers(name: str, directory: str, untrusted: list = None) -> list:
+    """
+    :param directory: the directory to start looking in, an absolute path
+    :param untrusted: a list to append the paths of layers skipped as untrusted to, if given
+    :return: a list of (path, modification time) of the layers for tool name, in the order to
+        apply them in
+    """
+    paths = []
+    while True:
+        paths.append(os.path.join(directory, PROJECT_DIRECTORY, name))
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+    paths.reverse()
+    overrides = os.environ.get(OVERRIDES_ENVIRONMENT)
+    if overrides:
+        paths.append(os.path.join(os.path.abspath(overrides), name))
+
+    layers = []
+    for path in paths:
+        mtime_ns = mtime_of(path)
+        if mtime_ns is None:
+            continue
+        if is_trusted_layer(path):
+            layers.append((path, mtime_ns))
+        elif untrusted is not None:
+            untrusted.append(path)
+    return layers
+
+
+def merge(dct: dict, layer: dict) -> None:
+    """
+    Apply layer on top of dct, the JSON of a configuration.
+
+    :raises ValueError: layer is not a valid layer
+    """
+    if not isinstance(layer, dict):
+        raise ValueError('a layer has to be a JSON object')
+    for key in REFUSED_KEYS.intersection(layer):
+        raise ValueError('%s may only be set in the configuration itself' % (key,))
+    for key, value in layer.items():
+        if key in IGNORED_KEYS:
+            continue
+        if key in RULE_LISTS:
+            if not isinstance(value, list):
+                raise ValueError('%s has to be a list' % (key,))
+            dct[key] = list(dct.get(key) or []) + value
+        elif key in RULE_DICTS:
+            if not isinstance(value, dict):
+                raise ValueError('%s has to be an object' % (key,))
+            merged = dict(dct.get(key) or {})
+            merged.update(value)
+            dct[key] = merged
+        else:
+            dct[key] = value
+
+
+def entry_path(name: str, layers: list) -> str:
+    key = '\0'.join(path for path, _ in layers).encode('utf-8', 'surrogateescape')
+    return os.path.join(Configuration.cache_path(), 'projects', str(os.getuid()),
+                        '%s.%08x' % (name, zlib.crc32(key)))
+
+
+def load_entry(path: str):
+    """
+    :return: the unmarshalled entry at path
+    :raises OSError: the entry could not be read, or is not owned by the user
+    """
+    with open(path, 'rb') as f_in:
+        st = os.fstat(f_in.fileno())
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            raise PermissionError('%s is not owned by the user' % (path,))
+        return marshal.load(f_in)
+
+
+def apply_project_overrides(cfg: Configuration, name: str, mtime_ns: int) -> Configuration:
+    """
+    :param cfg: the configuration of tool name
+    :param mtime_ns: modification time of it's file
+    :return: the configuration with the layers found from the working directory applied, or
+        cfg if there are none
+    """
+    try:
+        layers = find_layers(name, os.getcwd())
+    except OSError:
+        return cfg
+    if not layers:
+        return cfg
+
+    path = entry_path(name, layers)
+    try:
+        version, entry_mtime_ns, entry_layers, dct, rewriter_plan = load_entry(path)
+        if version == INDEX_VERSION and entry_mtime_ns == mtime_ns \
+                and entry_layers == layers:
+            result = Configuration.from_json(dct, app_name=name)
+            result._rewriter = Rewriter.from_plan(rewriter_plan)
+            return result
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    import json
+    dct = cfg.to_json()
+    valid = True
+    for layer_path, _ in layers:
+        try:
+            with open(layer_path, 'r') as f_in:
+                merge(dct, json.load(f_in))
+        except (OSError, ValueError) as e:
+            sys.stderr.write('interceptor(%s): ignoring %s: %s\n' % (name, layer_path, e))
+            valid = False
+    result = Configuration.from_json(dct, app_name=name)
+    if valid:
+        # rewritten as a whole, so that wrappers never see a half written entry
+        data = marshal.dumps((INDEX_VERSION, mtime_ns, layers, result.to_json(),
+                              result.rewriter.to_plan()))
+        tmp_path = '%s.%s' % (path, os.getpid())
+        try:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+            try:
+                fd = os.open(tmp_path, flags, 0o600)
+            except FileNotFoundError:
+                directory = os.path.dirname(path)
+                os.makedirs(os.path.dirname(directory), exist_ok=True)
+                os.mkdir(directory, 0o700)
+                fd = os.open(tmp_path, flags, 0o600)
+            with open(fd, 'wb') as f_out:
+                f_out.write(data)
+            os.rename(tmp_path, path)
+        except OSError:
+            pass
+    return result
@@ -0,0 +1,40 @@
+#
+# Framing of the messages exchanged over interceptor's sockets.
+#
+# This is used by the generated wrappers, so only cheap parts of the standard library may be
+# imported here. Messages are marshalled rather than JSON-encoded for the same reason.
+#
+import marshal
+
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024
+
+
+def send_message(sock, message) -> None:
+    data = marshal.dumps(message)
+    sock.sendall(len(data).to_bytes(4, 'big') + data)
+
+
+def receive_exactly(sock, length: int) -> bytes:
+    chunks = []
+    while length:
+        chunk = sock.recv(min(length, 1024 * 1024))
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b''.join(chunks)
+
+
+def receive_message(sock):
+    """
+    :raises EOFError: connection was closed
+    :raises ValueError: the message was malformed
+    """
+    length = int.from_bytes(receive_exactly(sock, 4), 'big')
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError('message too large')
+    data = receive_exactly(sock, length)
+    try:
+        return marshal.loads(data)
+    except (EOFError, TypeError) as e:
+        raise ValueError('malformed message: %s' % (e,))
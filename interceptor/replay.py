@@ -0,0 +1,343 @@
+"""
+intercept replay - A/B benchmarking of two configurations of a tool, against the invocations of
+it recorded in it's log.
+
+Each invocation is rewritten by both of the configurations, exactly as their wrappers would do
+it, and ran in it's recorded working directory, with the environment variables recorded along
+with it (see log_environment) and the environment changes of the configuration. The runs of
+both configurations are interleaved and spread over a process pool, and each of them is
+repeated, so that the differences in wall time, CPU time and max RSS can be reported together
+with their 95% confidence intervals.
+
+Files given to -o and -MF are redirected into a scratch directory of each configuration, so
+that replaying does not overwrite the outputs of the build. Compilations that write their object
+file or their dependency file to the working directory by default are given -o and -MF leading
+there as well.
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import typing as tp
+from concurrent.futures import ProcessPoolExecutor
+
+from interceptor.cache import SOURCE_EXTENSIONS
+from interceptor.compiler_options import operands
+from interceptor.config import Configuration, read_json_from_file
+from interceptor.index import ExecutableIndex, INTERCEPTED
+from interceptor.supervise import Child, exit_code
+
+# two-sided 95% quantiles of Student's t-distribution, by degrees of freedom
+T_QUANTILES = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201,
+               2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074,
+               2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042)
+
+OUTPUT_OPTIONS = ('-o', '-MF')
+
+METRICS = ('wall', 'cpu', 'rss')
+
+
+class Invocation:
+    def __init__(self, cwd: str, argv: tp.List[str], env: tp.Dict[str, str]):
+        self.cwd = cwd
+        self.argv = argv
+        self.env = env
+
+    @property
+    def name(self) -> str:
+        files = operands(self.argv[1:])
+        name = os.path.basename(self.argv[0])
+        if files:
+            name += ' ' + os.path.basename(files[0])
+        return name
+
+
+def load_invocations(path: str, limit: int) -> tp.List[Invocation]:
+    """
+    Read the invocations from a log, skipping repeated ones.
+
+    :return: the last limit of them
+    """
+    invocations = {}
+    with open(path, 'r', encoding='utf-8') as f_in:
+        for line in f_in:
+            try:
+                record = json.loads(line)
+                key = json.dumps([record['cwd'], record['argv'], record.get('env', {})])
+                invocations.pop(key, None)
+                invocations[key] = Invocation(record['cwd'], record['argv'],
+                                              record.get('env', {}))
+            except (ValueError, KeyError, TypeError):
+                continue
+    return list(invocations.values())[-limit:]
+
+
+def find_original(tool_name: str) -> str:
+    """Return path to the original executable of tool_name"""
+    for executable in ExecutableIndex([tool_name]).paths(tool_name):
+        if executable.is_wrapper and executable.has_original:
+            return executable.path + INTERCEPTED
+        if not executable.is_wrapper:
+            return executable.path
+    print('No executable of %s was found' % (tool_name,))
+    sys.exit(1)
+
+
+def implied_output(args: tp.List[str]) -> tp.Optional[str]:
+    """
+    :param args: the arguments of a compiler, without the process name and without -o
+    :return: name of the file it writes to it's working directory, or None if it writes to
+        stdout or it's not a compilation
+    :raises ValueError: it writes several files to it's working directory
+    """
+    if '-E' in args or '-M' in args or '-MM' in args:
+        return None
+    sources = [arg for arg in operands(args) if os.path.splitext(arg)[1] in SOURCE_EXTENSIONS]
+    if not sources:
+        # other tools may take -o for something else
+        return None
+    if '-c' not in args and '-S' not in args:
+        return 'a.out'
+    if len(sources) > 1:
+        raise ValueError('compiles several files to the working directory')
+    return os.path.splitext(os.path.basename(sources[0]))[0] + ('.s' if '-S' in args else '.o')
+
+
+def redirect_outputs(args: tp.List[str], directory: str) -> tp.List[str]:
+    """
+    Return args with the files given to -o and -MF moved into directory, and with -o and -MF
+    leading into directory added if it's a compilation that writes them to the working
+    directory by default.
+
+    :raises ValueError: the outputs cannot be redirected
+    """
+    result = []
+    redirect_next = None
+    given = {}
+    for arg in args:
+        if redirect_next is not None:
+            given[redirect_next] = os.path.basename(arg)
+            arg = os.path.join(directory, os.path.basename(arg))
+            redirect_next = None
+        elif arg in OUTPUT_OPTIONS:
+            redirect_next = arg
+        else:
+            for option in OUTPUT_OPTIONS:
+                if arg.startswith(option) and arg != option:
+                    given[option] = os.path.basename(arg[len(option):])
+                    arg = option + os.path.join(directory, given[option])
+                    break
+        result.append(arg)
+
+    output = given.get('-o')
+    if output is None:
+        output = implied_output(result[1:])
+        if output is not None:
+            result.extend(('-o', os.path.join(directory, output)))
+    if '-MF' not in given and ('-MD' in result or '-MMD' in result):
+        # named after the output, like the compiler does
+        name = os.path.splitext(output or 'a.out')[0] + '.d'
+        result.extend(('-MF', os.path.join(directory, name)))
+    return result
+
+
+def prepare(cfg: Configuration, invocation: Invocation,
+            directory: str) -> tp.Tuple[tp.List[str], tp.Dict[str, str]]:
+    """
+    :return: a tuple of (the arguments, the environment) to run invocation with under cfg
+    """
+    args = redirect_outputs(cfg.rewrite(invocation.argv), directory)
+    env = dict(os.environ)
+    env.update(invocation.env)
+    for name in cfg.env_unset:
+        env.pop(name, None)
+    env.update(cfg.env_set)
+    return args, env
+
+
+def run_once(location: str, args: tp.List[str], cwd: str,
+             env: tp.Dict[str, str]) -> tp.Tuple[float, float, int, int]:
+    """
+    Run the tool once, in a worker of the pool.
+
+    :return: a tuple of (wall time, CPU time, max RSS in KiB, exit code)
+    """
+    os.chdir(cwd)
+    with open(os.devnull, 'wb') as devnull:
+        child = Child(location, args, env, stdout=devnull.fileno(), stderr=devnull.fileno())
+        status, wall_time, rusage = child.wait()
+    return wall_time, rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss, exit_code(status)
+
+
+def mean_and_variance(values: tp.Sequence[float]) -> tp.Tuple[float, float]:
+    mean = sum(values) / len(values)
+    if len(values) < 2:
+        return mean, 0.0
+    return mean, sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+
+
+def t_quantile(degrees_of_freedom: float) -> float:
+    if degrees_of_freedom < 1:
+        return T_QUANTILES[0]
+    if degrees_of_freedom > len(T_QUANTILES):
+        return 1.96
+    return T_QUANTILES[int(degrees_of_freedom) - 1]
+
+
+def compare(a: tp.Sequence[float], b: tp.Sequence[float]) -> dict:
+    """
+    Compare two samples with Welch's t-interval.
+
+    :return: a dict of the means, the difference of b from a and the half-width of it's 95%
+        confidence interval, the latter two in percent of a's mean
+    """
+    mean_a, variance_a = mean_and_variance(a)
+    mean_b, variance_b = mean_and_variance(b)
+    se_a, se_b = variance_a / len(a), variance_b / len(b)
+    denominator = sum(se ** 2 / (count - 1) for se, count in ((se_a, len(a)), (se_b, len(b)))
+                      if count > 1)
+    degrees_of_freedom = (se_a + se_b) ** 2 / denominator if denominator else 1
+    margin = t_quantile(degrees_of_freedom) * math.sqrt(se_a + se_b)
+    scale = 100 / mean_a if mean_a else 0
+    return {'a': mean_a, 'b': mean_b, 'difference': (mean_b - mean_a) * scale,
+            'margin': margin * scale}
+
+
+def aggregate(ratios: tp.Sequence[float]) -> dict:
+    """
+    Summarize the ratios of b's means to a's over all the invocations as their geometric mean.
+
+    :return: a dict of the difference and the bounds of it's 95% confidence interval, all
+        in percent
+    """
+    logs = [math.log(ratio) for ratio in ratios if ratio > 0]
+    if not logs:
+        return {'difference': 0.0, 'low': 0.0, 'high': 0.0}
+    mean, variance = mean_and_variance(logs)
+    margin = t_quantile(len(logs) - 1) * math.sqrt(variance / len(logs)) if len(logs) > 1 \
+        else 0.0
+    return {'difference': (math.exp(mean) - 1) * 100,
+            'low': (math.exp(mean - margin) - 1) * 100,
+            'high': (math.exp(mean + margin) - 1) * 100}
+
+
+def replay(tool_name: str, paths: tp.Tuple[str, str], runs: int, jobs: int, limit: int,
+           log_path: tp.Optional[str] = None) -> dict:
+    """
+    :return: a JSON-able report
+    """
+    configs = [Configuration.from_json(read_json_from_file(path), app_name=tool_name)
+               for path in paths]
+    invocations = load_invocations(
+        log_path or os.path.join(Configuration.log_path(), tool_name), limit)
+    if not invocations:
+        print('No invocations of %s were logged' % (tool_name,))
+        sys.exit(1)
+    location = find_original(tool_name)
+
+    scratch = tempfile.mkdtemp(prefix='interceptor-replay-')
+    try:
+        tasks = []
+        replayed = []
+        for invocation in invocations:
+            i = len(replayed)
+            try:
+                prepared = []
+                for variant, cfg in enumerate(configs):
+                    directory = os.path.join(scratch, '%s-%s' % (i, variant))
+                    os.makedirs(directory, exist_ok=True)
+                    prepared.append(prepare(cfg, invocation, directory))
+            except ValueError as e:
+                print('Skipping %s, since it %s' % (invocation.name, e))
+                continue
+            replayed.append(invocation)
+            for variant, (args, env) in enumerate(prepared):
+                tasks.append((i, variant, (location, args, invocation.cwd, env)))
+        invocations = replayed
+        if not invocations:
+            print('None of the invocations of %s can be replayed' % (tool_name,))
+            sys.exit(1)
+        # alternate which of the configurations goes first, so that neither is favoured
+        order = []
+        for repetition in range(runs):
+            for i in range(0, len(tasks), 2):
+                pair = tasks[i:i + 2]
+                order.extend(pair if repetition % 2 == 0 else reversed(pair))
+
+        results = {}
+        with ProcessPoolExecutor(jobs) as executor:
+            futures = [(i, variant, executor.submit(run_once, *task))
+                       for i, variant, task in order]
+            for i, variant, future in futures:
+                results.setdefault((i, variant), []).append(future.result())
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    report = {'tool': tool_name, 'configurations': list(paths), 'runs': runs,
+              'invocations': [], 'aggregate': {}}
+    ratios = {metric: [] for metric in METRICS}
+    for i, invocation in enumerate(invocations):
+        entry = {'name': invocation.name, 'cwd': invocation.cwd, 'argv': invocation.argv,
+                 'failed': [any(result[3] != 0 for result in results[i, variant])
+                            for variant in (0, 1)]}
+        for index, metric in enumerate(METRICS):
+            comparison = compare([result[index] for result in results[i, 0]],
+                                 [result[index] for result in results[i, 1]])
+            entry[metric] = comparison
+            if comparison['a'] > 0:
+                ratios[metric].append(comparison['b'] / comparison['a'])
+        report['invocations'].append(entry)
+    for metric in METRICS:
+        report['aggregate'][metric] = aggregate(ratios[metric])
+    return report
+
+
+def print_report(report: dict) -> None:
+    print('A: %s\nB: %s\n%s runs of each of %s invocations' % (
+        report['configurations'][0], report['configurations'][1], report['runs'],
+        len(report['invocations'])))
+    print('%-32s %10s %10s %18s %18s %18s' % ('invocation', 'wall A', 'wall B', 'wall B-A',
+                                              'CPU B-A', 'RSS B-A'))
+    for entry in report['invocations']:
+        failed = ' (failed: %s)' % (' and '.join(
+            variant for variant, failed in zip('AB', entry['failed']) if failed),) \
+            if any(entry['failed']) else ''
+        print('%-32s %9.3fs %9.3fs %18s %18s %18s%s' % (
+            entry['name'][:32], entry['wall']['a'], entry['wall']['b'],
+            *('%+.1f%% ±%.1f%%' % (entry[metric]['difference'], entry[metric]['margin'])
+              for metric in METRICS), failed))
+    print('Overall (geometric mean, 95% confidence interval):')
+    for metric in METRICS:
+        summary = report['aggregate'][metric]
+        print('  %-4s %+.1f%% [%+.1f%%, %+.1f%%]' % (metric, summary['difference'],
+                                                     summary['low'], summary['high']))
+
+
+def replay_main(argv: tp.List[str]) -> None:
+    """Entry point of intercept replay"""
+    parser = argparse.ArgumentParser(
+        prog='intercept replay',
+        description='Compare two configurations of a tool on the invocations in it\'s log',
+        usage='intercept replay [options] tool config_a config_b')
+    parser.add_argument('tool', help='name of the tool, whose log will be replayed')
+    parser.add_argument('config_a', help='path to the first configuration, in JSON')
+    parser.add_argument('config_b', help='path to the second configuration, in JSON')
+    parser.add_argument('--runs', type=int, default=5, help='how many times to run each')
+    parser.add_argument('--jobs', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='how many runs to do at once')
+    parser.add_argument('--limit', type=int, default=20,
+                        help='how many of the last distinct invocations to replay')
+    parser.add_argument('--log', help='the log to read instead of the tool\'s')
+    parser.add_argument('--json', action='store_true', help='output the report as JSON')
+    args = parser.parse_args(argv)
+    if args.runs < 1 or args.jobs < 1 or args.limit < 1:
+        parser.error('--runs, --jobs and --limit have to be positive')
+    report = replay(args.tool, (args.config_a, args.config_b), args.runs, args.jobs,
+                    args.limit, args.log)
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_report(report)
@@ -0,0 +1,337 @@
+#
+# Response files (@file arguments): applying the rules to their contents, and spilling
+# command lines too long to be exec'd into them.
+#
+# Response files are parsed the way GCC's libiberty does it, which Clang's GNU mode agrees
+# with except for backslashes inside single quotes. Arguments are whitespace separated,
+# single and double quotes group them, and a backslash escapes any following character.
+# Unlike in libiberty, non-ASCII whitespace separates arguments as well.
+# Response files are written with backslash escapes only, which both of them read the same.
+#
+# They are streamed in chunks, so that memory use does not depend on their size.
+#
+# This is imported by the wrappers of tools that have "response_files" enabled, so only
+# cheap parts of the standard library may be imported at module level here.
+#
+import os
+import sys
+
+from interceptor.supervise import Child, exit_like
+
+CHUNK_SIZE = 1024 * 1024
+
+_patterns = None
+
+
+def patterns() -> dict:
+    """
+    :return: the regular expressions used to read and to write response files
+    """
+    global _patterns
+    if _patterns is None:
+        import re
+        # written so that a failed match backtracks over a single argument at most
+        argument = r'''[^\s'"\\]*(?:(?:\\[\s\S]|'[^'\\]*(?:\\[\s\S][^'\\]*)*'|''' \
+                   r'''"[^"\\]*(?:\\[\s\S][^"\\]*)*")[^\s'"\\]*)*'''
+        _patterns = {
+            # a single argument
+            'argument': re.compile(argument),
+            # the longest prefix made up of whole arguments followed by whitespace
+            'complete': re.compile(r'(?:\s*(?=\S)%s(?=\s))*' % (argument,)),
+            # arguments in such a prefix
+            'arguments': re.compile(r'\s*((?=\S)%s)' % (argument,)),
+            # characters that have to be escaped
+            'special': re.compile(r'''([\s'"\\])'''),
+        }
+        for quote_char in '\'"':
+            # text where quote_char is the only special character, and it quotes no whitespace
+            _patterns['balanced' + quote_char] = re.compile(
+                r'[^{0}]*(?:{0}[^{0}\s]*{0}[^{0}]*)*'.format(quote_char))
+            # an empty argument, made up of quote_chars only
+            _patterns['empty' + quote_char] = re.compile(
+                r'(?<!\S)(?:{0}{0})+(?!\S)'.format(quote_char))
+    return _patterns
+
+
+def split(text: str):
+    """
+    Split the contents of a response file into arguments, one character at a time.
+
+    An unterminated quote extends to the end of text, like in libiberty.
+
+    :return: a generator of arguments
+    """
+    arg = []
+    in_arg = squote = dquote = bsquote = False
+    for c in text:
+        if c.isspace() and not (squote or dquote or bsquote):
+            if in_arg:
+                yield ''.join(arg)
+                arg = []
+                in_arg = False
+            continue
+        in_arg = True
+        if bsquote:
+            bsquote = False
+            arg.append(c)
+        elif c == '\\':
+            bsquote = True
+        elif squote:
+            if c == "'":
+                squote = False
+            else:
+                arg.append(c)
+        elif dquote:
+            if c == '"':
+                dquote = False
+            else:
+                arg.append(c)
+        elif c == "'":
+            squote = True
+        elif c == '"':
+            dquote = True
+        else:
+            arg.append(c)
+    if in_arg:
+        yield ''.join(arg)
+
+
+def unquote(arg: str) -> str:
+    """Remove the quotes and backslashes from a single, complete argument"""
+    if '\\' not in arg:
+        if '"' not in arg:
+            return arg.replace("'", '')
+        if "'" not in arg:
+            return arg.replace('"', '')
+    return next(split(arg))
+
+
+def unquote_words(text: str, words: list):
+    """
+    Turn words, that text has been split into by str.split(), into arguments.
+
+    :return: the arguments, or None if there is whitespace within quotes, so that
+        str.split() won't do
+    """
+    if '\\' not in text and ("'" not in text or '"' not in text):
+        # there is a single kind of quotes, so all of them can be removed at once
+        quote_char = '"' if '"' in text else "'"
+        if not patterns()['balanced' + quote_char].fullmatch(text):
+            return None
+        if quote_char * 2 not in text or not patterns()['empty' + quote_char].search(text):
+            return text.replace(quote_char, '').split()
+
+    argument = patterns()['argument']
+    if not all(argument.fullmatch(word) for word in words
+               if "'" in word or '"' in word or '\\' in word):
+        return None
+    return [unquote(word) if "'" in word or '"' in word or '\\' in word else word
+            for word in words]
+
+
+def read_chunks(path: str, chunk_size: int = CHUNK_SIZE):
+    """
+    Read the response file at path, chunk_size characters at a time.
+
+    :return: a generator of tuples of (a piece of the file made up of whole arguments,
+        the arguments in it)
+    :raises OSError: the file cannot be read
+    """
+    with open(path, 'r', encoding='utf-8', errors='surrogateescape') as f_in:
+        buffer = ''
+        while True:
+            chunk = f_in.read(chunk_size)
+            if not chunk:
+                if buffer:
+                    yield buffer, list(split(buffer))
+                return
+            buffer += chunk
+            # the last argument may go on in the next chunk, so it's left in the buffer
+            if buffer[-1].isspace():
+                end = len(buffer)
+                args = buffer.split()
+            else:
+                head = buffer.rsplit(None, 1)
+                end = len(buffer) - len(head[-1])
+                args = head[0].split() if len(head) == 2 else []
+            if "'" in buffer or '"' in buffer or '\\' in buffer:
+                args = unquote_words(buffer[:end], args)
+                if args is None:
+                    end = patterns()['complete'].match(buffer).end()
+                    args = [unquote(arg) if "'" in arg or '"' in arg or '\\' in arg else arg
+                            for arg in patterns()['arguments'].findall(buffer, 0, end)]
+            if end:
+                yield buffer[:end], args
+                buffer = buffer[end:]
+
+
+def read_arguments(path: str, chunk_size: int = CHUNK_SIZE):
+    """
+    Read the arguments from the response file at path, chunk_size characters at a time.
+
+    :return: a generator of arguments
+    :raises OSError: the file cannot be read
+    """
+    for _, args in read_chunks(path, chunk_size):
+        yield from args
+
+
+def quote(arg: str) -> str:
+    """Quote arg for a response file"""
+    return patterns()['special'].sub(r'\\\1', arg) or "''"
+
+
+def quote_all(args: list) -> str:
+    """Quote args for a response file, one per line"""
+    text = '\n'.join(args)
+    if "'" in text or '"' in text or '\\' in text or text.split() != args:
+        if '' in args or '\0' in text:
+            return '\n'.join(map(quote, args))
+        # escape all of them at once, with NULs standing in for the newlines between them
+        text = patterns()['special'].sub(r'\\\1', '\0'.join(args)).replace('\0', '\n')
+    return text
+
+
+def create_temporary_file() -> tuple:
+    """
+    Create a new, empty response file in $TMPDIR.
+
+    :return: a tuple of (file opened for writing, it's path)
+    """
+    directory = os.environ.get('TMPDIR') or '/tmp'
+    for i in range(100):
+        path = os.path.join(directory, 'interceptor-%s-%s.rsp' % (os.getpid(), i))
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600)
+        except FileExistsError:
+            continue
+        return open(fd, 'w', encoding='utf-8', errors='surrogateescape',
+                    buffering=CHUNK_SIZE), path
+    raise FileExistsError('cannot create a response file in %s' % (directory,))
+
+
+class ResponseFileRewriter:
+    """
+    Applies a rewriter's rules to disable and to replace arguments to the response files
+    given as @file arguments, including response files nested in them.
+
+    A response file that needs no change is passed on as is, otherwise a rewritten copy
+    is written and it's path is appended to temporary_files, for the caller to remove once
+    the tool has exited. Chunks of the response file that no rule applies to are copied
+    verbatim.
+
+    Arguments in response files are not deduplicated, and they are kept in present only if
+    they are to be appended or prepended, so that memory use does not depend on their count.
+    """
+
+    def __init__(self, rewriter, notes: list = None, temporary_files: list = None):
+        self.rewriter = rewriter
+        self.notes = notes
+        self.temporary_files = [] if temporary_files is None else temporary_files
+        self.to_add = frozenset(rewriter.to_append) | frozenset(rewriter.to_prepend)
+        self.to_rewrite = rewriter.to_disable | frozenset(rewriter.replacements)
+        self.expanding = set()
+
+    def __call__(self, arg: str, present: set = None) -> str:
+        path = arg[1:]
+        real_path = os.path.realpath(path)
+        if real_path in self.expanding or not os.path.isfile(path):
+            # GCC passes on @file arguments that don't name a file
+            return arg
+
+        self.expanding.add(real_path)
+        try:
+            new_path = self.rewrite_file(path, present)
+        except OSError as e:
+            sys.stderr.write('interceptor: cannot rewrite %s: %s\n' % (path, e))
+            return arg
+        finally:
+            self.expanding.discard(real_path)
+
+        if new_path is None:
+            return arg
+        self.temporary_files.append(new_path)
+        return '@' + new_path
+
+    def rewrite_file(self, path: str, present: set = None):
+        """
+        :return: path of the rewritten copy of the response file at path, or None if it needs
+            no change
+        :raises OSError: the response file cannot be read, or it's copy cannot be written
+        """
+        f_out, new_path = create_temporary_file()
+        changed = False
+        # without pattern rules and notes, a chunk can be rewritten by a list comprehension
+        simple = self.rewriter.pattern_source is None and self.notes is None
+        to_disable = self.rewriter.to_disable
+        replacements = self.rewriter.replacements
+        try:
+            with f_out:
+                for text, args in read_chunks(path):
+                    if not simple or '@' in text:
+                        new_args = list(self.rewriter.filter(args, self.notes, None, self))
+                    elif self.to_rewrite.isdisjoint(args):
+                        new_args = args
+                    else:
+                        new_args = [replacements.get(arg, arg) for arg in args
+                                    if arg not in to_disable]
+                    if present is not None:
+                        present.update(self.to_add.intersection(new_args))
+                    if new_args == args:
+                        f_out.write(text)
+                    else:
+                        changed = True
+                        # text may end in the middle of whitespace, or be followed by it
+                        f_out.write('\n%s\n' % (quote_all(new_args),))
+        except BaseException:
+            os.unlink(new_path)
+            raise
+
+        if not changed:
+            os.unlink(new_path)
+            return None
+        return new_path
+
+
+def spill(args: list, temporary_files: list) -> list:
+    """
+    Move all the arguments but the process name into a response file.
+
+    :param temporary_files: list to append the path of the response file to
+    :return: the new command line
+    """
+    f_out, path = create_temporary_file()
+    temporary_files.append(path)
+    with f_out:
+        f_out.write(quote_all(args[1:]) + '\n')
+    return [args[0], '@' + path]
+
+
+def exceeds_arg_max(args: list) -> bool:
+    """Whether args, together with the environment, are too long to be exec'd"""
+    size = 0
+    for arg in args:
+        size += len(os.fsencode(arg)) + 9
+    for key, value in os.environb.items():
+        size += len(key) + len(value) + 10
+    return size > os.sysconf('SC_ARG_MAX') - 4096 or \
+        any(len(arg) >= 32 * 4096 for arg in args)
+
+
+def remove_files(paths: list) -> None:
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def run_and_remove(location: str, args: list, temporary_files: list) -> None:
+    """
+    Run the tool as a child, remove temporary_files once it has exited and exit the same way
+    it did.
+    """
+    child = Child(location, args)
+    status, _, _ = child.wait()
+    remove_files(temporary_files)
+    exit_like(status)
@@ -0,0 +1,166 @@
+#
+# Imported by every generated wrapper, so keep the imports cheap. re and fnmatch are only
+# imported if the configuration actually contains any pattern rules.
+#
+
+
+def compile_replacements(args_to_replace) -> dict:
+    """
+    Fold a list of (argument, replacement) rules, applied one after another, into a single
+    mapping of an original argument to it's final value.
+    """
+    replacements = {}
+    for arg_to_replace, arg_to_replace_with in args_to_replace:
+        for arg, replaced_with in replacements.items():
+            if replaced_with == arg_to_replace:
+                replacements[arg] = arg_to_replace_with
+        if arg_to_replace not in replacements:
+            replacements[arg_to_replace] = arg_to_replace_with
+    return {arg: replaced_with for arg, replaced_with in replacements.items()
+            if arg != replaced_with}
+
+
+def translate_pattern(pattern: str) -> str:
+    """
+    Turn a pattern rule into a regular expression.
+
+    Patterns starting with re: are regular expressions, everything else is a shell-style glob.
+    """
+    if pattern.startswith('re:'):
+        return '(?:%s)' % (pattern[3:],)
+    import fnmatch
+    return fnmatch.translate(pattern)
+
+
+class Rewriter:
+    """
+    The argument rules of a configuration compiled into hash lookups and a single regular
+    expression, so that a command line is rewritten in one pass.
+
+    The result is the same as applying the rules one after another: arguments to disable are
+    removed first, then the remaining ones are replaced, then arguments to append and to prepend
+    are added if they are not already present, and finally, if deduplication is enabled,
+    only the first occurrence of each argument is kept.
+
+    Pattern rules match whole arguments. An argument matching a pattern to disable is
+    removed, an argument matching a pattern to replace (and not replaced by an exact rule)
+    is replaced. If an argument matches multiple patterns to replace, the first one wins.
+    """
+
+    def __init__(self, args_to_disable=(), args_to_append=(), args_to_prepend=(),
+                 args_to_replace=(), patterns_to_disable=(), patterns_to_replace=(),
+                 deduplication: bool = False):
+        self.to_disable = frozenset(args_to_disable)
+        self.to_append = list(args_to_append)
+        self.to_prepend = list(args_to_prepend)
+        self.replacements = compile_replacements(args_to_replace)
+        self.deduplication = deduplication
+
+        groups = []
+        if patterns_to_disable:
+            groups.append('(?P<d>%s)' % ('|'.join(map(translate_pattern, patterns_to_disable)),))
+        self.pattern_replacements = {}
+        for i, (pattern, replace_with) in enumerate(patterns_to_replace):
+            groups.append('(?P<r%s>%s)' % (i, translate_pattern(pattern)))
+            self.pattern_replacements['r%s' % (i,)] = replace_with
+        self.pattern_source = '|'.join(groups) or None
+        self._pattern = None
+
+    def to_plan(self) -> tuple:
+        """Return this rewriter as a marshallable tuple, to be loaded with from_plan()"""
+        return (self.to_disable, self.to_append, self.to_prepend, self.replacements,
+                self.deduplication, self.pattern_source, self.pattern_replacements)
+
+    @classmethod
+    def from_plan(cls, plan: tuple) -> 'Rewriter':
+        rewriter = cls.__new__(cls)
+        rewriter.to_disable, rewriter.to_append, rewriter.to_prepend, rewriter.replacements, \
+            rewriter.deduplication, rewriter.pattern_source, rewriter.pattern_replacements = plan
+        rewriter._pattern = None
+        return rewriter
+
+    @property
+    def pattern(self):
+        if self._pattern is None and self.pattern_source is not None:
+            import re
+            self._pattern = re.compile(self.pattern_source)
+        return self._pattern
+
+    def filter(self, arguments, notes: list = None, present: set = None, expand=None):
+        """
+        Apply the rules to disable and to replace arguments to arguments, one by one.
+
+        :param notes: a list to append descriptions of actions taken to, if given
+        :param present: the arguments yielded so far, that this will update. If it's given
+            and deduplication is enabled, arguments already in it will be skipped.
+        :param expand: a callable that will be given each argument starting with @ that is
+            left after the rules were applied, together with present, and that returns the
+            argument to use instead
+        :return: a generator of the resulting arguments
+        """
+        to_disable = self.to_disable
+        replacements = self.replacements
+        deduplication = self.deduplication and present is not None
+        match = self.pattern.fullmatch if self.pattern_source is not None else None
+
+        for arg in arguments:
+            if arg in to_disable:
+                if notes is not None:
+                    notes.append('taking away %s' % (arg,))
+                continue
+
+            matched = match(arg) if match is not None else None
+            if matched is not None and matched.lastgroup == 'd':
+                if notes is not None:
+                    notes.append('taking away %s' % (arg,))
+                continue
+
+            if arg in replacements:
+                if notes is not None:
+                    notes.append('replacing %s with %s' % (arg, replacements[arg]))
+                arg = replacements[arg]
+            elif matched is not None:
+                replace_with = self.pattern_replacements[matched.lastgroup]
+                if notes is not None:
+                    notes.append('replacing %s with %s' % (arg, replace_with))
+                arg = replace_with
+
+            if expand is not None and arg[:1] == '@':
+                arg = expand(arg, present)
+
+            if present is not None:
+                if deduplication and arg in present:
+                    continue
+                present.add(arg)
+            yield arg
+
+    def rewrite(self, arguments, notes: list = None, expand=None) -> list:
+        """
+        Apply the rules to arguments (without the process name).
+
+        :param notes: a list to append descriptions of actions taken to, if given
+        :param expand: a callable to rewrite arguments starting with @ with, see filter()
+        :return: a new list of arguments
+        """
+        present = set()
+        result = list(self.filter(arguments, notes, present, expand))
+
+        for arg_to_append in self.to_append:
+            if arg_to_append not in present:
+                if notes is not None:
+                    notes.append('appending %s' % (arg_to_append,))
+                present.add(arg_to_append)
+                result.append(arg_to_append)
+
+        prepended = []
+        for arg_to_prepend in reversed(self.to_prepend):
+            if arg_to_prepend not in present:
+                if notes is not None:
+                    notes.append('prepending %s' % (arg_to_prepend,))
+                present.add(arg_to_prepend)
+                prepended.append(arg_to_prepend)
+
+        if prepended:
+            prepended.reverse()
+            result = prepended + result
+        return result
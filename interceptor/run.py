@@ -7,16 +7,21 @@ from interceptor.config import Configuration
 from satella.files import write_to_file, read_in_file
 
 from interceptor.intercepting import intercept_tool, unintercept_tool, assert_intercepted, check, \
-    abort, link, assert_etc_interceptor_d_exists, edit, reset, configure
+    abort, link, assert_etc_interceptor_d_exists, edit, reset, configure, refreeze, \
+    intercept_tools, intercept_toolchain
 
 
 def banner():
     print('''Usage:
     * intercept foo - intercept foo
+    * intercept foo --multicall - intercept foo with a symlink to the shared multi-call dispatcher
+    * intercept --tools foo bar baz - intercept foo, bar and baz, or none of them if any of them fails
+    * intercept --toolchain gcc - intercept all tools of gcc (or clang), including versioned ones
     * intercept undo foo - cancel intercepting foo
     * intercept configure foo - type in the configuration for foo in JSON format, end with Ctrl+D
     * intercept show foo - show the configuration for foo
     * intercept status foo - display foo's status of interception and details about it's configuration
+    * intercept status --all - audit every intercepted tool and configuration, add --json for JSON
     * intercept display foo - enable displaying what is launched on foo's startup
     * intercept hide foo - disable displaying what is launched on foo's startup
     * intercept edit foo - launch a nano/vi to edit it's configuration
@@ -24,8 +29,16 @@ def banner():
     * intercept prepend foo ARG - add ARG to be prepended to command line whenever foo is ran
     * intercept disable foo ARG - add ARG to be eliminated from the command line whenever foo is ran
     * intercept replace foo ARG1 ARG2 - add ARG1 to be replaced with ARG2 whenever it is passed to foo
+    * intercept disable-matching foo PATTERN - eliminate all arguments matching PATTERN
+    * intercept replace-matching foo PATTERN ARG - replace all arguments matching PATTERN with ARG
     * intercept notify foo - display a notification each time an argument action is taken
     * intercept unnotify foo - hide the notification each time an argument action is taken
+    * intercept enable-deduplication foo - pass only the first occurrence of each argument to foo
+    * intercept disable-deduplication foo - pass foo's arguments however often they occur
+    * intercept dedup-paths foo - remove repeated search paths and macro definitions from foo's command lines
+    * intercept no-dedup-paths foo - stop removing repeated search paths and macro definitions
+    * intercept drop-missing-dirs foo - with dedup-paths, also remove search paths that don't exist
+    * intercept keep-missing-dirs foo - with dedup-paths, keep search paths that don't exist
     * intercept link foo bar - symlink bar's config file to that of foo
     * intercept copy foo bar - copy foo's configuration onto that of bar
     * intercept backup foo - back up foo's config
@@ -33,6 +46,47 @@ def banner():
     * intercept reset foo - reset foo's configuration (delete it and create a new one)
     * intercept log foo - enable logging to /var/log/interceptor.d for foo
     * intercept unlog foo - disable logging to /var/log/interceptor.d for foo
+    * intercept freeze foo - precompile foo's configuration so that it's wrapper reads no JSON
+    * intercept unfreeze foo - make foo's wrapper read it's JSON configuration again
+    * intercept measure foo - record the time and memory taken by each run of foo
+    * intercept unmeasure foo - stop recording the time and memory taken by foo
+    * intercept response-files foo - apply the rules to @file arguments, and use them for long command lines
+    * intercept no-response-files foo - stop looking into foo's @file arguments
+    * intercept cache-results foo - restore the outputs of foo's compilations from a cache when their inputs didn't change
+    * intercept no-cache-results foo - stop caching the outputs of foo's compilations
+    * intercept cache-probes foo - answer repeated queries such as foo --version or foo -dumpmachine from a cache
+    * intercept no-cache-probes foo - stop answering foo's queries from a cache
+    * intercept project-overrides foo - apply the .interceptor/foo files found from the working directory on top of foo's configuration
+    * intercept no-project-overrides foo - use only foo's own configuration
+    * intercept offload foo - have foo's compilations done by intercept worker processes, when one of them is free
+    * intercept no-offload foo - compile foo's files locally again
+    * intercept offload-workers foo [ADDRESS...] - set the workers to offload to, as unix:PATH or tcp:HOST:PORT, none for the local one
+    * intercept max-concurrent foo N - let at most N runs of foo go on at once machine-wide, 0 for no limit
+    * intercept min-memory foo MiB - start foo only with MiB of memory available, 0 for no limit
+    * intercept nice foo N - run foo with it's nice level raised by N
+    * intercept affinity foo CPUS - run foo on CPUS only, eg. 0-7,16-23 or node:0 for a NUMA node, empty to remove
+    * intercept ionice foo CLASS[:LEVEL] - run foo with an I/O priority, eg. idle or best-effort:7, empty to remove
+    * intercept rlimit foo NAME [SOFT [HARD]] - run foo with a resource limit, eg. AS or NOFILE, -1 for unlimited
+    * intercept setenv foo NAME=VALUE - run foo with an environment variable set
+    * intercept unsetenv foo NAME - run foo with an environment variable unset
+    * intercept launcher foo [CMD...] - run foo through a launcher such as ccache, none to remove it
+    * intercept parallelism foo [KEY=VALUE...] - set the job count of a build driver (make, ninja, cmake --build) from the CPUs, load and memory available at each run
+    * intercept no-parallelism foo - leave the job count of foo as it's given
+    * intercept cache stats - display the cache's hits, misses and size
+    * intercept cache clear - remove everything from the cache
+    * intercept stats foo - summarize the time and memory taken by foo's runs
+    * intercept replay foo A.json B.json - compare two configurations of foo on it's logged calls, see intercept replay foo --help
+    * intercept rewrite-compdb foo IN OUT - apply foo's rules to a compilation database such as compile_commands.json, see intercept rewrite-compdb --help
+    * intercept bench foo - measure how much intercepting foo costs, see intercept bench foo --help
+    * intercept bench-parallelism - compare a simulated build with fixed job counts and with a parallelism policy, see intercept bench-parallelism --help
+    * intercept trace export DIR [OUT] - merge the runs traced to DIR into a Chrome trace, trace.json by default
+    * intercept multicall convert - turn every intercepted tool into a symlink to the multi-call dispatcher
+    * intercept multicall revert - turn every multi-call symlink back into a wrapper script of it's own
+    * intercept daemon run - run a daemon that rewrites arguments for the wrappers
+    * intercept daemon stats - display how many requests the daemon served and how fast
+    * intercept watch run - intercept the tools again as soon as package upgrades replace their wrappers
+    * intercept worker run [--listen ADDRESS] [--jobs N] - run a worker that compiles files for the wrappers of tools that offload
+    * intercept worker stats [ADDRESS...] - display how many compilations were offloaded, and how much local CPU time it saved
 Use the optional switch --force is you need a command to complete despite the command telling you
 that it is impossible to complete. One trick: already intercepted files won't be intercepted, because
 that would lead to overwriting of the original executable, so interceptor won't do that.
@@ -44,13 +98,20 @@ def run():
     interceptor_path = Configuration.interceptor_path()
 
     if len(sys.argv) == 2:
+        if sys.argv[1] in ('--tools', '--toolchain'):
+            banner()
+            sys.exit(1)
         intercept_tool(sys.argv[1])
     elif len(sys.argv) >= 3:
         op_name = sys.argv[1]
         app_name = sys.argv[2]
         target_name = sys.argv[3] if len(sys.argv) >= 4 else None
 
-        if op_name == 'undo':
+        if op_name == '--toolchain':
+            intercept_toolchain(app_name)
+        elif op_name == '--tools':
+            intercept_tools(sys.argv[2:])
+        elif op_name == 'undo':
             unintercept_tool(app_name)
         elif op_name == 'configure':
             assert_intercepted(app_name)
@@ -62,6 +123,7 @@ def run():
                 abort()
             write_to_file(os.path.join(interceptor_path, app_name), data,
                           'utf-8')
+            refreeze(app_name)
             print('Configuration successfully written')
         elif op_name == 'show':
             assert_intercepted(app_name)
@@ -69,11 +131,24 @@ def run():
                                   'utf-8')
             print(config)
         elif op_name == 'status':
-            check(app_name, add_config=False)
+            if app_name == '--all':
+                from interceptor.audit import print_audit
+                print_audit(as_json=target_name == '--json')
+            else:
+                check(app_name, add_config=False)
         elif op_name == 'edit':
             edit(app_name)
         elif op_name in ('append', 'prepend', 'disable', 'replace', 'display',
-                         'hide', 'notify', 'unnotify', 'log', 'unlog'):
+                         'hide', 'notify', 'unnotify', 'log', 'unlog', 'freeze', 'unfreeze',
+                         'disable-matching', 'replace-matching', 'measure', 'unmeasure',
+                         'response-files', 'no-response-files', 'cache-results',
+                         'no-cache-results', 'cache-probes', 'no-cache-probes', 'offload',
+                         'no-offload', 'offload-workers', 'max-concurrent', 'min-memory',
+                         'nice', 'affinity', 'ionice', 'rlimit', 'setenv', 'unsetenv',
+                         'launcher', 'parallelism', 'no-parallelism', 'project-overrides',
+                         'no-project-overrides', 'enable-deduplication',
+                         'disable-deduplication', 'dedup-paths', 'no-dedup-paths',
+                         'drop-missing-dirs', 'keep-missing-dirs'):
             configure(op_name, app_name, target_name)
         elif op_name == 'link':
             link(app_name, target_name)
@@ -81,6 +156,68 @@ def run():
             link(app_name, target_name, copy=True)
         elif op_name == 'reset':
             reset(app_name)
+        elif op_name == 'stats':
+            from interceptor.stats import print_stats
+            print_stats(app_name)
+        elif op_name == 'replay':
+            from interceptor.replay import replay_main
+            replay_main(sys.argv[2:])
+        elif op_name == 'rewrite-compdb':
+            from interceptor.compdb import rewrite_compdb_main
+            rewrite_compdb_main(sys.argv[2:])
+        elif op_name == 'bench-parallelism':
+            from interceptor.bench import parallelism_main
+            parallelism_main(sys.argv[2:])
+        elif op_name == 'bench':
+            from interceptor.bench import bench_main
+            bench_main(sys.argv[2:])
+        elif op_name == 'daemon':
+            from interceptor.daemon import run_daemon, print_daemon_stats
+            if app_name == 'run':
+                run_daemon()
+            elif app_name == 'stats':
+                print_daemon_stats()
+            else:
+                print('Unrecognized daemon command %s' % (app_name,))
+                banner()
+                sys.exit(1)
+        elif op_name == 'watch':
+            if app_name == 'run':
+                from interceptor.watch import run_watch
+                run_watch()
+            else:
+                print('Unrecognized watch command %s' % (app_name,))
+                banner()
+                sys.exit(1)
+        elif op_name == 'worker':
+            from interceptor.worker import worker_main
+            worker_main(sys.argv[2:])
+        elif op_name == 'cache':
+            from interceptor.cache import print_cache_stats, clear_cache
+            if app_name == 'stats':
+                print_cache_stats()
+            elif app_name == 'clear':
+                clear_cache()
+            else:
+                print('Unrecognized cache command %s' % (app_name,))
+                banner()
+                sys.exit(1)
+        elif op_name == 'trace':
+            if app_name == 'export' and target_name:
+                from interceptor.timeline import export_trace
+                export_trace(target_name, sys.argv[4] if len(sys.argv) >= 5 else None)
+            else:
+                print('Unrecognized trace command %s' % (' '.join(sys.argv[2:]),))
+                banner()
+                sys.exit(1)
+        elif op_name == 'multicall':
+            from interceptor.intercepting import convert_wrappers
+            if app_name in ('convert', 'revert'):
+                convert_wrappers(multicall=app_name == 'convert')
+            else:
+                print('Unrecognized multicall command %s' % (app_name,))
+                banner()
+                sys.exit(1)
         elif op_name == 'backup':
             i = 1
             while os.path.exists(os.path.join(interceptor_path,
@@ -98,6 +235,7 @@ def run():
             os.unlink(os.path.join(interceptor_path, app_name))
             shutil.copy(os.path.join(interceptor_path, f'{app_name}.{i}'),
                         os.path.join(interceptor_path, app_name))
+            refreeze(app_name)
             print(f'Restored configuration for {app_name} from save number {i}')
         else:
             print('Unrecognized command %s' % (op_name,))
@@ -0,0 +1,140 @@
+#
+# The code ran by every generated wrapper.
+#
+# Like interceptor.config, only cheap parts of the standard library may be
+# imported at module level here.
+#
+import errno
+import os
+import sys
+import time
+
+# Taken before the rest of interceptor is imported, for intercept bench
+STARTED_AT = time.time()
+
+from interceptor.config import Configuration, load_config_for, assert_correct_version  # noqa
+
+IMPORTED_AT = time.time()
+
+DAEMON_TIMEOUT = 2.0
+
+
+def rewrite_by_daemon(tool_name: str, args: list):
+    """
+    Have the interceptor daemon rewrite args for tool_name.
+
+    :return: a tuple of (configuration, rewritten args, notes), or None if the daemon is not
+        running, failed to answer or left the rewriting to the wrapper
+    """
+    socket_path = Configuration.socket_path()
+    if not os.path.exists(socket_path):
+        return None
+
+    # the socket module imports enum, which alone costs more than it would take us to parse
+    # the configuration by ourselves
+    import _socket
+    from interceptor.protocol import send_message, receive_message
+    try:
+        sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+        try:
+            sock.settimeout(DAEMON_TIMEOUT)
+            sock.connect(socket_path)
+            send_message(sock, ('rewrite', tool_name, args))
+            status, *response = receive_message(sock)
+        finally:
+            sock.close()
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if status != 'ok':
+        return None
+    dct, new_args, notes = response
+    return Configuration.from_json(dct, app_name=tool_name), new_args, notes
+
+
+def run(tool_name: str, location: str, version: str = '') -> None:
+    """
+    Rewrite sys.argv according to tool_name's configuration and exec the real binary.
+
+    :param tool_name: name of the intercepted tool
+    :param location: path to the original executable, ie. foo-intercepted
+    :param version: version of interceptor that generated the wrapper
+    """
+    assert_correct_version(version)
+    if 'INTERCEPTOR_CHAIN' in os.environ:
+        # returns only if a wrapper up the chain has not done all that this one would do
+        from interceptor.chain import pass_through
+        pass_through(tool_name, location, sys.argv)
+    temporary_files = []
+    response = rewrite_by_daemon(tool_name, sys.argv)
+    if response is None:
+        cfg = load_config_for(tool_name, None, project=True)
+        loaded_at = time.time()
+        args = cfg.modify(sys.argv, temporary_files=temporary_files)
+    else:
+        loaded_at = time.time()
+        cfg, args, notes = response
+        cfg.report(sys.argv, args, notes)
+
+    modified_at = time.time()
+    profile_path = os.environ.get('INTERCEPTOR_PROFILE')
+    if profile_path:
+        write_profile(profile_path, (STARTED_AT, IMPORTED_AT, loaded_at, modified_at))
+
+    if cfg.has_resource_controls:
+        from interceptor.controls import apply_resource_controls
+        apply_resource_controls(cfg)
+    if cfg.parallelism:
+        # after the resource controls, so that the job count follows the CPU affinity
+        from interceptor.parallelism import apply_parallelism
+        args = apply_parallelism(cfg, args)
+    from interceptor.chain import mark_chain
+    mark_chain(tool_name, args)
+    if cfg.probe_cache:
+        # returns only if args is not a probe
+        from interceptor.probes import answer_probe
+        answer_probe(cfg, location, args)
+    if cfg.offload:
+        # returns only if args was not compiled by a worker
+        from interceptor.offload import run_offloaded
+        run_offloaded(cfg, location, args)
+    if cfg.max_concurrent or cfg.min_available_memory:
+        # the slot is held by a descriptor that the tool inherits
+        from interceptor.slots import acquire_slot
+        acquire_slot(cfg)
+    if cfg.cache:
+        # returns only if args cannot be cached
+        from interceptor.cache import run_cached
+        run_cached(cfg, location, args)
+    if cfg.launcher:
+        from interceptor.controls import apply_launcher
+        location, args = apply_launcher(cfg, location, args)
+    trace_path = os.environ.get('INTERCEPTOR_TRACE')
+    if cfg.measure or trace_path:
+        from interceptor.metrics import run_measured
+        if cfg.response_files:
+            from interceptor.response_files import exceeds_arg_max, spill
+            if exceeds_arg_max(args):
+                args = spill(args, temporary_files)
+        run_measured(cfg, location, args, temporary_files, trace_path)
+    if temporary_files:
+        from interceptor.response_files import run_and_remove
+        run_and_remove(location, args, temporary_files)
+    try:
+        os.execv(location, args)
+    except OSError as e:
+        if e.errno != errno.E2BIG or not cfg.response_files:
+            raise
+    from interceptor.response_files import run_and_remove, spill
+    args = spill(args, temporary_files)
+    run_and_remove(location, args, temporary_files)
+
+
+def write_profile(path: str, timestamps: tuple) -> None:
+    """
+    Record when each phase of running the wrapper has finished, for intercept bench.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, (' '.join(map(repr, timestamps)) + '\n').encode('ascii'))
+    finally:
+        os.close(fd)
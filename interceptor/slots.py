@@ -0,0 +1,251 @@
+#
+# Machine-wide concurrency slots: a tool with max_concurrent set may only run that many times
+# at once, and a tool with min_available_memory set is only started when the machine has
+# that much memory available.
+#
+# A slot is a file in /var/run/interceptor/slots/<tool> that is locked with flock. The lock
+# is held by the descriptor that the wrapper leaves open across exec, so it's released when
+# the tool exits, however it does. Wrappers waiting for a slot line up on the lock of the
+# queue file, and only the one at it's head polls the slots, so that they get them roughly
+# in the order they came in. Tools whose configurations are symlinked to the same file share
+# their slots.
+#
+# The directories of the slots held up the process tree are exported in INTERCEPTOR_SLOTS, and
+# a wrapper whose slots are among them runs it's tool without taking another one, since it's
+# ancestor's slot is not released before it exits. Otherwise a tool run by another tool sharing
+# it's slots, such as a compiler driver running the linker, would wait for itself forever once
+# all the slots were taken.
+#
+# If the slots cannot be opened, eg. because /var/run/interceptor is read-only, the tool runs
+# without one. The wrapper warns about it, unless a wrapper up the process tree already did.
+#
+# This is imported by the wrappers of tools that have slots, so only cheap parts of the
+# standard library may be imported at module level here.
+#
+import fcntl
+import os
+import sys
+import time
+
+from interceptor.config import Configuration
+
+POLL_INTERVAL = 0.005
+MAX_POLL_INTERVAL = 0.1
+
+STATISTICS = ('runs', 'waited', 'total_wait', 'max_wait')
+
+# set once a wrapper has warned that the slots cannot be used, so that the tools it runs don't
+WARNED_ENVIRONMENT = 'INTERCEPTOR_NO_SLOTS'
+# the directories of the slots held by wrappers up the process tree, separated by os.pathsep
+HELD_ENVIRONMENT = 'INTERCEPTOR_SLOTS'
+
+
+def slots_path(cfg: Configuration) -> str:
+    """Return the directory of the slots of cfg's tool"""
+    name = os.path.basename(os.path.realpath(cfg.path))
+    return os.path.join(Configuration.run_path(), 'slots', name)
+
+
+def slot_count(cfg: Configuration) -> int:
+    return cfg.max_concurrent or os.cpu_count() or 1
+
+
+def open_lock(path: str, inheritable: bool = False) -> int:
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o666)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o666)
+    if inheritable:
+        os.set_inheritable(fd, True)
+    return fd
+
+
+def try_lock(fd: int) -> bool:
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def available_memory() -> int:
+    """
+    :return: MemAvailable from /proc/meminfo in bytes, or None if it's unknown
+    """
+    try:
+        with open('/proc/meminfo', 'rb') as f_in:
+            for line in f_in:
+                if line.startswith(b'MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def others_running(slot_fds: list, own_fd: int) -> bool:
+    """Whether any slot other than own_fd is taken"""
+    for fd in slot_fds:
+        if fd == own_fd:
+            continue
+        if not try_lock(fd):
+            return True
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    return False
+
+
+def held_slots() -> list:
+    """:return: the directories of the slots held by wrappers up the process tree"""
+    held = os.environ.get(HELD_ENVIRONMENT)
+    return held.split(os.pathsep) if held else []
+
+
+def acquire_slot(cfg: Configuration) -> int:
+    """
+    Wait for a free slot of cfg's tool and take it, unless a wrapper up the process tree holds
+    one of them already.
+
+    A tool that is short on memory is still started if no other run of it is in progress,
+    since waiting for it's own runs to finish would be of no use then.
+
+    :return: the descriptor holding the slot, that is inherited by the tool, or None if the
+        slots cannot be opened or an ancestor holds one
+    """
+    directory = slots_path(cfg)
+    held = held_slots()
+    if directory in held:
+        return None
+    slot_fds = []
+    try:
+        for i in range(slot_count(cfg)):
+            slot_fds.append(open_lock(os.path.join(directory, str(i)), inheritable=True))
+        queue_fd = open_lock(os.path.join(directory, 'queue'))
+    except OSError as e:
+        for fd in slot_fds:
+            os.close(fd)
+        if WARNED_ENVIRONMENT not in os.environ:
+            sys.stderr.write('interceptor(%s): running without a slot: %s\n' % (
+                cfg.app_name, e))
+            os.environ[WARNED_ENVIRONMENT] = '1'
+        return None
+    started_at = time.monotonic()
+    own_fd = None
+    try:
+        fcntl.flock(queue_fd, fcntl.LOCK_EX)
+        interval = POLL_INTERVAL
+        while True:
+            for fd in slot_fds:
+                if try_lock(fd):
+                    if has_memory_for(cfg, slot_fds, fd):
+                        own_fd = fd
+                    else:
+                        fcntl.flock(fd, fcntl.LOCK_UN)
+                    break
+            if own_fd is not None:
+                break
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+    finally:
+        os.close(queue_fd)
+        for fd in slot_fds:
+            if fd != own_fd:
+                os.close(fd)
+
+    record_wait(directory, time.monotonic() - started_at)
+    os.environ[HELD_ENVIRONMENT] = os.pathsep.join(held + [directory])
+    return own_fd
+
+
+def has_memory_for(cfg: Configuration, slot_fds: list, own_fd: int) -> bool:
+    if not cfg.min_available_memory:
+        return True
+    memory = available_memory()
+    if memory is None or memory >= cfg.min_available_memory:
+        return True
+    return not others_running(slot_fds, own_fd)
+
+
+def update_statistics(directory: str, wait: float) -> None:
+    fd = open_lock(os.path.join(directory, 'stats'))
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        statistics = parse_statistics(os.read(fd, 4096))
+        statistics['runs'] += 1
+        if wait >= POLL_INTERVAL:
+            statistics['waited'] += 1
+            statistics['total_wait'] += wait
+            statistics['max_wait'] = max(statistics['max_wait'], wait)
+        data = ('%d %d %r %r\n' % tuple(statistics[name] for name in STATISTICS)).encode('ascii')
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, data)
+        os.ftruncate(fd, len(data))
+    finally:
+        os.close(fd)
+
+
+def record_wait(directory: str, wait: float) -> None:
+    try:
+        update_statistics(directory, wait)
+    except OSError:
+        pass
+
+
+def parse_statistics(data: bytes) -> dict:
+    values = data.split()
+    if len(values) != len(STATISTICS):
+        values = [0, 0, 0.0, 0.0]
+    return {'runs': int(values[0]), 'waited': int(values[1]),
+            'total_wait': float(values[2]), 'max_wait': float(values[3])}
+
+
+def occupancy(cfg: Configuration) -> tuple:
+    """
+    :return: a tuple of (number of slots taken, whether any wrapper is queued for one)
+    """
+    directory = slots_path(cfg)
+    if not os.path.isdir(directory):
+        return 0, False
+    taken = 0
+    for i in range(slot_count(cfg)):
+        path = os.path.join(directory, str(i))
+        if not os.path.exists(path):
+            continue
+        fd = open_lock(path)
+        try:
+            if try_lock(fd):
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                taken += 1
+        finally:
+            os.close(fd)
+    queued = False
+    queue_path = os.path.join(directory, 'queue')
+    if os.path.exists(queue_path):
+        fd = open_lock(queue_path)
+        try:
+            queued = not try_lock(fd)
+        finally:
+            os.close(fd)
+    return taken, queued
+
+
+def print_slots(cfg: Configuration) -> None:
+    if not cfg.max_concurrent and not cfg.min_available_memory:
+        return
+    taken, queued = occupancy(cfg)
+    line = 'Slots: %s of %s taken' % (taken, slot_count(cfg))
+    if cfg.min_available_memory:
+        line += ', started only with %.0f MiB available' % (
+            cfg.min_available_memory / 1024 / 1024,)
+    print(line + (', wrappers are queued' if queued else ''))
+    try:
+        with open(os.path.join(slots_path(cfg), 'stats'), 'rb') as f_in:
+            statistics = parse_statistics(f_in.read())
+    except FileNotFoundError:
+        return
+    if statistics['waited']:
+        print('%s of %s runs waited for a slot, %.2f s on average, %.2f s at most' % (
+            statistics['waited'], statistics['runs'],
+            statistics['total_wait'] / statistics['waited'], statistics['max_wait']))
+    else:
+        print('None of %s runs waited for a slot' % (statistics['runs'],))
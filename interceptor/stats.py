@@ -0,0 +1,145 @@
+import collections
+import heapq
+import json
+import os
+import sys
+import typing as tp
+
+from interceptor.metrics import metrics_file_for
+
+VALUE_FLAGS = ('-I', '-L', '-D', '-U', '-o', '-l', '-isystem', '-iquote', '-idirafter',
+               '-include', '-MF', '-MT', '-MQ', '-Wl,', '-Wa,', '-Wp,', '-Xlinker', '-x')
+
+
+def argument_pattern(args: tp.List[str]) -> str:
+    """
+    Reduce a command line to it's shape, so that invocations differing only in the files
+    they process or the values of their options can be grouped together.
+
+    Options keep their names, but options such as -Ifoo lose their values, and everything
+    else is replaced by a star and it's extension.
+    """
+    pattern = [os.path.basename(args[0])] if args else []
+    for arg in args[1:]:
+        if arg.startswith('-'):
+            for flag in VALUE_FLAGS:
+                if arg.startswith(flag) and arg != flag:
+                    arg = flag + '*'
+                    break
+        else:
+            arg = '*' + os.path.splitext(arg)[1]
+        if not pattern or pattern[-1] != arg:
+            pattern.append(arg)
+    return ' '.join(pattern)
+
+
+class Histogram:
+    """A histogram with buckets growing by powers of two, starting from unit"""
+
+    def __init__(self, unit: float):
+        self.unit = unit
+        self.buckets = collections.Counter()
+
+    def add(self, value: float) -> None:
+        bucket = 0
+        while value >= self.unit * 2 ** bucket:
+            bucket += 1
+        self.buckets[bucket] += 1
+
+    def print(self, format_value: tp.Callable[[float], str], width: int = 50) -> None:
+        if not self.buckets:
+            return
+        most = max(self.buckets.values())
+        for bucket in range(min(self.buckets), max(self.buckets) + 1):
+            count = self.buckets[bucket]
+            print('  < %10s %8s %s' % (format_value(self.unit * 2 ** bucket), count,
+                                       '#' * (count * width // most)))
+
+
+class Group:
+    def __init__(self):
+        self.count = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.max_rss = 0
+
+
+def aggregate(lines: tp.Iterable[str], top: int) -> dict:
+    """Aggregate lines of a metrics file, one at a time"""
+    count = failures = 0
+    wall_total = cpu_total = 0.0
+    wall_histogram = Histogram(0.001)
+    rss_histogram = Histogram(1024)
+    slowest = []  # a min-heap of (wall time, argv) of the slowest invocations
+    groups = collections.defaultdict(Group)
+    for line in lines:
+        try:
+            started_at, wall_time, utime, stime, max_rss, code, args = json.loads(line)
+        except ValueError:
+            continue
+        count += 1
+        failures += int(code != 0)
+        wall_total += wall_time
+        cpu_total += utime + stime
+        wall_histogram.add(wall_time)
+        rss_histogram.add(max_rss)
+        if len(slowest) < top:
+            heapq.heappush(slowest, (wall_time, args))
+        elif wall_time > slowest[0][0]:
+            heapq.heapreplace(slowest, (wall_time, args))
+        group = groups[argument_pattern(args)]
+        group.count += 1
+        group.wall_time += wall_time
+        group.cpu_time += utime + stime
+        group.max_rss = max(group.max_rss, max_rss)
+    return {'count': count,
+            'failures': failures,
+            'wall_total': wall_total,
+            'cpu_total': cpu_total,
+            'wall_histogram': wall_histogram,
+            'rss_histogram': rss_histogram,
+            'slowest': sorted(slowest, reverse=True),
+            'groups': heapq.nlargest(top, groups.items(), key=lambda item: item[1].wall_time)}
+
+
+def format_time(seconds: float) -> str:
+    if seconds < 1:
+        return '%.1f ms' % (seconds * 1000,)
+    return '%.2f s' % (seconds,)
+
+
+def format_size(kib: float) -> str:
+    if kib < 1024:
+        return '%.0f KiB' % (kib,)
+    if kib < 1024 * 1024:
+        return '%.0f MiB' % (kib / 1024,)
+    return '%.1f GiB' % (kib / 1024 / 1024,)
+
+
+def print_stats(app_name: str, top: int = 10) -> None:
+    path = metrics_file_for(app_name)
+    if not os.path.exists(path):
+        print('No metrics were recorded for %s. Enable them with intercept measure %s'
+              % (app_name, app_name))
+        sys.exit(1)
+    with open(path, 'r') as f_in:
+        stats = aggregate(f_in, top)
+    if not stats['count']:
+        print('No metrics were recorded for %s' % (app_name,))
+        return
+
+    print('%s was ran %s times (%s failed), taking %s of wall time and %s of CPU time' % (
+        app_name, stats['count'], stats['failures'], format_time(stats['wall_total']),
+        format_time(stats['cpu_total'])))
+    print('Wall time:')
+    stats['wall_histogram'].print(format_time)
+    print('Max RSS:')
+    stats['rss_histogram'].print(format_size)
+    print('Slowest invocations:')
+    for wall_time, args in stats['slowest']:
+        print('  %10s  %s' % (format_time(wall_time), ' '.join(args)))
+    print('Command lines taking the most time in total:')
+    for pattern, group in stats['groups']:
+        print('  %10s  %6s runs, %10s on average, max RSS %s  %s' % (
+            format_time(group.wall_time), group.count, format_time(group.wall_time / group.count),
+            format_size(group.max_rss), pattern))
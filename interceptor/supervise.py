@@ -0,0 +1,93 @@
+#
+# Running the intercepted tool as a child of the wrapper, instead of exec'ing it directly,
+# for the modes that need to do something after it exits.
+#
+# This is imported by the wrappers, so only cheap parts of the standard library may be
+# imported at module level here.
+#
+import os
+import sys
+import time
+
+# the signal module imports enum, which is too costly to import in a wrapper
+import _signal as signal
+
+FORWARDED_SIGNALS = (signal.SIGHUP, signal.SIGINT, signal.SIGQUIT, signal.SIGTERM,
+                     signal.SIGUSR1, signal.SIGUSR2, signal.SIGWINCH)
+
+
+class Child:
+    """
+    The tool, ran as a child process, that receives every signal sent to the wrapper.
+    """
+
+    def __init__(self, location: str, args: list, env: dict = None, stdout: int = None,
+                 stderr: int = None, stdin: int = None):
+        """
+        :param stdout: descriptor to replace the child's stdout with, if given
+        :param stderr: descriptor to replace the child's stderr with, if given
+        :param stdin: descriptor to replace the child's stdin with, if given
+        """
+        self.pid = None
+        for signum in FORWARDED_SIGNALS:
+            signal.signal(signum, self.forward)
+
+        self.started_at = time.time()
+        self.started_at_monotonic = time.monotonic()
+        pid = os.fork()
+        if not pid:
+            try:
+                if stdout is not None:
+                    os.dup2(stdout, 1)
+                if stderr is not None:
+                    os.dup2(stderr, 2)
+                if stdin is not None:
+                    os.dup2(stdin, 0)
+                if env is None:
+                    os.execv(location, args)
+                else:
+                    os.execve(location, args, env)
+            except BaseException as e:
+                # anything escaping would go on running the wrapper's code in the child
+                try:
+                    sys.stderr.write('interceptor: cannot execute %s: %s\n' % (location, e))
+                finally:
+                    os._exit(127)
+        self.pid = pid
+
+    def forward(self, signum, frame) -> None:
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def wait(self) -> tuple:
+        """
+        Wait for the child to exit.
+
+        :return: a tuple of (wait status, wall time in seconds, resource usage)
+        """
+        _, status, rusage = os.wait4(self.pid, 0)
+        return status, time.monotonic() - self.started_at_monotonic, rusage
+
+
+def exit_like(status: int) -> None:
+    """
+    Terminate the wrapper the same way the child has terminated, given it's wait status.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.WIFSIGNALED(status):
+        signum = os.WTERMSIG(status)
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+        os._exit(128 + signum)  # in case the signal does not terminate us
+    os._exit(os.WEXITSTATUS(status))
+
+
+def exit_code(status: int) -> int:
+    """Return the exit code of a wait status, or minus the signal number that killed it"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
@@ -0,0 +1,13 @@
+#!{EXECUTABLE}
+
+# Generated automatically by interceptor, a tool to intercept calls
+# to the commands and to alter their arguments.
+
+# To learn more visit https://github.com/Dronehub/interceptor
+
+# This is the multi-call dispatcher that intercepted tools are symlinked to.
+
+from interceptor.dispatch import main
+
+if __name__ == '__main__':
+    main()
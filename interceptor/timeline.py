@@ -0,0 +1,217 @@
+"""
+intercept trace export - merge the records written in the tracing mode (see interceptor.trace)
+into a Chrome trace, that chrome://tracing and Perfetto can open, and report the critical path
+and the parallelism of the build.
+
+Runs are nested under the nearest of their ancestors that is a traced run too, so a compiler
+ran by an intercepted make shows up within make's run, even if a shell was in between.
+"""
+import bisect
+import collections
+import json
+import os
+import sys
+import typing as tp
+
+from interceptor.compiler_options import operands
+
+
+class Run:
+    def __init__(self, record: dict):
+        self.tool = record['tool']
+        self.pid = record['pid']
+        self.child = record['child']
+        self.ancestors = record['ancestors']
+        self.start = record['start']
+        self.end = record['end']
+        self.cwd = record['cwd']
+        self.argv = record['argv']
+        self.status = record['status']
+        self.parent = None  # type: tp.Optional[Run]
+        self.children = []  # type: tp.List[Run]
+        self.lane = None  # type: tp.Optional[int]
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    @property
+    def name(self) -> str:
+        """The tool, along with the file it worked on if it's apparent"""
+        files = operands(self.argv[1:])
+        if files:
+            return '%s %s' % (self.tool, os.path.basename(files[0]))
+        return self.tool
+
+
+def load_runs(directory: str) -> tp.List[Run]:
+    """Read every record in directory, skipping lines that are not valid records"""
+    runs = []
+    for entry in os.scandir(directory):
+        if not entry.name.endswith('.trace'):
+            continue
+        with open(entry.path, 'r', encoding='utf-8') as f_in:
+            for line in f_in:
+                try:
+                    runs.append(Run(json.loads(line)))
+                except (ValueError, KeyError, TypeError):
+                    continue
+    runs.sort(key=lambda run: (run.start, -run.end))
+    return runs
+
+
+def link_runs(runs: tp.List[Run]) -> None:
+    """Find the parent of each run, ie. the nearest of it's ancestors that was traced"""
+    by_pid = collections.defaultdict(list)
+    for run in runs:
+        by_pid[run.pid].append(run)
+        if run.child:
+            by_pid[run.child].append(run)
+    for run in runs:
+        for pid in run.ancestors:
+            # pids are reused, so the parent has to be running at the time
+            candidates = [candidate for candidate in by_pid.get(pid, ())
+                          if candidate is not run and candidate.start <= run.start
+                          and candidate.end >= run.end]
+            if candidates:
+                run.parent = candidates[-1]
+                run.parent.children.append(run)
+                break
+
+
+def assign_lanes(runs: tp.List[Run]) -> int:
+    """
+    Put each run on a lane, within it's parent if the parent's lane is free, so that runs
+    on a lane are either nested or apart from each other.
+
+    :return: number of lanes
+    """
+    lanes = []  # type: tp.List[tp.List[Run]]
+    for run in runs:
+        for stack in lanes:
+            while stack and stack[-1].end <= run.start:
+                stack.pop()
+        lane = None
+        if run.parent is not None and lanes[run.parent.lane] \
+                and lanes[run.parent.lane][-1] is run.parent:
+            lane = run.parent.lane
+        else:
+            for i, stack in enumerate(lanes):
+                if not stack:
+                    lane = i
+                    break
+        if lane is None:
+            lane = len(lanes)
+            lanes.append([])
+        lanes[lane].append(run)
+        run.lane = lane
+    return len(lanes)
+
+
+def chrome_trace(runs: tp.List[Run], lanes: int) -> dict:
+    """Return the runs as a Chrome trace, in the JSON object format"""
+    origin = min(run.start for run in runs)
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'build'}}]
+    for lane in range(lanes):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': lane + 1,
+                       'args': {'name': 'lane %s' % (lane + 1,)}})
+    for run in runs:
+        events.append({'name': run.name,
+                       'cat': run.tool,
+                       'ph': 'X',
+                       'pid': 1,
+                       'tid': run.lane + 1,
+                       'ts': (run.start - origin) * 1e6,
+                       'dur': run.duration * 1e6,
+                       'args': {'argv': ' '.join(run.argv),
+                                'cwd': run.cwd,
+                                'pid': run.pid,
+                                'status': run.status,
+                                'parent': run.parent.name if run.parent else None}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def concurrency(runs: tp.List[Run]) -> tp.Dict[int, float]:
+    """
+    :return: how long each number of runs were going on at once, in seconds
+    """
+    changes = sorted([(run.start, 1) for run in runs] + [(run.end, -1) for run in runs])
+    time_at = collections.Counter()
+    running = 0
+    previous = changes[0][0]
+    for moment, change in changes:
+        time_at[running] += moment - previous
+        running += change
+        previous = moment
+    return time_at
+
+
+def critical_path(runs: tp.List[Run]) -> tp.List[Run]:
+    """
+    Find the chain of runs that the build waited on, starting from the one that ended last,
+    and going back each time to the run that ended last before it started.
+
+    There is no record of what the runs depended on, so this is a heuristic: it's the path
+    the build could not have been shorter than, if the runs were ran as soon as possible.
+    """
+    by_end = sorted(runs, key=lambda run: run.end)
+    ends = [run.end for run in by_end]
+    path = [by_end[-1]]
+    while True:
+        i = bisect.bisect_right(ends, path[-1].start)
+        if not i or by_end[i - 1] is path[-1]:
+            break
+        path.append(by_end[i - 1])
+    path.reverse()
+    return path
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds < 1:
+        return '%.0f ms' % (seconds * 1000,)
+    return '%.2f s' % (seconds,)
+
+
+def print_report(runs: tp.List[Run]) -> None:
+    # the runs that did the work, not the ones like make that waited for others
+    leaves = [run for run in runs if not run.children]
+    start = min(run.start for run in runs)
+    end = max(run.end for run in runs)
+    wall = end - start
+    busy = sum(run.duration for run in leaves)
+    print('%s runs, %s of which did the work, in %s' % (len(runs), len(leaves),
+                                                          format_seconds(wall)))
+    print('Average parallelism: %.2f' % (busy / wall if wall else 0,))
+
+    time_at = concurrency(leaves)
+    print('Time spent running:')
+    for count in sorted(time_at):
+        if time_at[count] > 0:
+            print('  %4s at once: %10s (%.1f%%)' % (count, format_seconds(time_at[count]),
+                                                   100 * time_at[count] / wall if wall else 0))
+
+    path = critical_path(leaves)
+    on_path = sum(run.duration for run in path)
+    print('Critical path: %s runs, %s of work and %s of gaps between them' % (
+        len(path), format_seconds(on_path),
+        format_seconds(path[-1].end - path[0].start - on_path)))
+    for run in path:
+        print('  %10s at %10s  %s' % (format_seconds(run.duration),
+                                      format_seconds(run.start - start), run.name))
+
+
+def export_trace(directory: str, output_path: tp.Optional[str] = None) -> None:
+    if not os.path.isdir(directory):
+        print('%s is not a directory' % (directory,))
+        sys.exit(1)
+    runs = load_runs(directory)
+    if not runs:
+        print('No runs were traced in %s' % (directory,))
+        sys.exit(1)
+    link_runs(runs)
+    lanes = assign_lanes(runs)
+    output_path = output_path or 'trace.json'
+    with open(output_path, 'w') as f_out:
+        json.dump(chrome_trace(runs, lanes), f_out)
+    print('Wrote %s runs to %s' % (len(runs), output_path))
+    print_report(runs)
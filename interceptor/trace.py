@@ -0,0 +1,63 @@
+#
+# The tracing mode: with INTERCEPTOR_TRACE pointing to a directory, every wrapper runs it's
+# tool as a child and, once it exits, records when it ran and who ran it. intercept trace
+# export then merges the records into a timeline of the whole build.
+#
+# Each wrapper appends a single line of JSON to a file of it's own in that directory, named
+# after it's pid, so that wrappers never contend for a file:
+#
+# {"tool":..., "pid": the wrapper's pid, "child": the tool's pid, "ancestors": pids of the
+#  wrapper's parent, it's parent and so on, "start": time the tool was started, "end": time the
+#  tool exited, "cwd":..., "argv": the rewritten arguments, "status": exit code}
+#
+# This is imported by the wrappers, so only cheap parts of the standard library may be
+# imported at module level here.
+#
+import os
+
+from interceptor.invocation_log import encode_basestring_ascii, encode_list
+
+TRACE_ENVIRONMENT = 'INTERCEPTOR_TRACE'
+
+# how many ancestors of a wrapper to record, enough to see past make's or ninja's shells
+MAX_ANCESTORS = 8
+
+
+def ancestors(pid: int) -> list:
+    """
+    :return: pids of pid's parent, it's parent and so on, up to MAX_ANCESTORS of them
+    """
+    result = []
+    while len(result) < MAX_ANCESTORS:
+        try:
+            with open('/proc/%d/stat' % (pid,), 'rb') as f_in:
+                stat = f_in.read()
+        except OSError:
+            break
+        # the name of the process may contain spaces and parentheses, so it's skipped
+        pid = int(stat[stat.rindex(b')') + 2:].split(None, 2)[1])
+        if pid <= 1:
+            break
+        result.append(pid)
+    return result
+
+
+def record_trace(directory: str, tool_name: str, started_at: float, ended_at: float,
+                 child_pid: int, status: int, args: list) -> None:
+    """Append a record about a finished run of tool_name to the trace in directory"""
+    from interceptor.supervise import exit_code
+    record = '{"tool":%s,"pid":%d,"child":%d,"ancestors":[%s],"start":%r,"end":%r,' \
+             '"cwd":%s,"argv":%s,"status":%d}\n' % (
+                 encode_basestring_ascii(tool_name), os.getpid(), child_pid,
+                 ','.join(map(str, ancestors(os.getpid()))), started_at, ended_at,
+                 encode_basestring_ascii(os.getcwd()), encode_list(args), exit_code(status))
+    path = os.path.join(directory, '%d.trace' % (os.getpid(),))
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    except FileNotFoundError:
+        os.makedirs(directory, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    try:
+        os.write(fd, record.encode('ascii'))
+    finally:
+        os.close(fd)
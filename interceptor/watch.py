@@ -0,0 +1,180 @@
+"""
+intercept watch run - keep the intercepted tools intercepted.
+
+A package upgrade that replaces an intercepted foo removes it's wrapper, and the builds lose
+their rules without anyone noticing. The watcher keeps an index of every intercepted
+executable, ie. every foo with a foo-intercepted beside it, and watches the directories they
+are in, along with the directory of the configurations, with inotify. When foo is replaced by
+something that is not a wrapper, the new foo becomes foo-intercepted and the wrapper is put
+back in place, the same way intercept foo would do it.
+
+Package managers replace many files at once, so events are collected until none have come
+for QUIET_PERIOD (or for at most MAX_DELAY), and each executable is checked once per such
+burst. A single watch is added per directory, however many tools are in it, and the watcher
+sleeps in between the bursts. The index is rebuilt whenever a configuration is added or
+removed, or the kernel drops events.
+"""
+import os
+import select
+import sys
+import time
+import typing as tp
+
+from interceptor.audit import WORKERS, list_configurations
+from interceptor.config import Configuration
+from interceptor.dispatch import read_registry, registry_key
+from interceptor.index import ExecutableIndex, INTERCEPTED, is_wrapper_file
+from interceptor.inotify import Inotify, IN_IGNORED, IN_Q_OVERFLOW
+
+QUIET_PERIOD = 0.5
+MAX_DELAY = 10.0
+
+
+class Watched:
+    """
+    An intercepted executable.
+
+    :ivar tool_name: name of the tool whose configuration it's wrapper uses
+    :ivar multicall: whether it's wrapper is a symlink to the multi-call dispatcher
+    """
+
+    def __init__(self, path: str, tool_name: str, multicall: bool):
+        self.path = path
+        self.tool_name = tool_name
+        self.multicall = multicall
+
+
+def log(message: str) -> None:
+    print('%s %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), message))
+    sys.stdout.flush()
+
+
+class Watcher:
+    def __init__(self):
+        self.inotify = Inotify()
+        self.config_wd = self.inotify.add_watch(Configuration.interceptor_path())
+        self.directories = {}  # type: tp.Dict[str, int]
+        self.watched = {}  # type: tp.Dict[str, Watched]
+        self.healed = 0
+
+    def rebuild(self) -> tp.List[str]:
+        """
+        Index the intercepted executables again, and watch their directories.
+
+        :return: paths of the executables that have lost their wrappers
+        """
+        from interceptor.intercepting import wrapper_tool_name
+        index = ExecutableIndex(list_configurations(), with_intercepted=True, workers=WORKERS)
+        registry = None
+        watched = {}
+        broken = []
+        for name in index.found_names():
+            for executable in index.paths(name, abort_on_failure=False):
+                if not executable.has_original:
+                    continue
+                previous = self.watched.get(executable.path)
+                if executable.is_wrapper:
+                    try:
+                        tool_name = wrapper_tool_name(executable.path, name)
+                    except (OSError, ValueError):
+                        tool_name = name
+                    watched[executable.path] = Watched(executable.path, tool_name,
+                                                       os.path.islink(executable.path))
+                elif previous is not None:
+                    watched[executable.path] = previous
+                    broken.append(executable.path)
+                else:
+                    # found without it's wrapper, so what it was is told by the registry
+                    if registry is None:
+                        registry = read_registry()
+                    entry = registry.get(registry_key(executable.path))
+                    watched[executable.path] = Watched(executable.path,
+                                                       entry[0] if entry else name,
+                                                       entry is not None)
+                    broken.append(executable.path)
+        self.watched = watched
+
+        directories = {os.path.dirname(path) for path in watched}
+        for directory in set(self.directories) - directories:
+            self.inotify.remove_watch(self.directories.pop(directory))
+        for directory in directories - set(self.directories):
+            try:
+                self.directories[directory] = self.inotify.add_watch(directory)
+            except OSError as e:
+                log('cannot watch %s: %s' % (directory, e))
+        log('watching %s intercepted executables in %s directories' % (
+            len(self.watched), len(self.directories)))
+        return broken
+
+    def heal(self, path: str) -> None:
+        """Put the wrapper of path back in place, if it's been replaced"""
+        watched = self.watched.get(path)
+        if watched is None or not os.path.exists(path + INTERCEPTED):
+            # unintercepted in the meantime
+            return
+        if not os.path.lexists(path):
+            log('%s was removed, leaving %s alone' % (path, path + INTERCEPTED))
+            return
+        if is_wrapper_file(path):
+            return
+        from interceptor.intercepting import intercept_path
+        log('%s was replaced, intercepting it again as %s' % (path, watched.tool_name))
+        try:
+            intercept_path(watched.tool_name, path, watched.multicall)
+            self.healed += 1
+        except OSError as e:
+            log('failed to intercept %s: %s' % (path, e))
+
+    def collect(self) -> tp.Tuple[tp.Set[str], bool]:
+        """
+        Wait for a burst of events, and return when it's over.
+
+        :return: a tuple of (paths of the watched executables that have changed, whether
+            the index has to be rebuilt)
+        """
+        paths_by_wd = {wd: directory for directory, wd in self.directories.items()}
+        changed = set()
+        rebuild = False
+        events = self.inotify.read()
+        deadline = time.monotonic() + MAX_DELAY
+        while True:
+            for event in events:
+                if event.mask & IN_Q_OVERFLOW or event.wd == self.config_wd:
+                    rebuild = True
+                elif event.mask & IN_IGNORED:
+                    # a watched directory is gone
+                    rebuild = rebuild or event.wd in paths_by_wd
+                elif event.wd in paths_by_wd:
+                    name = event.name
+                    if name.endswith(INTERCEPTED):
+                        name = name[:-len(INTERCEPTED)]
+                    path = os.path.join(paths_by_wd[event.wd], name)
+                    if path in self.watched:
+                        changed.add(path)
+            timeout = min(QUIET_PERIOD, deadline - time.monotonic())
+            if timeout <= 0 or not select.select([self.inotify], [], [], timeout)[0]:
+                return changed, rebuild
+            events = self.inotify.read()
+
+    def run(self) -> None:
+        for path in self.rebuild():
+            self.heal(path)
+        while True:
+            changed, rebuild = self.collect()
+            if rebuild:
+                changed.update(self.rebuild())
+            for path in sorted(changed):
+                self.heal(path)
+
+
+def run_watch() -> None:
+    try:
+        watcher = Watcher()
+    except OSError as e:
+        print('Cannot watch the intercepted tools: %s' % (e,))
+        sys.exit(1)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    print('Healed %s executables' % (watcher.healed,))
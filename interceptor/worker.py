@@ -0,0 +1,367 @@
+"""
+intercept worker - compile preprocessed sources sent by the wrappers of tools that have
+"offload" enabled (see interceptor.offload), on this machine or for other ones.
+
+A worker runs at most --jobs compilations at once, and the ones above that wait in line.
+Wrappers ask every worker how loaded it is before sending it a compilation, and run it
+themselves if all of them are busy.
+
+The tools are looked up by name in the worker's PATH, and their original executables are ran
+if they are intercepted here as well, since the arguments have already been rewritten by the
+wrapper. The workers are expected to have the same compilers as the machines they compile for.
+
+Only arguments in the allowlist of interceptor.offload are ran. A worker listening on TCP
+requires the wrappers to send the secret from it's --secret file first, and the unix socket is
+only accessible to the worker's user and group.
+"""
+import argparse
+import hmac
+import os
+import shutil
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing as tp
+
+from interceptor.index import ExecutableIndex, INTERCEPTED
+from interceptor.offload import MAX_SECRET_SIZE, connect, default_worker_address, read_secret, \
+    read_statistics, secret_path, unsafe_argument
+from interceptor.protocol import send_message, receive_exactly, receive_message
+
+# how long a client connected over TCP has to send the secret
+AUTHENTICATION_TIMEOUT = 10.0
+
+LANGUAGES = frozenset(('cpp-output', 'c++-cpp-output', 'objective-c-cpp-output',
+                       'objective-c++-cpp-output'))
+
+
+class Worker:
+    """
+    The compilations going on in a worker, and the statistics of the finished ones.
+    """
+
+    def __init__(self, jobs: int):
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.semaphore = threading.Semaphore(jobs)
+        self.running = 0
+        self.waiting = 0
+        self.started_at = time.time()
+        self.compilations = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.locations = {}  # type: tp.Dict[str, str]
+
+    def load(self) -> tuple:
+        with self.lock:
+            return 'ok', self.running, self.waiting, self.jobs
+
+    def locate(self, tool_name: str) -> str:
+        """
+        :raises ValueError: the tool was not found
+        """
+        if tool_name not in self.locations:
+            if '/' in tool_name or tool_name.startswith('.'):
+                raise ValueError('invalid tool name %s' % (tool_name,))
+            for executable in ExecutableIndex([tool_name]).paths(tool_name,
+                                                                  abort_on_failure=False):
+                if not executable.is_wrapper:
+                    self.locations[tool_name] = executable.path
+                    break
+                if executable.has_original:
+                    self.locations[tool_name] = executable.path + INTERCEPTED
+                    break
+            else:
+                raise ValueError('%s was not found' % (tool_name,))
+        return self.locations[tool_name]
+
+    def reserve(self) -> None:
+        """Count a wrapper that has asked for the load, and may send a compilation, as waiting"""
+        with self.lock:
+            self.waiting += 1
+
+    def release(self) -> None:
+        with self.lock:
+            self.waiting -= 1
+
+    def compile(self, tool_name: str, args: tp.List[str], language: str, cwd: str,
+                source: bytes) -> tuple:
+        """
+        Run the compilation, once a slot is free.
+
+        :raises ValueError: the compilation cannot be done here
+        """
+        if language not in LANGUAGES:
+            raise ValueError('unknown language %s' % (language,))
+        unsafe = unsafe_argument(args[1:])
+        if unsafe is not None:
+            raise ValueError('%s is not allowed on a worker' % (unsafe,))
+        location = self.locate(tool_name)
+        with self.lock:
+            self.waiting += 1
+        with self.semaphore:
+            with self.lock:
+                self.waiting -= 1
+                self.running += 1
+            started_at = time.monotonic()
+            try:
+                return self.run_compiler(location, args, language, cwd, source)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.busy_time += time.monotonic() - started_at
+
+    def run_compiler(self, location: str, args: tp.List[str], language: str, cwd: str,
+                     source: bytes) -> tuple:
+        started_at = time.monotonic()
+        directory = tempfile.mkdtemp(prefix='interceptor-worker-')
+        try:
+            input_path = os.path.join(directory, 'input')
+            output_path = os.path.join(directory, 'output.o')
+            with open(input_path, 'wb') as f_out:
+                f_out.write(source)
+            # so that the debugging information names the wrapper's directory, not this one
+            full_args = args + ['-fdebug-prefix-map=%s=%s' % (directory, cwd), '-x', language,
+                                '-c', input_path, '-o', output_path]
+            with open(os.path.join(directory, 'stdout'), 'w+b') as stdout, \
+                    open(os.path.join(directory, 'stderr'), 'w+b') as stderr:
+                process = subprocess.Popen(full_args, executable=location, cwd=directory,
+                                           stdin=subprocess.DEVNULL, stdout=stdout,
+                                           stderr=stderr)
+                # waited for directly, to get the CPU time of this compilation alone
+                _, status, rusage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                stdout.seek(0)
+                stderr.seek(0)
+                output = stdout.read(), stderr.read()
+            if process.returncode < 0:
+                raise ValueError('%s was killed by signal %s' % (
+                    os.path.basename(location), -process.returncode))
+            obj = None
+            if process.returncode == 0:
+                try:
+                    with open(output_path, 'rb') as f_in:
+                        obj = f_in.read()
+                except FileNotFoundError:
+                    raise ValueError('%s wrote no object file' % (os.path.basename(location),))
+            return 'ok', process.returncode, output[0], output[1], obj, \
+                time.monotonic() - started_at, rusage.ru_utime + rusage.ru_stime
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def to_json(self) -> dict:
+        with self.lock:
+            return {'uptime': time.time() - self.started_at,
+                    'jobs': self.jobs,
+                    'running': self.running,
+                    'waiting': self.waiting,
+                    'compilations': self.compilations,
+                    'errors': self.errors,
+                    'busy_time': self.busy_time}
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    def authenticate(self) -> bool:
+        """Check the secret that a client connected over TCP sends first"""
+        try:
+            self.request.settimeout(AUTHENTICATION_TIMEOUT)
+            length = int.from_bytes(receive_exactly(self.request, 4), 'big')
+            if length > MAX_SECRET_SIZE:
+                return False
+            secret = receive_exactly(self.request, length)
+        except (EOFError, OSError):
+            return False
+        if not hmac.compare_digest(secret, self.server.secret):
+            return False
+        try:
+            send_message(self.request, ('ok',))
+            self.request.settimeout(None)
+        except OSError:
+            return False
+        return True
+
+    def handle(self) -> None:
+        self.reserved = False
+        if self.server.secret is not None and not self.authenticate():
+            return
+        try:
+            while True:
+                try:
+                    request = receive_message(self.request)
+                except (EOFError, OSError, ValueError):
+                    return
+                response = self.serve(request)
+                try:
+                    send_message(self.request, response)
+                except OSError:
+                    return
+        finally:
+            if self.reserved:
+                self.server.worker.release()
+
+    def serve(self, request) -> tuple:
+        worker = self.server.worker
+        try:
+            op_name, *args = request
+            if op_name == 'load':
+                response = worker.load()
+                if not self.reserved:
+                    worker.reserve()
+                    self.reserved = True
+                return response
+            elif op_name == 'compile':
+                tool_name, argv, language, cwd, source = args
+                if self.reserved:
+                    worker.release()
+                    self.reserved = False
+                try:
+                    response = worker.compile(tool_name, argv, language, cwd, source)
+                except (OSError, ValueError):
+                    with worker.lock:
+                        worker.errors += 1
+                    raise
+                with worker.lock:
+                    worker.compilations += 1
+                return response
+            elif op_name == 'stats':
+                return 'ok', worker.to_json()
+            return 'error', 'unknown request %s' % (op_name,)
+        except (OSError, ValueError, TypeError) as e:
+            return 'error', str(e)
+
+
+class UnixWorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = socket.SOMAXCONN
+    secret = None
+
+
+class TCPWorkerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = socket.SOMAXCONN
+
+
+class TCP6WorkerServer(TCPWorkerServer):
+    address_family = socket.AF_INET6
+
+
+def create_server(address: str, secret_file: str = None) -> socketserver.BaseServer:
+    """
+    :param secret_file: file holding the secret that clients connecting over TCP have to send
+    :raises OSError: the secret could not be read
+    :raises ValueError: the address or the secret is invalid
+    """
+    scheme, _, rest = address.partition(':')
+    if scheme == 'unix':
+        os.makedirs(os.path.dirname(rest) or '.', exist_ok=True)
+        if os.path.exists(rest):
+            os.unlink(rest)
+        server = UnixWorkerServer(rest, RequestHandler)
+        os.chmod(rest, 0o660)
+        return server
+    if scheme == 'tcp':
+        secret = read_secret(secret_file)
+        host, _, port = rest.rpartition(':')
+        host = host.strip('[]')
+        server_class = TCP6WorkerServer if ':' in host else TCPWorkerServer
+        server = server_class((host, int(port)), RequestHandler)
+        server.secret = secret
+        return server
+    raise ValueError('unknown transport in %s' % (address,))
+
+
+def run_worker(address: str, jobs: int, secret_file: str = None) -> None:
+    try:
+        server = create_server(address, secret_file)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    server.worker = Worker(jobs)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print('Compiling up to %s files at once, listening on %s' % (jobs, address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if address.startswith('unix:'):
+            os.unlink(address[len('unix:'):])
+
+
+def query_worker(address: str, request: tuple):
+    """Send a request to a worker and return it's response, or None if it did not answer"""
+    try:
+        sock = connect(address, 5)
+        try:
+            send_message(sock, request)
+            return receive_message(sock)
+        finally:
+            sock.close()
+    except (OSError, EOFError, ValueError):
+        return None
+
+
+def print_offload_stats(addresses: tp.List[str]) -> None:
+    statistics = read_statistics()
+    attempted = statistics['offloaded'] + statistics['failed'] + statistics['busy']
+    print('Compilations offloaded: %s of %s, %s failed and were compiled locally, %s were '
+          'compiled locally since no worker was free' % (
+              statistics['offloaded'], attempted, statistics['failed'], statistics['busy']))
+    if statistics['offloaded']:
+        offloaded = statistics['offloaded']
+        remote = statistics['remote_cpu_time']
+        local = statistics['preprocess_cpu_time']
+        print('CPU time compiling on the workers: %.1f s, %.3f s per file' % (
+            remote, remote / offloaded))
+        print('CPU time preprocessing locally: %.1f s, %.3f s per file' % (
+            local, local / offloaded))
+        print('Time waiting for the workers and on the network: %.1f s, %.3f s per file' % (
+            statistics['transfer_time'], statistics['transfer_time'] / offloaded))
+        print('Local CPU time saved: %.1f s, %.0f%% of what compiling locally would take' % (
+            remote - local, 100 * (remote - local) / remote if remote else 0))
+
+    for address in addresses:
+        response = query_worker(address, ('stats',))
+        if response is None or response[0] != 'ok':
+            print('%s: not running' % (address,))
+            continue
+        stats = response[1]
+        print('%s: %s compilations (%s errors), %s of %s slots running, %s waiting, '
+              '%.0f%% busy' % (address, stats['compilations'], stats['errors'],
+                               stats['running'], stats['jobs'], stats['waiting'],
+                               100 * stats['busy_time'] / (stats['uptime'] * stats['jobs'])
+                               if stats['uptime'] else 0))
+
+
+def worker_main(argv: tp.List[str]) -> None:
+    """Entry point of intercept worker"""
+    parser = argparse.ArgumentParser(
+        prog='intercept worker',
+        description='Compile files for the wrappers of tools that have offloading enabled',
+        usage='intercept worker run [--listen ADDRESS] [--jobs N] [--secret FILE] | '
+              'intercept worker stats [ADDRESS...]')
+    parser.add_argument('command', choices=('run', 'stats'))
+    parser.add_argument('addresses', nargs='*',
+                        help='addresses of the workers to display the statistics of')
+    parser.add_argument('--listen', default=default_worker_address(),
+                        help='unix:PATH or tcp:HOST:PORT to listen on, %s by default' % (
+                            default_worker_address(),))
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='how many files to compile at once')
+    parser.add_argument('--secret', default=secret_path(),
+                        help='file holding the secret that the wrappers connecting over TCP '
+                             'have to send, %s by default' % (secret_path(),))
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        if args.jobs < 1:
+            parser.error('--jobs has to be positive')
+        run_worker(args.listen, args.jobs, args.secret)
+    else:
+        print_offload_stats(args.addresses or [default_worker_address()])
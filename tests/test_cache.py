@@ -0,0 +1,153 @@
+"""
+Tests of which compilations the result cache takes, and of hits restoring their outputs.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from interceptor.cache import parse_invocation
+from interceptor.intercepting import render_wrapper
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# arguments, and the outputs of the compilation, or None if it's not cacheable
+INVOCATIONS = [
+    (['-c', 'a.c'], ['a.o']),
+    (['-c', 'src/a.c', '-O2'], ['a.o']),
+    (['-c', 'a.c', '-o', 'out/b.o'], ['out/b.o']),
+    (['-c', 'a.c', '-oout/b.o'], ['out/b.o']),
+    (['-c', 'a.cpp', '-o', 'a.o', '-MD'], ['a.o', 'a.d']),
+    (['-c', 'a.c', '-o', 'a.o', '-MMD', '-MF', 'deps/a.dep'], ['a.o', 'deps/a.dep']),
+    (['-c', 'a.c', '-o', 'a.o', '-MP'], ['a.o']),
+    (['-c', 'a.c', '-include', 'config.h', '-x', 'c'], ['a.o']),
+    (['a.c'], None),
+    (['-c'], None),
+    (['-c', 'a.c', 'b.c'], None),
+    (['-c', 'a.o'], None),
+    (['-c', '-'], None),
+    (['-c', 'a.c', '-o', 'a.o', '-o', 'b.o'], None),
+    (['-c', 'a.c', '-o'], None),
+    (['-c', 'a.c', '-E'], None),
+    (['-c', 'a.c', '-S'], None),
+    (['-c', 'a.c', '-M'], None),
+    (['-c', 'a.c', '-save-temps'], None),
+    (['-c', 'a.c', '-fprofile-generate'], None),
+    (['-c', 'a.c', '--coverage'], None),
+    (['-c', 'a.c', '-Wp,-MD,a.d'], None),
+    (['-c', 'a.c', '-Xpreprocessor', '-MD'], None),
+    (['-c', 'a.c', '-Wa,-adhln=a.lst'], None),
+    (['-c', 'a.c', '-fplugin=x.so'], None),
+    (['-c', '@args'], None),
+    (['-c', 'a.c', '-MF'], None),
+]
+
+
+def gcc_exec_prefix() -> str:
+    process = subprocess.run(['gcc', '-print-search-dirs'], stdout=subprocess.PIPE, check=True)
+    install = process.stdout.decode('utf-8').splitlines()[0].partition(' ')[2]
+    # install is <prefix>/<machine>/<version>/
+    return os.path.dirname(os.path.dirname(install.rstrip('/'))) + '/'
+
+
+class TestParseInvocation(unittest.TestCase):
+    def test_invocations(self):
+        for args, outputs in INVOCATIONS:
+            invocation = parse_invocation(['gcc'] + args)
+            self.assertEqual(None if invocation is None else invocation.outputs, outputs, args)
+
+    def test_keyed_by_target(self):
+        # the object file is the target named in the dependency file, unless -MT names another
+        invocation = parse_invocation(['gcc', '-c', 'a.c', '-o', 'a.o', '-MD'])
+        self.assertEqual(invocation.hashed_args, ['gcc', 'a.c', '-MD', '-o', 'a.o'])
+        invocation = parse_invocation(['gcc', '-c', 'a.c', '-o', 'a.o', '-MD', '-MT', 'x'])
+        self.assertEqual(invocation.hashed_args, ['gcc', 'a.c', '-MD', '-MT', 'x'])
+        invocation = parse_invocation(['gcc', '-c', 'a.c', '-o', 'a.o', '-O2'])
+        self.assertEqual(invocation.hashed_args, ['gcc', 'a.c', '-O2'])
+
+    def test_preprocessor_args(self):
+        invocation = parse_invocation(['gcc', '-c', 'a.c', '-o', 'a.o', '-MD', '-DX=1',
+                                       '-I', 'include'])
+        self.assertEqual(invocation.source, 'a.c')
+        self.assertEqual(invocation.preprocessor_args,
+                         ['gcc', 'a.c', '-DX=1', '-I', 'include', '-E'])
+        self.assertEqual(invocation.dependency_args, ['-MD'])
+
+
+@unittest.skipUnless(shutil.which('gcc'), 'gcc is not installed')
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.env = {name: value for name, value in os.environ.items()
+                    if not name.startswith('INTERCEPTOR_')}
+        self.env['VIRTUAL_ENV'] = self.directory
+        self.env['PYTHONPATH'] = ROOT
+        # gcc finds it's programs relative to argv[0], which is the wrapper here
+        self.env['GCC_EXEC_PREFIX'] = gcc_exec_prefix()
+        os.makedirs(os.path.join(self.directory, 'etc', 'interceptor.d'))
+        self.wrapper = os.path.join(self.directory, 'gcc')
+        with open(self.wrapper, 'w') as f_out:
+            f_out.write(render_wrapper('gcc', shutil.which('gcc')))
+        os.chmod(self.wrapper, 0o755)
+        subprocess.run([sys.executable, '-c',
+                        'from interceptor.config import Configuration\n'
+                        'Configuration(app_name="gcc", cache=True).save()'],
+                       env=self.env, check=True)
+        self.source = os.path.join(self.directory, 'a.c')
+        self.write_source('#warning "compiled"\nint a(void) { return 1; }\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_source(self, content: str) -> None:
+        with open(self.source, 'w') as f_out:
+            f_out.write(content)
+
+    def compile(self) -> bytes:
+        """:return: what the compiler printed on stderr"""
+        process = subprocess.run([self.wrapper, '-c', 'a.c', '-o', 'a.o', '-MD'],
+                                 cwd=self.directory, env=self.env, stderr=subprocess.PIPE,
+                                 check=True)
+        return process.stderr
+
+    def outputs(self) -> list:
+        contents = []
+        for name in ('a.o', 'a.d'):
+            path = os.path.join(self.directory, name)
+            with open(path, 'rb') as f_in:
+                contents.append(f_in.read())
+            os.unlink(path)
+        return contents
+
+    def statistics(self) -> dict:
+        process = subprocess.run([sys.executable, '-c',
+                                  'from interceptor.cache import read_statistics\n'
+                                  'print(read_statistics())'],
+                                 env=self.env, stdout=subprocess.PIPE, check=True)
+        return eval(process.stdout)
+
+    def test_hit_restores_outputs(self):
+        stderr = self.compile()
+        self.assertIn(b'compiled', stderr)
+        outputs = self.outputs()
+        self.assertIn(b'a.o:', outputs[1])
+        self.assertEqual(self.compile(), stderr)
+        self.assertEqual(self.outputs(), outputs)
+        statistics = self.statistics()
+        self.assertEqual((statistics['misses'], statistics['hits'], statistics['stores']),
+                         (1, 1, 1))
+
+    def test_miss_after_change(self):
+        self.compile()
+        self.outputs()
+        self.write_source('int a(void) { return 2; }\n')
+        self.assertNotIn(b'compiled', self.compile())
+        self.outputs()
+        statistics = self.statistics()
+        self.assertEqual((statistics['misses'], statistics['hits']), (2, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""
+Tests of wrappers ran by other wrappers: passing straight through when the configuration has
+been applied up the chain, and counting the nested runs.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from interceptor.chain import MAX_DEPTH, already_applied, args_digest, compact_statistics, \
+    parse_chain, parse_statistics
+from interceptor.intercepting import render_wrapper
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestChain(unittest.TestCase):
+    def test_parse_chain(self):
+        self.assertEqual(parse_chain('2|c++:1c291ca3/g++:09a3b7f2'),
+                         (2, [('c++', '1c291ca3'), ('g++', '09a3b7f2')]))
+        self.assertEqual(parse_chain('1|x86_64-linux-gnu-g++:1c291ca3'),
+                         (1, [('x86_64-linux-gnu-g++', '1c291ca3')]))
+        self.assertEqual(parse_chain(''), (0, []))
+        self.assertEqual(parse_chain('x|c++:1c291ca3'), (0, []))
+
+    def test_already_applied(self):
+        chain = [('c++', args_digest(['c++', '-c', 'a.cc']))]
+        self.assertTrue(already_applied('c++', chain, ['/usr/bin/c++', '-c', 'a.cc']))
+        self.assertFalse(already_applied('c++', chain, ['c++', '-c', 'b.cc']))
+
+    def test_statistics(self):
+        self.assertEqual(parse_statistics(b''), [0] * MAX_DEPTH)
+        self.assertEqual(parse_statistics(b'2p23p36'), [2, 2, 2, 0, 0, 1])
+        self.assertEqual(parse_statistics(b'5 4 3 2 1 0\np2'), [6, 5, 3, 2, 1, 0])
+        self.assertEqual(parse_statistics(b'garbage\n2'), [0, 1, 0, 0, 0, 0])
+
+    def test_compact_statistics(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'g++')
+            with open(path, 'wb') as f_out:
+                f_out.write(b'1 1 1 1 1 1\n' + b'p2' * 100 + b'3')
+            compact_statistics(path)
+            with open(path, 'rb') as f_in:
+                self.assertEqual(f_in.read(), b'101 101 2 1 1 1\n')
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestNestedWrappers(unittest.TestCase):
+    """c++, whose tool runs the g++ wrapper with the arguments it was given"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.env = {name: value for name, value in os.environ.items()
+                    if not name.startswith('INTERCEPTOR_')}
+        self.env['VIRTUAL_ENV'] = self.directory
+        self.env['PYTHONPATH'] = ROOT
+        os.makedirs(os.path.join(self.directory, 'etc', 'interceptor.d'))
+        self.write_script('c++-intercepted', 'exec "%s" "$@"' % (
+            os.path.join(self.directory, 'g++'),))
+        self.write_script('g++-intercepted', 'echo "$@"')
+        for name in ('c++', 'g++'):
+            self.write_script(name, render_wrapper(
+                name, os.path.join(self.directory, name + '-intercepted')), shell=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_script(self, name: str, content: str, shell: bool = True) -> None:
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f_out:
+            f_out.write('#!/bin/sh\n%s\n' % (content,) if shell else content)
+        os.chmod(path, 0o755)
+
+    def configure(self, linked: bool) -> None:
+        subprocess.run([sys.executable, '-c',
+                        'import os\n'
+                        'from interceptor.config import Configuration\n'
+                        'cfg = Configuration(app_name="c++", args_to_prepend=["-g"],'
+                        ' args_to_replace=[["-g", "-g3"]])\n'
+                        'cfg.save()\n'
+                        'if %r:\n'
+                        '    os.symlink(cfg.path, os.path.join(os.path.dirname(cfg.path),'
+                        ' "g++"))\n'
+                        'else:\n'
+                        '    cfg.app_name = "g++"\n'
+                        '    cfg.save()' % (linked,)],
+                       env=self.env, check=True)
+
+    def run_wrapper(self) -> str:
+        process = subprocess.run([os.path.join(self.directory, 'c++'), '-c', '-g', 'a.cc'],
+                                 env=self.env, stdout=subprocess.PIPE, check=True)
+        return process.stdout.decode('utf-8').strip()
+
+    def statistics(self) -> list:
+        with open(os.path.join(self.directory, 'var', 'run', 'interceptor', 'chains', 'g++'),
+                  'rb') as f_in:
+            return parse_statistics(f_in.read())
+
+    def test_passes_through_linked_configuration(self):
+        self.configure(linked=True)
+        # applying the rules again would replace the -g prepended by c++, and prepend another
+        self.assertEqual(self.run_wrapper(), '-g -c -g3 a.cc')
+        self.assertEqual(self.statistics(), [1, 1, 0, 0, 0, 0])
+
+    def test_applies_another_configuration(self):
+        self.configure(linked=False)
+        self.assertEqual(self.run_wrapper(), '-g -g3 -c -g3 a.cc')
+        self.assertEqual(self.statistics(), [0, 1, 0, 0, 0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
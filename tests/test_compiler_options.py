@@ -0,0 +1,108 @@
+"""
+Tests of deduplicating search paths and macros, and of telling options and operands apart.
+"""
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from interceptor.compiler_options import Deduplication, deduplicate, macro_state, operands, \
+    without_preprocessor_options
+
+# arguments, and what is left of them once deduplicated
+DEDUPLICATIONS = [
+    (['-Ia', '-Ib', '-Ia'], ['-Ia', '-Ib']),
+    (['-I', 'a', '-Ia', '-I', './a/', '-Ib/../a'], ['-I', 'a']),
+    (['-Ia', '-isystem', 'a', '-iquote', 'a', '-idirafter', 'a', '-La', '-Fa'],
+     ['-Ia', '-isystem', 'a', '-iquote', 'a', '-idirafter', 'a', '-La', '-Fa']),
+    (['-isystem', 'a', '-isystema', '-isystem', 'b'], ['-isystem', 'a', '-isystem', 'b']),
+    (['-Ia', '-I-', '-Ia'], ['-Ia', '-I-', '-Ia']),
+    (['-DX', '-DX=1', '-D', 'X'], ['-DX']),
+    (['-DX=1', '-DX=2', '-DX=1'], ['-DX=1', '-DX=2', '-DX=1']),
+    (['-DX', '-UX', '-DX'], ['-DX', '-UX', '-DX']),
+    (['-UX', '-U', 'X', '-DX', '-UX'], ['-UX', '-DX', '-UX']),
+    (['-DF(a)=a', '-DF(a)=a', '-DF(b)=b'], ['-DF(a)=a', '-DF(b)=b']),
+    (['-o', '-Ia', '-Ia', '-x', '-Ia'], ['-o', '-Ia', '-Ia', '-x', '-Ia']),
+    (['-Xlinker', 'x', '-Xlinker', 'x', 'a.c', 'a.c'],
+     ['-Xlinker', 'x', '-Xlinker', 'x', 'a.c', 'a.c']),
+    (['-Ia', '-I'], ['-Ia', '-I']),
+]
+
+# macro options, and the state they leave the macro in
+MACRO_STATES = [
+    (('-D', 'X'), ('X', '1')),
+    (('-D', 'X='), ('X', '1')),
+    (('-D', 'X=0'), ('X', '0')),
+    (('-D', 'X=a=b'), ('X', 'a=b')),
+    (('-D', 'F(a)=a'), ('F', '(a)=a')),
+    (('-D', 'F(a)'), ('F', '(a)')),
+    (('-U', 'X'), ('X', None)),
+]
+
+NAMES = ['X', 'Y', 'F(a)']
+VALUES = ['', '=1', '=2', '=a']
+
+
+class TestDeduplicate(unittest.TestCase):
+    def test_deduplications(self):
+        for args, expected in DEDUPLICATIONS:
+            self.assertEqual(deduplicate(args), expected, args)
+
+    def test_macro_states(self):
+        for (option, value), state in MACRO_STATES:
+            self.assertEqual(macro_state(option, value), state, (option, value))
+
+    def test_counts(self):
+        counts = Deduplication()
+        deduplicate(['-I.', '-I.', '-DX', '-DX', '-DX', '-Imissing'], True, counts)
+        self.assertEqual((counts.paths, counts.macros, counts.missing), (1, 2, 1))
+        self.assertEqual(counts.total, 4)
+
+    def test_drop_missing(self):
+        directory = tempfile.mkdtemp()
+        try:
+            args = ['-I', directory, '-I%s/missing' % (directory,), '-isystem', '=missing',
+                    '-L$SYSROOT/missing']
+            self.assertEqual(deduplicate(args, drop_missing=True),
+                             ['-I', directory, '-isystem', '=missing', '-L$SYSROOT/missing'])
+            self.assertEqual(deduplicate(args), args)
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipUnless(shutil.which('gcc'), 'gcc is not installed')
+    def test_same_macros_defined(self):
+        def macros(args: list) -> str:
+            process = subprocess.run(['gcc', '-E', '-dM', '-x', 'c', os.devnull] + args,
+                                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                     check=True)
+            return process.stdout
+
+        rnd = random.Random(1)
+        for _ in range(30):
+            args = []
+            for _ in range(rnd.randint(1, 8)):
+                name = rnd.choice(NAMES)
+                if rnd.random() < 0.3:
+                    args.append('-U%s' % (name.partition('(')[0],))
+                else:
+                    args.append('-D%s%s' % (name, rnd.choice(VALUES)))
+            self.assertEqual(macros(deduplicate(args)), macros(args), args)
+
+
+class TestOptions(unittest.TestCase):
+    def test_operands(self):
+        self.assertEqual(operands(['-c', 'a.c', '-o', 'a.o', '-I', 'inc', '-x', 'c', 'b.c',
+                                   '-', '-Wall']),
+                         ['a.c', 'b.c', '-'])
+
+    def test_without_preprocessor_options(self):
+        self.assertEqual(without_preprocessor_options(
+            ['-c', 'a.c', '-DX', '-I', 'inc', '-isystem', 'sys', '-include', 'config.h',
+             '-Wp,-MD,a.d', '-nostdinc', '-o', 'a.o', '-O2']),
+            ['-c', 'a.c', '-o', 'a.o', '-O2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+"""
+Tests of the index of executables in PATH, and of intercepting many tools at once.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from interceptor.index import ExecutableIndex
+from interceptor.intercepting import render_wrapper
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bin = os.path.join(self.directory, 'bin')
+        self.local = os.path.join(self.directory, 'local')
+        os.mkdir(self.bin)
+        os.mkdir(self.local)
+        os.symlink(self.bin, os.path.join(self.directory, 'usr-bin'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create(self, path: str, content: str = '#!/bin/sh\n', mode: int = 0o755) -> None:
+        with open(path, 'w') as f_out:
+            f_out.write(content)
+        os.chmod(path, mode)
+
+    def index(self, *args, **kwargs) -> ExecutableIndex:
+        path = ':'.join((self.local, self.bin, os.path.join(self.directory, 'usr-bin')))
+        with mock.patch.dict(os.environ, {'PATH': path}):
+            return ExecutableIndex(*args, **kwargs)
+
+    def test_index(self):
+        self.create(os.path.join(self.bin, 'gcc'))
+        self.create(os.path.join(self.local, 'gcc'), render_wrapper('gcc', '/bin/false'))
+        self.create(os.path.join(self.local, 'gcc-intercepted'))
+        self.create(os.path.join(self.bin, 'gcc-12'))
+        self.create(os.path.join(self.bin, 'gcc-ar'))
+        self.create(os.path.join(self.bin, 'ld'), mode=0o644)
+        index = self.index(['gcc', 'ld'], ['gcc'])
+        self.assertEqual(index.found_names(), ['gcc', 'gcc-12'])
+        # the directory symlinked to bin is walked once
+        self.assertEqual([(executable.path, executable.is_wrapper, executable.has_original)
+                          for executable in index.paths('gcc')],
+                         [(os.path.join(self.local, 'gcc'), True, True),
+                          (os.path.join(self.bin, 'gcc'), False, False)])
+        self.assertTrue(index.is_partially_intercepted('gcc'))
+        self.assertFalse(index.is_all_intercepted('gcc'))
+        self.assertEqual(index.paths('ld', abort_on_failure=False), [])
+
+    def test_with_intercepted(self):
+        self.create(os.path.join(self.bin, 'foo'))
+        self.create(os.path.join(self.bin, 'foo-intercepted'))
+        self.create(os.path.join(self.bin, 'bar-intercepted'))
+        index = self.index(with_intercepted=True)
+        self.assertEqual(index.found_names(), ['foo'])
+        self.assertEqual(index.orphans, [os.path.join(self.bin, 'bar-intercepted')])
+
+
+class TestInterceptTools(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bin = os.path.join(self.directory, 'bin')
+        self.local = os.path.join(self.directory, 'local')
+        os.mkdir(self.bin)
+        os.mkdir(self.local)
+        self.env = {name: value for name, value in os.environ.items()
+                    if not name.startswith('INTERCEPTOR_')}
+        self.env['VIRTUAL_ENV'] = self.directory
+        self.env['PYTHONPATH'] = ROOT
+        self.env['PATH'] = '%s:%s' % (self.bin, self.local)
+        os.makedirs(os.path.join(self.directory, 'etc', 'interceptor.d'))
+        for directory, name in ((self.bin, 'foo'), (self.local, 'foo'), (self.bin, 'bar')):
+            with open(os.path.join(directory, name), 'w') as f_out:
+                f_out.write('#!/bin/sh\necho %s "$@"\n' % (name,))
+            os.chmod(os.path.join(directory, name), 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def intercept(self, *tool_names) -> int:
+        return subprocess.run([sys.executable, '-c',
+                               'from interceptor.intercepting import intercept_tools\n'
+                               'intercept_tools(%r)' % (list(tool_names),)],
+                              env=self.env, stdout=subprocess.DEVNULL).returncode
+
+    def files(self) -> list:
+        return sorted(os.path.join(os.path.basename(directory), name)
+                      for directory in (self.bin, self.local) for name in os.listdir(directory))
+
+    def test_intercept_tools(self):
+        self.assertEqual(self.intercept('foo', 'bar'), 0)
+        self.assertEqual(self.files(), ['bin/bar', 'bin/bar-intercepted', 'bin/foo',
+                                        'bin/foo-intercepted', 'local/foo',
+                                        'local/foo-intercepted'])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'etc', 'interceptor.d',
+                                                    'bar')))
+        process = subprocess.run([os.path.join(self.local, 'foo'), 'x'], env=self.env,
+                                 stdout=subprocess.PIPE, check=True)
+        self.assertEqual(process.stdout, b'foo x\n')
+
+    def test_rollback(self):
+        # copying bar aside fails, after both foos have been intercepted
+        os.symlink(os.path.join(self.directory, 'missing', 'bar'),
+                   os.path.join(self.bin, 'bar-intercepted'))
+        files = self.files()
+        self.assertEqual(self.intercept('foo', 'bar'), 1)
+        self.assertEqual(self.files(), files)
+        with open(os.path.join(self.local, 'foo')) as f_in:
+            self.assertEqual(f_in.read(), '#!/bin/sh\necho foo "$@"\n')
+
+    def test_unknown_tool(self):
+        files = self.files()
+        self.assertEqual(self.intercept('foo', 'baz'), 1)
+        self.assertEqual(self.files(), files)
+
+
+if __name__ == '__main__':
+    unittest.main()
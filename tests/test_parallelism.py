@@ -0,0 +1,125 @@
+"""
+Tests of working out the number of jobs, and of setting it on the command lines and in the
+environment of build drivers.
+"""
+import os
+import unittest
+from unittest import mock
+
+from interceptor.config import Configuration
+from interceptor.parallelism import apply_parallelism, job_count, policy_of, \
+    split_parallelism, validate_policy
+
+RESOURCES = {'cpus': 8, 'quota': None, 'load': 2.0, 'memory': None}
+
+# driver, arguments and whether to strip the load limit, and what's left of them with the
+# number of jobs given
+SPLITS = [
+    ('make', ['make', '-j4', 'all'], False, ['make', 'all'], 4),
+    ('make', ['make', '-j', '4', '-k'], False, ['make', '-k'], 4),
+    ('make', ['make', '-j', 'all'], False, ['make', 'all'], 0),
+    ('make', ['make', '--jobs=3', '-l2.5'], True, ['make'], 3),
+    ('make', ['make', '--jobs', '3', '--load-average', '2'], True, ['make'], 3),
+    ('make', ['make', '-l', '2', 'install'], False, ['make', '-l', '2', 'install'], None),
+    ('make', ['make', '-C', 'dir', '--', '-j4'], False, ['make', '-C', 'dir', '--', '-j4'],
+     None),
+    ('ninja', ['ninja', '-j8', '-l', '4', '-C', 'build'], True, ['ninja', '-C', 'build'], 8),
+    ('cmake', ['cmake', '--build', 'b', '--parallel', '6'], False, ['cmake', '--build', 'b'],
+     6),
+    ('cmake', ['cmake', '--build', 'b', '-j', '--', '-k'], False,
+     ['cmake', '--build', 'b', '--', '-k'], 0),
+]
+
+
+class TestJobCount(unittest.TestCase):
+    def policy(self, **policy) -> dict:
+        return policy_of(Configuration(app_name='make', parallelism=policy))
+
+    def test_job_count(self):
+        self.assertEqual(job_count(self.policy(), RESOURCES), (6, 8.0))
+        self.assertEqual(job_count(self.policy(load_factor=1.5), RESOURCES), (10, 12.0))
+        self.assertEqual(job_count(self.policy(), dict(RESOURCES, quota=2.5)), (1, 3.0))
+        self.assertEqual(job_count(self.policy(min_jobs=2), dict(RESOURCES, load=20.0)),
+                         (2, 8.0))
+        self.assertEqual(job_count(self.policy(max_jobs=4), RESOURCES), (4, 8.0))
+        self.assertEqual(job_count(self.policy(memory_per_job=1024),
+                                   dict(RESOURCES, memory=3 * 1024 ** 3)), (3, 8.0))
+
+    def test_validate_policy(self):
+        validate_policy({'mode': 'cap', 'load_factor': 1.5, 'driver': 'ninja'})
+        for policy in ({'mode': 'all'}, {'driver': 'scons'}, {'jobs': 4},
+                       {'load_factor': -1}, {'load_limit': 1}, {'max_jobs': True}):
+            self.assertRaises(ValueError, validate_policy, policy)
+
+
+class TestSplitParallelism(unittest.TestCase):
+    def test_splits(self):
+        for driver, args, strip_load, remaining, jobs in SPLITS:
+            self.assertEqual(split_parallelism(args, driver, strip_load), (remaining, jobs),
+                             args)
+
+
+@mock.patch('interceptor.parallelism.measure_resources', lambda: dict(RESOURCES))
+class TestApplyParallelism(unittest.TestCase):
+    def setUp(self):
+        self.environ = mock.patch.dict(os.environ)
+        self.environ.start()
+        for name in ('MAKEFLAGS', 'CMAKE_BUILD_PARALLEL_LEVEL'):
+            os.environ.pop(name, None)
+
+    def tearDown(self):
+        self.environ.stop()
+
+    def apply(self, name: str, args: list, **policy) -> list:
+        return apply_parallelism(Configuration(app_name=name, parallelism=policy), args)
+
+    def test_replace(self):
+        self.assertEqual(self.apply('make', ['make', '-j32', '-l', '40', 'all']),
+                         ['make', '-j6', '-l8', 'all'])
+        self.assertEqual(self.apply('make', ['make', '-j32'], load_limit=False),
+                         ['make', '-j6'])
+        self.assertEqual(self.apply('ninja', ['ninja', '-C', 'build']),
+                         ['ninja', '-j6', '-l8', '-C', 'build'])
+
+    def test_modes(self):
+        self.assertEqual(self.apply('make', ['make', '-j2'], mode='cap'),
+                         ['make', '-j2', '-l8'])
+        self.assertEqual(self.apply('make', ['make', '-j32'], mode='cap'),
+                         ['make', '-j6', '-l8'])
+        self.assertEqual(self.apply('make', ['make'], mode='cap'), ['make'])
+        self.assertEqual(self.apply('make', ['make', '-j32'], mode='missing'),
+                         ['make', '-j32'])
+        self.assertEqual(self.apply('make', ['make'], mode='missing'),
+                         ['make', '-j6', '-l8'])
+
+    def test_cmake(self):
+        self.assertEqual(self.apply('cmake', ['cmake', '--build', 'b', '--', '-k']),
+                         ['cmake', '--build', 'b', '--parallel', '6', '--', '-k'])
+        self.assertEqual(self.apply('cmake', ['cmake', '-S', '.', '-B', 'b']),
+                         ['cmake', '-S', '.', '-B', 'b'])
+        os.environ['CMAKE_BUILD_PARALLEL_LEVEL'] = '32'
+        self.assertEqual(self.apply('cmake', ['cmake', '--build', 'b']),
+                         ['cmake', '--build', 'b'])
+        self.assertEqual(os.environ['CMAKE_BUILD_PARALLEL_LEVEL'], '6')
+
+    def test_makeflags(self):
+        os.environ['MAKEFLAGS'] = '-j32 -k -- CC=gcc CFLAGS=-O2'
+        self.assertEqual(self.apply('make', ['make', 'all']), ['make', 'all'])
+        # whatever follows -- are variable definitions
+        self.assertEqual(os.environ['MAKEFLAGS'], '-k -j6 -l8 -- CC=gcc CFLAGS=-O2')
+
+        os.environ['MAKEFLAGS'] = '-j32'
+        self.assertEqual(self.apply('make', ['make', '-j2']), ['make', '-j6', '-l8'])
+        self.assertEqual(os.environ['MAKEFLAGS'], '-j32')
+
+    def test_jobserver(self):
+        os.environ['MAKEFLAGS'] = ' -j8 --jobserver-auth=fifo:/tmp/x'
+        self.assertEqual(self.apply('make', ['make', '-j32']), ['make', '-j32'])
+
+    def test_other_tools(self):
+        self.assertEqual(self.apply('gcc', ['gcc', '-j4']), ['gcc', '-j4'])
+        self.assertEqual(self.apply('gcc', ['gcc', '-j4'], driver='make'), ['gcc', '-j6', '-l8'])
+
+
+if __name__ == '__main__':
+    unittest.main()
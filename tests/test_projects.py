@@ -0,0 +1,56 @@
+"""
+Tests of which per-project layers are trusted, and of what they may set.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from interceptor.projects import PROJECT_DIRECTORY, find_layers, merge
+
+
+class TestLayers(unittest.TestCase):
+    def setUp(self):
+        self.directory = os.path.realpath(tempfile.mkdtemp())
+        os.chmod(self.directory, 0o755)
+        self.project = os.path.join(self.directory, 'project')
+        self.layer = os.path.join(self.project, PROJECT_DIRECTORY, 'gcc')
+        os.makedirs(os.path.dirname(self.layer), 0o755)
+        with open(self.layer, 'w') as f_out:
+            f_out.write('{}')
+        os.chmod(self.layer, 0o644)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def found(self) -> tuple:
+        untrusted = []
+        layers = find_layers('gcc', self.project, untrusted)
+        return [path for path, _ in layers if path.startswith(self.directory)], untrusted
+
+    def test_trusted(self):
+        self.assertEqual(self.found(), ([self.layer], []))
+
+    def test_writable_by_others(self):
+        for path in (self.layer, os.path.dirname(self.layer), self.project):
+            os.chmod(path, 0o777 if os.path.isdir(path) else 0o666)
+            self.assertEqual(self.found(), ([], [self.layer]), path)
+            os.chmod(path, 0o755 if os.path.isdir(path) else 0o644)
+
+    def test_refused_keys(self):
+        dct = {'args_to_append': ['-g']}
+        for key in ('launcher', 'env_set', 'rlimits', 'offload_workers'):
+            self.assertRaises(ValueError, merge, dct, {'args_to_append': ['-O2'], key: {}})
+        self.assertEqual(dct, {'args_to_append': ['-g']})
+
+    def test_merge(self):
+        dct = {'args_to_append': ['-g'], 'parallelism': {'make': 'cpus'}, 'frozen': True}
+        merge(dct, {'args_to_append': ['-O2'], 'parallelism': {'ninja': 'cpus'},
+                    'frozen': False, 'deduplication': True})
+        self.assertEqual(dct, {'args_to_append': ['-g', '-O2'], 'frozen': True,
+                               'parallelism': {'make': 'cpus', 'ninja': 'cpus'},
+                               'deduplication': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
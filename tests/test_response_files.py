@@ -0,0 +1,111 @@
+"""
+Tests of reading response files the way GCC does, of writing them, and of applying the rules
+to them.
+"""
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from interceptor.config import Configuration
+from interceptor.response_files import quote_all, read_arguments, spill, split
+
+# contents of a response file, and the arguments GCC reads from it
+SPLITS = [
+    ('a b\tc\n d', ['a', 'b', 'c', 'd']),
+    ('  \n', []),
+    ("'a b' \"c d\"", ['a b', 'c d']),
+    ('a\\ b c\\\\d', ['a b', 'c\\d']),
+    ("-D'X=\"a b\"'", ['-DX="a b"']),
+    ("'a\\'b' \"a\\\"b\"", ["a'b", 'a"b']),
+    ("a'b c'd e", ['ab cd', 'e']),
+    ("'' \"\" x", ['', '', 'x']),
+    ("'unterminated quote", ['unterminated quote']),
+    ('trailing\\', ['trailing']),
+]
+
+CHARACTERS = ['a', 'b', ' ', '\t', '\n', "'", '"', '\\', '@', '-', 'ż']
+
+
+def random_text(rnd: random.Random) -> str:
+    return ''.join(rnd.choice(CHARACTERS) for _ in range(rnd.randint(0, 40)))
+
+
+class TestSplit(unittest.TestCase):
+    def test_splits(self):
+        for text, args in SPLITS:
+            self.assertEqual(list(split(text)), args, text)
+
+    def test_round_trip(self):
+        rnd = random.Random(1)
+        for _ in range(2000):
+            args = [random_text(rnd)[:rnd.randint(0, 8)] for _ in range(rnd.randint(1, 6))]
+            self.assertEqual(list(split(quote_all(args))), args, args)
+
+
+class TestResponseFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tmpdir = os.environ.get('TMPDIR')
+        os.environ['TMPDIR'] = self.directory
+
+    def tearDown(self):
+        if self.tmpdir is None:
+            del os.environ['TMPDIR']
+        else:
+            os.environ['TMPDIR'] = self.tmpdir
+        shutil.rmtree(self.directory)
+
+    def write(self, name: str, content: str) -> str:
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f_out:
+            f_out.write(content)
+        return path
+
+    def test_chunks(self):
+        # arguments and quotes cut in half by the end of a chunk are read whole
+        rnd = random.Random(2)
+        for _ in range(500):
+            text = random_text(rnd)
+            path = self.write('args', text)
+            for chunk_size in (1, 3, 7):
+                self.assertEqual(list(read_arguments(path, chunk_size)), list(split(text)),
+                                 (text, chunk_size))
+
+    def test_rewrite(self):
+        cfg = Configuration(app_name='gcc', response_files=True, args_to_disable=['-O3'],
+                            args_to_replace=[['-g', '-g1']])
+        nested = self.write('nested', "-O3 'a b.c'\n")
+        unchanged = self.write('unchanged', '-O2 -Wall\n')
+        outer = self.write('outer', '-g @%s @%s\n' % (nested, unchanged))
+        temporary_files = []
+        args = cfg.rewrite(['gcc', '@' + outer, '@missing', '-O3'],
+                           temporary_files=temporary_files)
+        self.assertEqual(len(temporary_files), 2)
+        self.assertEqual(args, ['gcc', '@' + temporary_files[1], '@missing'])
+        rewritten = list(read_arguments(temporary_files[1]))
+        self.assertEqual(rewritten, ['-g1', '@' + temporary_files[0], '@' + unchanged])
+        self.assertEqual(list(read_arguments(temporary_files[0])), ['a b.c'])
+
+    def test_spill(self):
+        args = ['gcc', '-DX="a b"', "it's", 'c:\\dir', '', 'x\ny']
+        temporary_files = []
+        new_args = spill(args, temporary_files)
+        self.assertEqual(new_args, ['gcc', '@' + temporary_files[0]])
+        self.assertEqual(list(read_arguments(temporary_files[0])), args[1:])
+
+    @unittest.skipUnless(shutil.which('gcc'), 'gcc is not installed')
+    def test_gcc_reads_spilled_file(self):
+        args = ['gcc', '-E', '-dM', '-x', 'c', os.devnull, '-DQUOTED="a \'b\' \\\\c"',
+                '-DSPACED=x y']
+        new_args = spill(args, [])
+        process = subprocess.run(new_args, stdout=subprocess.PIPE, check=True)
+        macros = process.stdout.decode('utf-8').splitlines()
+        self.assertIn('#define QUOTED "a \'b\' \\\\c"', macros)
+        self.assertIn('#define SPACED x y', macros)
+
+
+if __name__ == '__main__':
+    unittest.main()
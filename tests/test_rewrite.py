@@ -0,0 +1,98 @@
+"""
+Property tests of the compiled Rewriter, against the rules applied one after another the way
+Configuration.modify did before they were compiled.
+"""
+import marshal
+import random
+import unittest
+
+from interceptor.config import Configuration
+from interceptor.rewrite import Rewriter
+
+VOCABULARY = ['-a', '-b', '-c', '-O2', '-O3', 'x.o', 'y.o', '-g', '-DX', '-march=native']
+CASES = 20000
+
+
+def sequential_modify(args: list, args_to_disable=(), args_to_append=(), args_to_prepend=(),
+                      args_to_replace=(), deduplication: bool = False) -> list:
+    """The argument rules applied one after another, as they were before being compiled"""
+    process, *arguments = args
+    for arg_to_take_away in args_to_disable:
+        while arg_to_take_away in arguments:
+            del arguments[arguments.index(arg_to_take_away)]
+
+    for arg_to_replace, arg_to_replace_with in args_to_replace:
+        while arg_to_replace in arguments:
+            arguments[arguments.index(arg_to_replace)] = arg_to_replace_with
+
+    for arg_to_append in args_to_append:
+        if arg_to_append not in arguments:
+            arguments.append(arg_to_append)
+
+    for arg_to_prepend in reversed(args_to_prepend):
+        if arg_to_prepend not in arguments:
+            arguments = [arg_to_prepend] + arguments
+
+    if deduplication:
+        new_arguments = []
+        added_args = set()
+        for arg in arguments:
+            if arg not in added_args:
+                new_arguments.append(arg)
+                added_args.add(arg)
+        arguments = new_arguments
+    return [process, *arguments]
+
+
+def random_rules(rnd: random.Random) -> dict:
+    def pick(count: int) -> list:
+        return [rnd.choice(VOCABULARY) for _ in range(rnd.randint(0, count))]
+
+    # a rule replacing an argument with itself made the loop above spin forever
+    return {'args_to_disable': pick(3),
+            'args_to_append': pick(3),
+            'args_to_prepend': pick(3),
+            'args_to_replace': [[arg, replace_with] for arg, replace_with in zip(pick(3), pick(3))
+                                if arg != replace_with],
+            'deduplication': rnd.random() < 0.5}
+
+
+def random_args(rnd: random.Random) -> list:
+    return ['cc'] + [rnd.choice(VOCABULARY) for _ in range(rnd.randint(0, 12))]
+
+
+class TestRewriter(unittest.TestCase):
+    def test_same_as_sequential_rules(self):
+        rnd = random.Random(1)
+        for _ in range(CASES):
+            rules = random_rules(rnd)
+            args = random_args(rnd)
+            expected = sequential_modify(list(args), **rules)
+            result = Configuration(app_name='cc', **rules).modify(list(args))
+            self.assertEqual(result, expected, (rules, args))
+
+    def test_plan_round_trip(self):
+        rnd = random.Random(2)
+        for _ in range(CASES // 10):
+            rules = random_rules(rnd)
+            rewriter = Rewriter(rules['args_to_disable'], rules['args_to_append'],
+                                rules['args_to_prepend'], rules['args_to_replace'],
+                                ['-march=*'], [['re:-O[0-3]', '-O1']], rules['deduplication'])
+            loaded = Rewriter.from_plan(marshal.loads(marshal.dumps(rewriter.to_plan())))
+            args = random_args(rnd)[1:]
+            self.assertEqual(loaded.rewrite(list(args)), rewriter.rewrite(list(args)),
+                             (rules, args))
+
+    def test_patterns(self):
+        rewriter = Rewriter(patterns_to_disable=['-march=*'],
+                            patterns_to_replace=[['-O[0-3]', '-O2'], ['re:-W.*', '-Wall']],
+                            args_to_replace=[['-O3', '-Os']])
+        notes = []
+        self.assertEqual(rewriter.rewrite(['-march=x', '-O3', '-O1', '-Wextra', 'a.c'], notes),
+                         ['-Os', '-O2', '-Wall', 'a.c'])
+        self.assertEqual(notes, ['taking away -march=x', 'replacing -O3 with -Os',
+                                 'replacing -O1 with -O2', 'replacing -Wextra with -Wall'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Tests of machine-wide concurrency slots, ran in child processes since the slots are held until
+the process exits.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# takes a slot of ld, prints the descriptor holding it and runs the rest of argv
+ACQUIRE = '''
+import os, sys, time
+from interceptor.config import Configuration
+from interceptor.slots import acquire_slot
+started_at = time.monotonic()
+fd = acquire_slot(Configuration(app_name="ld", max_concurrent=1))
+print(fd, round(time.monotonic() - started_at, 3), flush=True)
+if len(sys.argv) > 1:
+    os.execv(sys.argv[1], sys.argv[1:])
+'''
+
+
+class TestSlots(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.env = {name: value for name, value in os.environ.items()
+                    if not name.startswith('INTERCEPTOR_')}
+        self.env['VIRTUAL_ENV'] = self.directory
+        self.env['PYTHONPATH'] = ROOT
+        os.makedirs(os.path.join(self.directory, 'etc', 'interceptor.d'))
+        subprocess.run([sys.executable, '-c',
+                        'from interceptor.config import Configuration\n'
+                        'Configuration(app_name="ld", max_concurrent=1).save()'],
+                       env=self.env, check=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def acquire(self, *args, **kwargs) -> subprocess.Popen:
+        return subprocess.Popen([sys.executable, '-c', ACQUIRE] + list(args), env=self.env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+
+    def test_waits_for_slot(self):
+        holder = self.acquire('/bin/sleep', '0.5')
+        fd, _ = holder.stdout.readline().split()
+        self.assertNotEqual(fd, b'None')
+        waiter = self.acquire()
+        stdout, _ = waiter.communicate(timeout=10)
+        fd, waited = stdout.split()
+        self.assertNotEqual(fd, b'None')
+        self.assertGreater(float(waited), 0.2)
+        holder.wait()
+
+    def test_nested_runs_in_parent_slot(self):
+        # a tool sharing the slots, ran by the holder, would otherwise wait for itself forever
+        holder = self.acquire(sys.executable, '-c', ACQUIRE)
+        stdout, _ = holder.communicate(timeout=10)
+        lines = stdout.splitlines()
+        self.assertNotEqual(lines[0].split()[0], b'None')
+        self.assertEqual(lines[1].split()[0], b'None')
+
+    def test_runs_without_slots_that_cannot_be_opened(self):
+        os.makedirs(os.path.join(self.directory, 'var', 'run'))
+        with open(os.path.join(self.directory, 'var', 'run', 'interceptor'), 'w'):
+            pass
+        # the warning is written once down the process tree
+        process = self.acquire(sys.executable, '-c', ACQUIRE)
+        stdout, stderr = process.communicate(timeout=10)
+        self.assertEqual([line.split()[0] for line in stdout.splitlines()], [b'None', b'None'])
+        self.assertEqual(stderr.count(b'running without a slot'), 1)
+
+    def test_statistics(self):
+        for _ in range(2):
+            self.acquire().communicate(timeout=10)
+        process = subprocess.run([sys.executable, '-c',
+                                  'from interceptor.config import Configuration\n'
+                                  'from interceptor.slots import print_slots\n'
+                                  'print_slots(Configuration(app_name="ld", '
+                                  'max_concurrent=1))'],
+                                 env=self.env, stdout=subprocess.PIPE, check=True)
+        self.assertEqual(process.stdout.decode('utf-8').splitlines(),
+                         ['Slots: 0 of 1 taken', 'None of 2 runs waited for a slot'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+The generated wrapper runs on every call to an intercepted tool, so it may only import
+interceptor's hot path and cheap parts of the standard library, and it has to start about as
+fast as the interpreter itself.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from interceptor.intercepting import render_wrapper
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the modules that a wrapper may import, besides those imported by the interpreter at startup
+ALLOWED_MODULES = frozenset(('interceptor', 'interceptor.config', 'interceptor.runtime',
+                             'interceptor.rewrite', 'interceptor.chain', 'errno',
+                             'marshal', 'stat', 'time', 'zlib'))
+
+# how much longer than the bare interpreter a wrapper may take to start and exec the tool
+MAX_OVERHEAD = 0.05
+RUNS = 10
+
+
+def imported_modules(args: list, env: dict) -> set:
+    """:return: the names of the modules imported by running args under -X importtime"""
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + args, env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    modules = set()
+    for line in process.stderr.decode('utf-8').splitlines():
+        if line.startswith('import time:') and not line.endswith('imported package'):
+            modules.add(line.rpartition('|')[2].strip())
+    return modules
+
+
+def best_time(args: list, env: dict) -> float:
+    times = []
+    for _ in range(RUNS):
+        started_at = time.perf_counter()
+        subprocess.run(args, env=env, check=True)
+        times.append(time.perf_counter() - started_at)
+    return min(times)
+
+
+class TestWrapperStartup(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.env = {name: value for name, value in os.environ.items()
+                    if not name.startswith('INTERCEPTOR_')}
+        self.env['VIRTUAL_ENV'] = self.directory
+        self.env['PYTHONPATH'] = ROOT
+        os.makedirs(os.path.join(self.directory, 'etc', 'interceptor.d'))
+        self.wrapper = os.path.join(self.directory, 'foo')
+        with open(self.wrapper, 'w') as f_out:
+            f_out.write(render_wrapper('foo', shutil.which('true')))
+        os.chmod(self.wrapper, 0o755)
+        self.startup_modules = imported_modules(['-c', 'pass'], self.env)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def configure(self, frozen: bool) -> None:
+        # in a child, since the paths of the configuration are kept once they're found
+        subprocess.run([sys.executable, '-c',
+                        'from interceptor.config import Configuration\n'
+                        'Configuration(app_name="foo", frozen=%r, args_to_disable=["-O3"],'
+                        ' args_to_replace=[["-O2", "-Os"]]).save()' % (frozen,)],
+                       env=self.env, check=True)
+
+    def test_frozen_imports(self):
+        self.configure(frozen=True)
+        extra = imported_modules([self.wrapper, '-O3'], self.env) - self.startup_modules
+        self.assertEqual(extra - ALLOWED_MODULES, set())
+
+    def test_json_imports(self):
+        self.configure(frozen=False)
+        # parsing the JSON configuration needs json, and whatever it imports
+        allowed = ALLOWED_MODULES | imported_modules(['-c', 'import json'], self.env)
+        extra = imported_modules([self.wrapper, '-O3'], self.env) - self.startup_modules
+        self.assertEqual(extra - allowed, set())
+
+    def test_startup_time(self):
+        self.configure(frozen=True)
+        interpreter = best_time([sys.executable, '-c', 'pass'], self.env)
+        wrapper = best_time([self.wrapper, '-O3'], self.env)
+        self.assertLess(wrapper, interpreter + MAX_OVERHEAD)
+
+
+if __name__ == '__main__':
+    unittest.main()